@@ -0,0 +1,17 @@
+# Loaded by gunicorn from the working directory
+import os
+
+
+def on_starting(server):
+    # Metrics files of the workers of a previous server are stale
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'managment.settings')
+    from managment import metrics
+    metrics.reset()
+
+
+def worker_exit(server, worker):
+    # Write the log records still queued before the worker process exits
+    from managment.log import flush
+    flush()
+    from managment import metrics
+    metrics.flush()
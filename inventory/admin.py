@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Article, Stock, Sale, Order
+from .models import Article, Stock, Sale, Order, DailySalesRollup, LayerConsumption
 
 
 # Register your models here.
@@ -7,3 +7,5 @@ admin.site.register(Article)
 admin.site.register(Stock)
 admin.site.register(Sale)
 admin.site.register(Order)
+admin.site.register(DailySalesRollup)
+admin.site.register(LayerConsumption)
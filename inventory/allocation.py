@@ -0,0 +1,153 @@
+"""
+Stock allocation engine
+Sells articles by consuming their active stock layers inside a single
+transaction. Availability is reserved by updating the article stock
+counters before anything is read, which takes the write locks first, so
+concurrent sales of the same article are serialized on every backend
+(row lock on PostgreSQL, database write lock on SQLite).
+"""
+import logging
+from collections import defaultdict
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import F, Case, When, Value, IntegerField, DecimalField
+from django.utils import timezone
+from .models import Article, Stock, Sale, LayerConsumption
+from .caching import totals_cache, invalidate_collections
+from . import sqlite
+from managment import metrics
+
+allocation_logger = logging.getLogger(__name__)
+
+# Order in which the stock layers of an article are consumed
+POLICIES = {
+    'FIFO': ('created_at', 'id'),
+    'LIFO': ('-created_at', '-id'),
+}
+
+
+class NotEnoughStock(Exception):
+    def __init__(self, articles):
+        self.articles = set(articles)
+        super().__init__("Not enough stock of articles %s" %
+                         sorted(self.articles))
+
+
+def get_policy(policy=None):
+    policy = (policy or getattr(
+        settings, 'STOCK_ALLOCATION_POLICY', 'LIFO')).upper()
+    if policy not in POLICIES:
+        raise ValueError("Unknown stock allocation policy %s" % policy)
+    return policy
+
+
+def sell(article, quantity, price, user, policy=None):
+    """
+    Sells quantity units of the article at the given price, and returns the
+    created sales, one per consumed stock layer.
+    Raises NotEnoughStock when the article can not cover the quantity.
+    """
+    line = {'article': article, 'quantity': quantity, 'price': price}
+    return sell_cart([line], user, policy)[0]
+
+
+def sell_cart(lines, user, policy=None):
+    """
+    Sells every line of a cart, given as dicts with article, quantity and
+    price, in a single transaction. Returns the created sales of each line,
+    in the same order as the lines.
+    Raises NotEnoughStock, and writes nothing, when any line can not be filled.
+    """
+    ordering = POLICIES[get_policy(policy)]
+    # The writer thread does not know the view of the request
+    view = metrics.current_view() or 'unknown'
+
+    def on_retry(attempt):
+        allocation_logger.warning(
+            "DATABASE LOCKED WHILE SELLING, RETRY %s", attempt)
+        metrics.inc('inventory_allocation_retries_total', view=view)
+
+    return sqlite.write(_sell_lines, lines, user, ordering, on_retry=on_retry)
+
+
+def _per_article(values, output_field):
+    return Case(*[When(pk=article, then=Value(value)) for article, value in values.items()],
+                default=Value(0), output_field=output_field)
+
+
+def _sell_lines(lines, user, ordering):
+    requested = defaultdict(int)
+    for line in lines:
+        requested[line['article']] += line['quantity']
+    # Reserving first takes the write locks, then one read checks every article
+    Article.objects.filter(pk__in=requested).update(
+        stock_quantity=F('stock_quantity') - _per_article(requested, IntegerField()))
+    available = dict(Article.objects.filter(
+        pk__in=requested).values_list('id', 'stock_quantity'))
+    missing = [article for article in requested if available.get(article, -1) < 0]
+    if missing:
+        raise NotEnoughStock(missing)
+
+    layers = defaultdict(list)
+    candidates = Stock.objects.select_for_update().select_related('article').filter(
+        article__in=requested, status=True, quantity__gt=0).order_by('article', *ordering)
+    for layer in candidates:
+        layers[layer.article_id].append(layer)
+
+    now = timezone.now()
+    sales = []
+    consumed = {}
+    value = defaultdict(int)
+    for line in lines:
+        line_sales = []
+        remaining = line['quantity']
+        article_layers = layers[line['article']]
+        while remaining and article_layers:
+            layer = article_layers[0]
+            taken = min(layer.quantity, remaining)
+            layer.quantity -= taken
+            layer.status = layer.quantity > 0
+            layer.updated_by = user
+            layer.updated_at = now
+            consumed[layer.pk] = layer
+            line_sales.append(Sale(stock=layer, quantity=taken, price=line['price'],
+                                   created_by=user, updated_by=user))
+            value[line['article']] += taken * layer.cost
+            remaining -= taken
+            if not layer.quantity:
+                article_layers.pop(0)
+        if remaining:
+            # The counter was out of sync with the layers, nothing is written
+            allocation_logger.error(
+                "STOCK COUNTER OF ARTICLE %s IS OUT OF SYNC", line['article'])
+            raise NotEnoughStock([line['article']])
+        sales.append(line_sales)
+
+    Stock.objects.bulk_update(
+        consumed.values(), ['quantity', 'status', 'updated_at', 'updated_by'])
+    for layer in consumed.values():
+        layer._counted = layer.counted_values()
+    Article.objects.filter(pk__in=value).update(
+        stock_value=F('stock_value') - _per_article(value, DecimalField()))
+    created = bulk_create_with_pks(
+        Sale, [sale for line_sales in sales for sale in line_sales])
+    Sale.add_to_rollup(created)
+    LayerConsumption.record(created)
+    totals_cache.invalidate()
+    invalidate_collections(Article, Stock, Sale)
+    return sales
+
+
+def bulk_create_with_pks(model, objs):
+    """
+    bulk_create on backends that return the primary keys of the inserted
+    rows, PostgreSQL. Elsewhere the rows are inserted one at a time, which
+    sets their primary keys, skipping the save() of the model like
+    bulk_create does.
+    """
+    connection = connections[router.db_for_write(model)]
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    for obj in objs:
+        obj.save_base(force_insert=True)
+    return objs
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class InventoryConfig(AppConfig):
     name = 'inventory'
+
+    def ready(self):
+        from . import authentication, caching, images, search, sqlite
+        search.connect_signals()
+        caching.connect_signals()
+        authentication.connect_signals()
+        images.connect_signals()
+        sqlite.connect_signals()
@@ -0,0 +1,119 @@
+"""
+Authentication
+Token authentication that keeps the users of recently seen tokens in an
+in-process LRU, optionally backed by the shared Django cache, so most
+requests skip the token and user query.
+Entries are dropped when their token is deleted or their user is saved,
+in this process and in the shared cache. Other processes can keep a local
+entry until its TTL expires, so TOKEN_CACHE_TTL bounds how long a revoked
+token may still be accepted there.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from managment import metrics
+
+
+class TokenCache:
+    """
+    LRU of (user, token) pairs by token key, with a TTL.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'TOKEN_CACHE_SIZE', 1024)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'TOKEN_CACHE_TTL', 30)
+
+    @property
+    def shared(self):
+        return getattr(settings, 'TOKEN_CACHE_SHARED', False)
+
+    def shared_key(self, key):
+        return 'inventory:token:%s' % key
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+        if self.shared:
+            value = cache.get(self.shared_key(key))
+            if value is not None:
+                self.set(key, value, shared=False)
+                return value
+        return None
+
+    def set(self, key, value, shared=True):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if shared and self.shared:
+            cache.set(self.shared_key(key), value, self.ttl)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        if self.shared:
+            cache.delete_many([self.shared_key(key) for key in keys])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that reads the users of known tokens from the
+    token cache.
+    """
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        if credentials is None:
+            metrics.inc('inventory_cache_requests_total', cache='token', result='miss')
+            credentials = super().authenticate_credentials(key)
+            token_cache.set(key, credentials)
+        else:
+            metrics.inc('inventory_cache_requests_total', cache='token', result='hit')
+        return credentials
+
+
+def forget_token(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+
+
+def forget_user_tokens(sender, instance, created=False, **kwargs):
+    if not created:
+        keys = list(Token.objects.filter(
+            user=instance).values_list('key', flat=True))
+        if keys:
+            token_cache.delete(*keys)
+
+
+def connect_signals():
+    User = get_user_model()
+    post_save.connect(forget_token, sender=Token, dispatch_uid='token_cache_save')
+    post_delete.connect(forget_token, sender=Token, dispatch_uid='token_cache_delete')
+    post_save.connect(forget_user_tokens, sender=User, dispatch_uid='token_cache_user')
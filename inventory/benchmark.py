@@ -0,0 +1,476 @@
+"""
+Benchmark
+Seeds a synthetic dataset with bulk inserts and drives the API endpoints
+through the DRF test client, measuring latency percentiles, SQL queries
+and memory of every scenario. The dataset only depends on its sizes and
+seed, so reports of different commits can be compared.
+The load test forks reader and writer processes that hit the API at the
+same time, to see how they wait on each other for the database, and the
+serving benchmark compares the sync WSGI worker with the ASGI handler.
+"""
+import asyncio
+import datetime
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from decimal import Decimal
+from urllib.parse import urlencode
+import django
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction, OperationalError
+from django.db.models import OuterRef, Subquery, Sum, F, DecimalField, IntegerField
+from django.db.models.functions import Coalesce
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from managment.handlers import ThreadPoolASGIHandler
+from .models import Article, Stock, Sale, DailySalesRollup, LayerConsumption
+from .search import INDEXES, get_backend
+from .caching import totals_cache
+from .sqlite import insert_rows
+
+BATCH_SIZE = 10000
+USERNAME = 'benchmark'
+
+
+class Scenario:
+    """
+    A request to measure. data is a dict or a function of the end date of
+    the dataset. cold scenarios invalidate the totals cache before every
+    request.
+    """
+
+    def __init__(self, name, method, path, data=None, cold=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data or {}
+        self.cold = cold
+
+    def get_data(self, today):
+        return self.data(today) if callable(self.data) else self.data
+
+    def request(self, client, today):
+        return getattr(client, self.method)(self.path, self.get_data(today))
+
+    def raw(self, today):
+        """
+        Returns the method, path, query string and body of the request.
+        """
+        data = self.get_data(today)
+        if self.method == 'get':
+            return 'GET', self.path, urlencode(data), b''
+        return self.method.upper(), self.path, '', json.dumps(data).encode('utf-8')
+
+
+SCENARIOS = (
+    Scenario('articles', 'get', '/api/articles/'),
+    Scenario('articles_sorted', 'get', '/api/articles/', {'order': 'name'}),
+    Scenario('articles_search', 'get', '/api/articles/', {'search': 'articulo 12'}),
+    Scenario('articles_keyset', 'get', '/api/articles/', {'cursor': '', 'order': '-created_at'}),
+    Scenario('sales', 'get', '/api/sales/'),
+    Scenario('sales_sorted', 'get', '/api/sales/', {'order': '-price'}),
+    Scenario('sales_keyset', 'get', '/api/sales/', {'cursor': '', 'order': '-created_at'}),
+    Scenario('totals', 'get', '/api/getTotals'),
+    Scenario('totals_cold', 'get', '/api/getTotals', cold=True),
+    Scenario('earnings_month_by_day', 'post', '/api/getEarnings', lambda today: {
+        'dateFrom': (today - datetime.timedelta(days=29)).isoformat(),
+        'dateTo': today.isoformat(), 'dateType': 'day'}),
+    Scenario('earnings_year_by_month', 'post', '/api/getEarnings', lambda today: {
+        'dateFrom': (today - datetime.timedelta(days=364)).isoformat(),
+        'dateTo': today.isoformat(), 'dateType': 'month'}),
+    Scenario('valuation', 'get', '/api/getValuation'),
+    Scenario('valuation_month_ago', 'get', '/api/getValuation', lambda today: {
+        'date': (today - datetime.timedelta(days=30)).isoformat()}),
+    Scenario('cogs_month', 'get', '/api/getCogs', lambda today: {
+        'dateFrom': (today - datetime.timedelta(days=29)).isoformat(),
+        'dateTo': today.isoformat()}),
+)
+
+# Served by the WSGI and ASGI handlers, the exports stream their response
+SERVING_SCENARIOS = tuple(
+    scenario for scenario in SCENARIOS
+    if scenario.name in ('totals', 'earnings_month_by_day', 'earnings_year_by_month')
+) + (Scenario('sales_export', 'get', '/api/sales/export/', {'type': 'csv'}),)
+
+
+def batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_sales(sale_rows, consumption_rows):
+    insert_rows(Sale, ('id', 'stock', 'quantity', 'price', 'status', 'created_at',
+                       'updated_at', 'created_by', 'updated_by'), sale_rows)
+    insert_rows(LayerConsumption, ('id', 'stock', 'article', 'sale', 'quantity', 'unit_cost',
+                                   'cost', 'created_at'), consumption_rows)
+
+
+def seed(articles, layers, sales, days=365, seed=1):
+    """
+    Writes a dataset of the given sizes into an empty database, spread
+    over the last days, with the layer consumption of every sale, and
+    brings the counters, rollup and search index up to date. Returns the number of seconds it took.
+    """
+    started = time.perf_counter()
+    generator = random.Random(seed)
+    user, _ = get_user_model().objects.get_or_create(username=USERNAME)
+    end = timezone.now().replace(microsecond=0)
+    start = end - datetime.timedelta(days=days)
+    span = int((end - start).total_seconds())
+
+    def moment():
+        return start + datetime.timedelta(seconds=generator.randrange(span))
+
+    with transaction.atomic():
+        for batch in batches(
+                (i, 'Articulo %s' % i, 'SKU%08d' % i, 'Caja %s' % (i % 200),
+                 Decimal(generator.randrange(1000, 100000)) / 100, True, start, start,
+                 user.pk, user.pk)
+                for i in range(1, articles + 1)):
+            insert_rows(Article, ('id', 'name', 'sku', 'location', 'suggested_price', 'status',
+                                  'created_at', 'updated_at', 'created_by', 'updated_by'), batch)
+        costs = []
+        layer_rows = []
+        for i in range(1, layers + 1):
+            cost = Decimal(generator.randrange(100, 50000)) / 100
+            quantity = generator.randrange(0, 50)
+            created_at = moment()
+            costs.append(cost)
+            layer_rows.append((i, (i - 1) % articles + 1, quantity, cost, quantity > 0,
+                               created_at, created_at, user.pk, user.pk))
+            if len(layer_rows) >= BATCH_SIZE:
+                insert_rows(Stock, ('id', 'article', 'quantity', 'cost', 'status', 'created_at',
+                                    'updated_at', 'created_by', 'updated_by'), layer_rows)
+                layer_rows = []
+        insert_rows(Stock, ('id', 'article', 'quantity', 'cost', 'status', 'created_at',
+                            'updated_at', 'created_by', 'updated_by'), layer_rows)
+        sale_rows = []
+        consumption_rows = []
+        for i in range(1, sales + 1):
+            stock_id = generator.randrange(1, layers + 1)
+            created_at = moment()
+            quantity = generator.randrange(1, 4)
+            cost = costs[stock_id - 1]
+            price = (cost * Decimal('1.3')).quantize(Decimal('0.01'))
+            sale_rows.append((i, stock_id, quantity, price, generator.random() > 0.05,
+                              created_at, created_at, user.pk, user.pk))
+            # What the allocation engine records for every sale
+            consumption_rows.append((i, stock_id, (stock_id - 1) % articles + 1, i, quantity, cost,
+                                     quantity * cost, created_at))
+            if len(sale_rows) >= BATCH_SIZE:
+                insert_sales(sale_rows, consumption_rows)
+                sale_rows = []
+                consumption_rows = []
+        insert_sales(sale_rows, consumption_rows)
+        active = Stock.objects.filter(article=OuterRef('pk'), status=True).order_by().values('article')
+        Article.objects.update(
+            stock_quantity=Coalesce(Subquery(active.annotate(
+                total=Sum('quantity')).values('total'), output_field=IntegerField()), 0),
+            stock_value=Coalesce(Subquery(active.annotate(total=Sum(
+                F('quantity') * F('cost'), output_field=DecimalField())).values('total'),
+                output_field=DecimalField()), 0))
+        # Rows were inserted with their ids, move the sequences past them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [Article, Stock, Sale, LayerConsumption]):
+                cursor.execute(sql)
+        DailySalesRollup.rebuild()
+        for index in INDEXES.values():
+            get_backend().rebuild(index)
+    totals_cache.bump()
+    return time.perf_counter() - started
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(rank / 100.0 * (len(values) - 1))))]
+
+
+def measure(client, scenario, requests, today, warmup=2):
+    """
+    Returns the latency percentiles in milliseconds, the queries per
+    request and the peak of memory allocated by one request of a scenario.
+    """
+    for _ in range(warmup):
+        scenario.request(client, today)
+    timings = []
+    queries = []
+    statuses = set()
+    for _ in range(requests):
+        if scenario.cold:
+            totals_cache.bump()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = scenario.request(client, today)
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+        statuses.add(response.status_code)
+    if scenario.cold:
+        totals_cache.bump()
+    tracemalloc.start()
+    scenario.request(client, today)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'requests': requests,
+        'status': sorted(statuses),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': max(queries),
+        'peak_memory_kb': peak // 1024,
+    }
+
+
+def run(requests=50, scenarios=SCENARIOS):
+    """
+    Measures every scenario as the benchmark user and returns the results
+    by scenario name.
+    """
+    client = APIClient()
+    client.force_authenticate(get_user_model().objects.get(username=USERNAME))
+    today = timezone.localdate()
+    return {scenario.name: measure(client, scenario, requests, today)
+            for scenario in scenarios}
+
+
+def load_worker(role, seconds, seed, results):
+    """
+    Sends requests of its role, article lists for readers and sales for
+    writers, until seconds pass, and puts its timings on results. Runs in
+    a forked process.
+    """
+    generator = random.Random(seed)
+    client = APIClient()
+    client.force_authenticate(get_user_model().objects.get(username=USERNAME))
+    articles = list(Article.objects.filter(stock_quantity__gt=0).values_list('id', flat=True))
+    timings = []
+    statuses = Counter()
+    errors = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            if role == 'read':
+                response = client.get('/api/articles/', {'order': '-created_at'})
+            else:
+                response = client.post('/api/sales/', {
+                    'article': generator.choice(articles), 'quantity': 1, 'price': 10})
+            statuses[response.status_code] += 1
+        except OperationalError as error:
+            errors[str(error)] += 1
+        timings.append((time.perf_counter() - started) * 1000)
+    connections.close_all()
+    results.put((role, timings, dict(statuses), dict(errors)))
+
+
+def load_test(readers, writers, seconds):
+    """
+    Runs readers and writers processes against the current database for
+    seconds, and returns the latency percentiles, statuses and database
+    errors of each role.
+    """
+    journal_mode = None
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+    # Children must open connections of their own
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    roles = ['read'] * readers + ['write'] * writers
+    processes = [context.Process(target=load_worker, args=(role, seconds, i, results))
+                 for i, role in enumerate(roles)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    report = {'journal_mode': journal_mode, 'seconds': seconds}
+    for role in ('read', 'write'):
+        timings = []
+        statuses = Counter()
+        errors = Counter()
+        for result_role, result_timings, result_statuses, result_errors in collected:
+            if result_role == role:
+                timings += result_timings
+                statuses.update(result_statuses)
+                errors.update(result_errors)
+        if not timings:
+            continue
+        report[role] = {
+            'processes': roles.count(role),
+            'requests': len(timings),
+            'per_second': round(len(timings) / seconds, 1),
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'max_ms': round(max(timings), 3),
+            'status': dict(statuses),
+            'errors': dict(errors),
+        }
+    return report
+
+
+def wsgi_request(handler, token, method, path, query, body):
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'testserver', 'HTTP_AUTHORIZATION': 'Token %s' % token,
+        'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http', 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    statuses = []
+    response = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        for _ in response:
+            pass
+    finally:
+        response.close()
+    return int(statuses[0].split()[0])
+
+
+async def asgi_request(application, token, method, path, query, body):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode('utf-8'),
+        'query_string': query.encode('utf-8'), 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('ascii')),
+                    (b'authorization', ('Token %s' % token).encode('ascii'))],
+        'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+    }
+    statuses = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await application(scope, receive, send)
+    return statuses[0]
+
+
+def throughput(timings, statuses, seconds):
+    return {
+        'requests': len(timings),
+        'per_second': round(len(timings) / seconds, 1),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'status': dict(Counter(statuses)),
+    }
+
+
+def serving(requests=50, concurrency=16, scenarios=SERVING_SCENARIOS):
+    """
+    Serves requests of every scenario through the WSGI handler one after
+    the other, as a sync gunicorn worker does, and through the ASGI handler
+    with concurrency clients at once, returning the throughput of both.
+    """
+    user = get_user_model().objects.get(username=USERNAME)
+    token = Token.objects.get_or_create(user=user)[0].key
+    today = timezone.localdate()
+    calls = [scenario.raw(today) for scenario in scenarios] * requests
+    # Pool threads open connections of their own
+    connections.close_all()
+
+    handler = WSGIHandler()
+    timings = []
+    statuses = []
+    started = time.perf_counter()
+    for call in calls:
+        request_started = time.perf_counter()
+        statuses.append(wsgi_request(handler, token, *call))
+        timings.append((time.perf_counter() - request_started) * 1000)
+    wsgi = throughput(timings, statuses, time.perf_counter() - started)
+
+    application = ThreadPoolASGIHandler()
+    timings = []
+    statuses = []
+
+    async def client(pending):
+        while pending:
+            call = pending.pop()
+            request_started = time.perf_counter()
+            statuses.append(await asgi_request(application, token, *call))
+            timings.append((time.perf_counter() - request_started) * 1000)
+
+    async def clients():
+        pending = list(calls)
+        await asyncio.gather(*[client(pending) for _ in range(concurrency)])
+
+    started = time.perf_counter()
+    asyncio.run(clients())
+    asgi = throughput(timings, statuses, time.perf_counter() - started)
+    application.executor.shutdown()
+    asgi['concurrency'] = concurrency
+    return {
+        'scenarios': [scenario.name for scenario in scenarios],
+        'wsgi': wsgi,
+        'asgi': asgi,
+        'speedup': round(asgi['per_second'] / wsgi['per_second'], 3) if wsgi['per_second'] else None,
+    }
+
+
+def compare(results, baseline):
+    """
+    Adds to every scenario the ratio of its p50 and its change in queries
+    against the same scenario of a previous report.
+    """
+    for name, result in results.items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous:
+            result['p50_ratio'] = round(result['p50_ms'] / previous['p50_ms'], 3) \
+                if previous['p50_ms'] else None
+            result['queries_change'] = result['queries'] - previous['queries']
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(dataset, seed_seconds, results):
+    return {
+        'commit': commit(),
+        'created_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'dataset': dataset,
+        'seed_seconds': round(seed_seconds, 3) if seed_seconds is not None else None,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'scenarios': results,
+    }
+
+
+def dumps(data):
+    return json.dumps(data, indent=2, default=str)
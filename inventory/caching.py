@@ -0,0 +1,144 @@
+"""
+Caching
+Versioned entries in Django's cache framework. Every write that changes a
+cached value bumps its version, once the transaction commits, so readers
+of the same cache never get a stale entry and old ones simply expire.
+Workers with a local memory cache only see their own writes, their
+entries are kept for a few seconds, see CACHE_IS_SHARED.
+"""
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from managment import metrics
+
+caching_logger = logging.getLogger(__name__)
+
+
+class VersionedCache:
+    """
+    A cached value under a version number that is bumped on writes, with
+    hit and miss counters shared by every process using the same cache.
+    """
+
+    def __init__(self, namespace, timeout=None):
+        self.namespace = namespace
+        self._timeout = timeout
+
+    @property
+    def timeout(self):
+        if self._timeout is None:
+            return settings.TOTALS_CACHE_TIMEOUT
+        return self._timeout
+
+    def key(self, name):
+        return 'inventory:%s:%s' % (self.namespace, name)
+
+    def version(self):
+        version = cache.get(self.key('version'))
+        if version is None:
+            # Starting from the clock keeps a lost version from reusing old entries
+            version = int(time.time() * 1000)
+            if not cache.add(self.key('version'), version, None):
+                version = cache.get(self.key('version'), version)
+        return version
+
+    def bump(self):
+        cache.set(self.key('modified'), time.time(), None)
+        try:
+            return cache.incr(self.key('version'))
+        except ValueError:
+            return self.version()
+
+    def modified(self):
+        """
+        Time of the last bump seen by this cache, None before the first.
+        """
+        return cache.get(self.key('modified'))
+
+    def invalidate(self):
+        # Bumping again on commit drops entries cached from the state seen
+        # by concurrent readers while the transaction was open
+        self.bump()
+        transaction.on_commit(self.bump)
+
+    def count(self, name):
+        try:
+            cache.incr(self.key(name))
+        except ValueError:
+            cache.add(self.key(name), 1, None)
+
+    def get_or_compute(self, compute):
+        key = self.key('value:%s' % self.version())
+        value = cache.get(key)
+        if value is not None:
+            self.count('hits')
+            metrics.inc('inventory_cache_requests_total', cache=self.namespace, result='hit')
+            return value
+        self.count('misses')
+        metrics.inc('inventory_cache_requests_total', cache=self.namespace, result='miss')
+        value = compute()
+        cache.set(key, value, self.timeout)
+        return value
+
+    def stats(self):
+        return {
+            'version': self.version(),
+            'hits': cache.get(self.key('hits'), 0),
+            'misses': cache.get(self.key('misses'), 0),
+        }
+
+
+totals_cache = VersionedCache('totals')
+_collection_caches = {}
+
+
+def collection_cache(model):
+    """
+    Version of the rows of a model, bumped on every write, which stamps the
+    conditional responses of the lists built from them.
+    """
+    name = model._meta.model_name
+    if name not in _collection_caches:
+        _collection_caches[name] = VersionedCache('collection:%s' % name)
+    return _collection_caches[name]
+
+
+def invalidate_collections(*models):
+    # For writes that skip the signals, like bulk_update or update()
+    for model in models:
+        collection_cache(model).invalidate()
+
+
+def invalidate_collection(sender, instance, **kwargs):
+    collection_cache(sender).invalidate()
+
+
+def invalidate_totals(sender, instance, **kwargs):
+    totals_cache.invalidate()
+
+
+def invalidate_totals_on_status(sender, instance, created=False, **kwargs):
+    # Only active articles count in the totals, new ones have no stock yet
+    if not created and instance.status_changed():
+        totals_cache.invalidate()
+
+
+def connect_signals():
+    from .models import Article, Stock, Sale, Order
+    post_save.connect(invalidate_totals_on_status, sender=Article,
+                      dispatch_uid='totals_save_article')
+    post_delete.connect(invalidate_totals, sender=Article,
+                        dispatch_uid='totals_delete_article')
+    for model in (Stock, Sale):
+        post_save.connect(invalidate_totals, sender=model,
+                          dispatch_uid='totals_save_%s' % model.__name__)
+        post_delete.connect(invalidate_totals, sender=model,
+                            dispatch_uid='totals_delete_%s' % model.__name__)
+    for model in (Article, Stock, Sale, Order):
+        post_save.connect(invalidate_collection, sender=model,
+                          dispatch_uid='collection_save_%s' % model.__name__)
+        post_delete.connect(invalidate_collection, sender=model,
+                            dispatch_uid='collection_delete_%s' % model.__name__)
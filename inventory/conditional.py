@@ -0,0 +1,68 @@
+import datetime
+import hashlib
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .caching import collection_cache
+
+
+class NotModified(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag and Last-Modified headers to the list and retrieve responses
+    of a viewset, and answers 304 Not Modified right after authentication,
+    before anything is serialized, when the client copy is still current.
+    The version stamp of the collection is the version of every model in
+    stamp_models, the ones its responses are built from, which is bumped on
+    every write. Workers with a local cache never see the versions bumped
+    by the others, so without CACHE_IS_SHARED there are no conditional
+    responses: telling a current copy apart from a stale one would cost a
+    scan of every model on each request.
+    """
+    stamp_models = ()
+    conditional_actions = ('list', 'retrieve')
+
+    def get_version_stamp(self):
+        last_modified = None
+        parts = []
+        for model in self.stamp_models:
+            versions = collection_cache(model)
+            parts.append('%s:%s' % (model.__name__, versions.version()))
+            modified = versions.modified()
+            if modified and (last_modified is None or modified > last_modified):
+                last_modified = modified
+        if last_modified is not None:
+            last_modified = datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc)
+        return '|'.join(parts), last_modified
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if not settings.CACHE_IS_SHARED or self.action not in self.conditional_actions:
+            return
+        stamp, last_modified = self.get_version_stamp()
+        self.etag = '"%s"' % hashlib.md5(('%s|%s' % (
+            stamp, request.get_full_path())).encode('utf-8')).hexdigest()
+        self.last_modified = int(last_modified.timestamp()) if last_modified else None
+        not_modified = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified)
+        if not_modified is not None:
+            not_modified['ETag'] = self.etag
+            raise NotModified(not_modified)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code == 200:
+            response['ETag'] = self.etag
+            if self.last_modified is not None:
+                response['Last-Modified'] = http_date(self.last_modified)
+        return response
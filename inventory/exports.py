@@ -0,0 +1,208 @@
+"""
+Exports
+Streams whole tables as CSV or JSON lines in a single response. Rows are
+read with a values() projection, joining what they need in the same query,
+and fetched with iterator() in chunks, so memory stays the same whatever
+the size of the export.
+"""
+import csv
+import datetime
+import json
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db import router
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import status as http_status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from .models import Article, Stock, Sale
+from .reports import parse_report_date
+
+CHUNK_SIZE = 2000
+# Rows written to the response at once
+LINES_PER_WRITE = 500
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+STATUSES = {'true': True, 'false': False, 'all': None}
+
+
+class Export:
+    """
+    Declares the columns of an export as (header, lookup) pairs, and
+    optionally computed columns as (header, function of the row).
+    """
+
+    def __init__(self, name, model, columns, computed=()):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.computed = computed
+
+    @property
+    def headers(self):
+        return [header for header, _ in self.columns] + [header for header, _ in self.computed]
+
+    def queryset(self, date_from=None, date_to=None, status=True):
+        queryset = self.model.objects.all()
+        if status is not None:
+            queryset = queryset.filter(status=status)
+        if date_from is not None:
+            queryset = queryset.filter(created_at__gte=date_from)
+        if date_to is not None:
+            queryset = queryset.filter(created_at__lte=date_to)
+        return queryset.order_by('id').values_list(
+            *[lookup for _, lookup in self.columns])
+
+    def rows(self, queryset):
+        headers = [header for header, _ in self.columns]
+        for values in queryset.iterator(chunk_size=CHUNK_SIZE):
+            row = dict(zip(headers, values))
+            for header, compute in self.computed:
+                row[header] = compute(row)
+            yield row
+
+
+def sale_net(row):
+    return row['quantity'] * row['price']
+
+
+def sale_gross(row):
+    if row['cost'] is None:
+        return None
+    return row['quantity'] * (row['price'] - row['cost'])
+
+
+EXPORTS = {
+    'sales': Export('sales', Sale, (
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('article', 'stock__article__name'),
+        ('sku', 'stock__article__sku'),
+        ('stock', 'stock'),
+        ('quantity', 'quantity'),
+        ('price', 'price'),
+        ('cost', 'stock__cost'),
+        ('status', 'status'),
+        ('created_by', 'created_by__username'),
+    ), computed=(
+        ('net', sale_net),
+        ('gross', sale_gross),
+    )),
+    'stock': Export('stock', Stock, (
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('article', 'article__name'),
+        ('sku', 'article__sku'),
+        ('quantity', 'quantity'),
+        ('cost', 'cost'),
+        ('status', 'status'),
+        ('updated_at', 'updated_at'),
+    )),
+    'articles': Export('articles', Article, (
+        ('id', 'id'),
+        ('sku', 'sku'),
+        ('name', 'name'),
+        ('location', 'location'),
+        ('suggested_price', 'suggested_price'),
+        ('quantity', 'stock_quantity'),
+        ('value', 'stock_value'),
+        ('link', 'link'),
+        ('status', 'status'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+    )),
+}
+
+
+def to_text(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localtime(value).isoformat() if timezone.is_aware(value) else value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class Echo:
+    """
+    File-like object whose write returns the line, for csv.writer.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(export, rows):
+    writer = csv.writer(Echo())
+    headers = export.headers
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow([to_text(row[header]) for header in headers])
+
+
+def jsonl_lines(export, rows):
+    for row in rows:
+        yield json.dumps({key: to_text(value) for key, value in row.items()}) + '\n'
+
+
+def batched(lines, size=LINES_PER_WRITE):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def parse_filters(params):
+    """
+    Reads the dateFrom, dateTo and status filters of an export request.
+    Raises ValidationError when they are not valid.
+    """
+    status = params.get('status', 'true').lower()
+    if status not in STATUSES:
+        raise ValidationError("Invalid status %s" % status)
+    date_from = params.get('dateFrom')
+    date_to = params.get('dateTo')
+    return {
+        'date_from': parse_report_date(date_from) if date_from else None,
+        'date_to': parse_report_date(date_to, end_of_day=True) if date_to else None,
+        'status': STATUSES[status],
+    }
+
+
+def export_response(name, params):
+    """
+    Returns a StreamingHttpResponse with the whole export, in the format
+    given by the type param, csv by default.
+    """
+    export = EXPORTS[name]
+    format = params.get('type', 'csv')
+    if format not in FORMATS:
+        raise ValidationError("Invalid type %s" % format)
+    # Rows are streamed after the view returns, pin the database it chose
+    queryset = export.queryset(**parse_filters(params)).using(router.db_for_read(export.model))
+    writer = csv_lines if format == 'csv' else jsonl_lines
+    response = StreamingHttpResponse(
+        batched(writer(export, export.rows(queryset))), content_type=FORMATS[format])
+    response['Content-Disposition'] = 'attachment; filename="%s-%s.%s"' % (
+        name, timezone.localdate().isoformat(), format)
+    return response
+
+
+class ExportMixin:
+    """
+    Adds the export action, GET <collection>/export/, to a viewset.
+    """
+    export_name = None
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        try:
+            return export_response(self.export_name, request.query_params)
+        except ValidationError as error:
+            return Response({'message': error.message}, http_status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,130 @@
+"""
+Article images
+Once an article image is uploaded, a worker thread writes resized variants
+next to it, in the original format and in WebP, without the metadata of the
+original, so lists can load small thumbnails instead of the full photo.
+Once every variant is written the article records it in
+image_variants_of, so lists never ask the storage whether they exist.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .caching import invalidate_collections
+
+images_logger = logging.getLogger(__name__)
+
+# Longest side in pixels of every variant
+VARIANTS = {
+    'thumb': 160,
+    'medium': 640,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'IMAGE_PIPELINE_WORKERS', 2),
+                thread_name_prefix='images')
+        return _executor
+
+
+def variant_name(name, variant, webp=False):
+    stem, extension = os.path.splitext(name)
+    return '%s_%s%s' % (stem, variant, '.webp' if webp else extension)
+
+
+def variant_names(name):
+    """
+    Returns {key: storage name} of every variant of an image, where key is
+    the variant name, with a _webp suffix for the WebP ones.
+    """
+    names = {}
+    for variant in VARIANTS:
+        names[variant] = variant_name(name, variant)
+        names['%s_webp' % variant] = variant_name(name, variant, webp=True)
+    return names
+
+
+def save_image(image, name, format, **options):
+    content = io.BytesIO()
+    image.save(content, format, **options)
+    # Deleting a missing file does nothing, saving over one would rename it
+    default_storage.delete(name)
+    default_storage.save(name, ContentFile(content.getvalue()))
+
+
+def process_image(name):
+    """
+    Writes every variant of the stored image. Variants are re-encoded from
+    the pixels only, so EXIF and other metadata are dropped.
+    """
+    with default_storage.open(name) as file:
+        original = Image.open(file)
+        format = original.format or 'PNG'
+        original.load()
+    image = ImageOps.exif_transpose(original)
+    if format not in ('JPEG', 'PNG', 'GIF', 'WEBP'):
+        format = 'PNG'
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        if format == 'JPEG' and resized.mode != 'RGB':
+            resized = resized.convert('RGB')
+        save_image(resized, variant_name(name, variant), format, optimize=True)
+        if resized.mode not in ('RGB', 'RGBA'):
+            resized = resized.convert('RGBA')
+        save_image(resized, variant_name(name, variant, webp=True), 'WEBP', quality=80)
+    mark_processed(name)
+    images_logger.info("IMAGE VARIANTS CREATED FOR %s", name)
+
+
+def mark_processed(name):
+    from .models import Article
+    if Article.objects.filter(image=name).update(
+            image_variants_of=name, updated_at=timezone.now()):
+        invalidate_collections(Article)
+
+
+def _process_on_worker(name):
+    try:
+        process_image(name)
+    finally:
+        # The workers outlive requests, never keep a broken connection
+        for connection in connections.all():
+            connection.close_if_unusable_or_obsolete()
+
+
+def schedule(name):
+    future = get_executor().submit(_process_on_worker, name)
+    future.add_done_callback(lambda done: done.exception() and images_logger.error(
+        "ERROR WHILE PROCESSING IMAGE %s %s", name, done.exception()))
+    return future
+
+
+def process_uploaded_image(sender, instance, created=False, **kwargs):
+    name = instance.image.name if instance.image else None
+    if not name or name == instance._meta.get_field('image').default:
+        return
+    if created or instance.image_changed():
+        instance._loaded_image = name
+        transaction.on_commit(lambda: schedule(name))
+
+
+def connect_signals():
+    from .models import Article
+    post_save.connect(process_uploaded_image, sender=Article,
+                      dispatch_uid='images_process_article')
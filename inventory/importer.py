@@ -0,0 +1,330 @@
+"""
+Article import
+Loads a catalog of articles with their opening stock from a CSV or JSON
+lines stream. Rows are read lazily and written in chunks, so memory does
+not grow with the size of the file: every chunk is validated, then its
+articles are upserted by sku and their opening stock layers created or
+updated with executemany queries, inside one transaction per chunk.
+The opening stock of an article is its oldest layer. Once it was sold
+from, imports never change it again, the rows that would are reported.
+"""
+import csv
+import io
+import json
+import logging
+from itertools import islice
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import Exists, OuterRef, Subquery
+from django.utils import timezone
+from rest_framework import serializers
+from .models import Article, Stock, Sale
+from .serializers import ArticleImportSerializer
+from .search import update_index_many
+from .caching import totals_cache, invalidate_collections
+from . import sqlite
+
+importer_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+ARTICLE_FIELDS = ('name', 'location', 'suggested_price', 'link')
+
+
+def guess_format(filename):
+    """
+    Returns the import format from the extension of a file name.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower() if filename else ''
+    if extension in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(stream, format='csv'):
+    """
+    Yields (row number, row) from a text stream. Rows that can not be
+    parsed are yielded as an error string instead of a dict.
+    Empty values are left out, so they take the default of their field.
+    """
+    if format == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), start=2):
+            yield number, {key.strip(): value.strip() for key, value in row.items()
+                           if key and isinstance(value, str) and value.strip()}
+    elif format == 'jsonl':
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield number, 'Invalid JSON: %s' % error
+                continue
+            if not isinstance(row, dict):
+                yield number, 'Expected a JSON object.'
+                continue
+            yield number, {key: value for key, value in row.items()
+                           if value is not None and value != ''}
+    else:
+        raise ValueError('Unknown import format %s' % format)
+
+
+def text_stream(file, encoding='utf-8-sig'):
+    """
+    Wraps a binary file, such as an upload, to be read as text.
+    """
+    return io.TextIOWrapper(file, encoding=encoding, newline='')
+
+
+class ArticleImporter:
+    """
+    Upserts articles by sku from rows, chunk_size rows at a time.
+    Every row that can not be imported is passed to on_error as
+    {row, sku, errors}, by default they are kept in errors.
+    """
+
+    def __init__(self, user, chunk_size=CHUNK_SIZE, on_error=None):
+        self.user = user
+        self.chunk_size = chunk_size
+        self.errors = []
+        self.on_error = on_error or self.errors.append
+        self.created = 0
+        self.updated = 0
+        self.stock_created = 0
+        self.stock_updated = 0
+        self.stock_skipped = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    @property
+    def result(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'stock_created': self.stock_created,
+            'stock_updated': self.stock_updated,
+            'stock_skipped': self.stock_skipped,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+    def run(self, rows):
+        rows = iter(rows)
+        written = False
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            written |= self.import_chunk(chunk)
+        if written:
+            totals_cache.invalidate()
+            invalidate_collections(Article, Stock)
+        importer_logger.info(
+            "ARTICLES IMPORTED, %s CREATED, %s UPDATED, %s ERRORS",
+            self.created, self.updated, self.failed)
+        return self.result
+
+    def error(self, number, sku, errors):
+        self.failed += 1
+        self.on_error({'row': number, 'sku': sku, 'errors': errors})
+
+    def validate(self, chunk):
+        """
+        Returns the valid rows of a chunk as (number, data), reporting the
+        invalid ones, repeated skus and names owned by another sku.
+        """
+        # One serializer validates every row, building its fields once
+        serializer = ArticleImportSerializer()
+        valid = []
+        skus = {}
+        names = {}
+        for number, row in chunk:
+            if not isinstance(row, dict):
+                self.error(number, None, {'non_field_errors': [row]})
+                continue
+            try:
+                data = serializer.run_validation(row)
+            except serializers.ValidationError as error:
+                self.error(number, row.get('sku'), error.detail)
+                continue
+            if data['sku'] in skus:
+                self.error(number, data['sku'], {'sku': [
+                    'Repeated sku, already on row %s.' % skus[data['sku']]]})
+                continue
+            if data['name'] in names:
+                self.error(number, data['sku'], {'name': [
+                    'Repeated name, already on row %s.' % names[data['name']]]})
+                continue
+            skus[data['sku']] = number
+            names[data['name']] = number
+            valid.append((number, data))
+        owners = dict(Article.objects.filter(
+            name__in=list(names)).values_list('name', 'sku'))
+        rows = []
+        for number, data in valid:
+            owner = owners.get(data['name'], data['sku'])
+            if owner != data['sku']:
+                self.error(number, data['sku'], {'name': [
+                    'An article with this name already exists (%s).' % owner]})
+            else:
+                rows.append((number, data))
+        return rows
+
+    def import_chunk(self, chunk):
+        rows = self.validate(chunk)
+        if not rows:
+            return False
+        try:
+            with transaction.atomic():
+                skipped = self.write(rows)
+        except IntegrityError:
+            # A conflict between rows of the chunk, write them one by one
+            # to find the rows causing it
+            skipped = []
+            for number, data in rows:
+                try:
+                    with transaction.atomic():
+                        skipped += self.write([(number, data)])
+                except IntegrityError as error:
+                    self.error(number, data['sku'], {'non_field_errors': [str(error)]})
+        # Reported once the chunk is written, a rolled back write is retried
+        for number, sku in skipped:
+            self.stock_skipped += 1
+            self.on_error({'row': number, 'sku': sku, 'errors': {'quantity': [
+                'The opening stock was already sold from, it was not changed.']}})
+        return True
+
+    def write(self, rows):
+        """
+        Upserts the articles of the rows and their opening stock. Returns
+        the (number, sku) of the rows whose opening stock was left as is.
+        """
+        now = timezone.now()
+        existing = {article.sku: article for article in Article.objects.filter(
+            sku__in=[data['sku'] for _, data in rows]).only(
+                'id', 'sku', 'updated_at', 'updated_by', *ARTICLE_FIELDS)}
+        created, updated, new_stock = [], [], []
+        for _, data in rows:
+            article = existing.get(data['sku'])
+            if article is None:
+                article = Article(sku=data['sku'], created_by=self.user, updated_by=self.user)
+                for field in ARTICLE_FIELDS:
+                    if field in data:
+                        setattr(article, field, data[field])
+                if data.get('quantity'):
+                    article.stock_quantity = data['quantity']
+                    article.stock_value = data['quantity'] * data.get('cost', 0)
+                    new_stock.append((article, data))
+                created.append(article)
+            elif any(getattr(article, field) != data[field]
+                     for field in ARTICLE_FIELDS if field in data):
+                for field in ARTICLE_FIELDS:
+                    if field in data:
+                        setattr(article, field, data[field])
+                article.updated_by_id = self.user.pk
+                article.updated_at = now
+                updated.append(article)
+        insert_objects(Article, created)
+        sqlite.update_rows(Article, updated, ARTICLE_FIELDS + ('updated_at', 'updated_by'))
+        if created:
+            ids = dict(Article.objects.filter(
+                sku__in=[article.sku for article in created]).values_list('sku', 'id'))
+            for article in created:
+                article.pk = article.id = ids[article.sku]
+        skipped = self.write_opening_stock(rows, existing, new_stock, now)
+        update_index_many('article', created + updated)
+        self.created += len(created)
+        self.updated += len(updated)
+        self.unchanged += len(existing) - len(updated)
+        return skipped
+
+    def write_opening_stock(self, rows, existing, new_stock, now):
+        """
+        Creates the opening layer of the new articles, whose counters were
+        set on insert, and of the existing articles without layers. Updates
+        the one of the other existing articles, applying the difference to
+        their counters, unless it was sold from. Returns the (number, sku)
+        of the rows whose layer was sold from.
+        """
+        layers = [Stock(article=article, quantity=data['quantity'], cost=data.get('cost', 0),
+                        created_by=self.user, updated_by=self.user)
+                  for article, data in new_stock]
+        stocked = [(number, existing[data['sku']], data) for number, data in rows
+                   if data['sku'] in existing and ('quantity' in data or 'cost' in data)]
+        updated = []
+        deltas = []
+        skipped = []
+        if stocked:
+            oldest = Stock.objects.filter(
+                article=OuterRef('pk')).order_by('created_at', 'id')
+            opening_ids = Article.objects.filter(
+                pk__in=[article.pk for _, article, _ in stocked]).annotate(
+                    opening=Subquery(oldest.values('pk')[:1])).values_list('opening', flat=True)
+            opening = {stock.article_id: stock for stock in Stock.objects.filter(
+                pk__in=[pk for pk in opening_ids if pk is not None]).annotate(
+                    sold=Exists(Sale.objects.filter(stock=OuterRef('pk'))))}
+            for number, article, data in stocked:
+                stock = opening.get(article.pk)
+                if stock is None:
+                    if data.get('quantity'):
+                        layers.append(Stock(
+                            article=article, quantity=data['quantity'],
+                            cost=data.get('cost', 0), created_by=self.user, updated_by=self.user))
+                        deltas.append(layers[-1].counted_values())
+                    continue
+                quantity = data.get('quantity', stock.quantity)
+                cost = data.get('cost', stock.cost)
+                if (quantity, cost) == (stock.quantity, stock.cost):
+                    continue
+                if stock.sold:
+                    # Writing it would refill stock that was already sold
+                    skipped.append((number, article.sku))
+                    continue
+                previous = stock.counted_values()
+                stock.quantity = quantity
+                stock.cost = cost
+                stock.status = quantity > 0
+                stock.updated_by_id = self.user.pk
+                stock.updated_at = now
+                current = stock.counted_values()
+                deltas.append((article.pk, current[1] - previous[1], current[2] - previous[2]))
+                updated.append(stock)
+        insert_objects(Stock, layers)
+        sqlite.update_rows(Stock, updated, ('quantity', 'cost', 'status', 'updated_at', 'updated_by'))
+        add_to_stock_counters(deltas)
+        self.stock_created += len(layers)
+        self.stock_updated += len(updated)
+        return skipped
+
+
+def insert_objects(model, objs):
+    """
+    Inserts the objects with insert_rows, without setting their primary
+    keys, with the values their fields save on a creation.
+    """
+    fields = [field for field in model._meta.concrete_fields
+              if field is not model._meta.pk]
+    sqlite.insert_rows(model, [field.name for field in fields], [
+        [field.pre_save(obj, True) for field in fields] for obj in objs])
+
+
+def add_to_stock_counters(deltas):
+    """
+    Applies many (article_id, quantity, value) deltas to the article stock
+    counters, like Article.add_to_stock_counters, with one executemany.
+    """
+    deltas = [delta for delta in deltas if delta[1] or delta[2]]
+    if not deltas:
+        return
+    connection = connections[router.db_for_write(Article)]
+    value_field = Article._meta.get_field('stock_value')
+    quote = connection.ops.quote_name
+    quantity = quote(Article._meta.get_field('stock_quantity').column)
+    value = quote(value_field.column)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'UPDATE %s SET %s = %s + %%s, %s = %s + %%s WHERE %s = %%s' % (
+                quote(Article._meta.db_table), quantity, quantity, value, value,
+                quote(Article._meta.pk.column)),
+            [(quantity, value_field.get_db_prep_save(value, connection), article_id)
+             for article_id, quantity, value in deltas])
@@ -0,0 +1,82 @@
+import json
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from inventory import benchmark
+from inventory.models import Article, Stock, Sale
+
+commands_logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Seeds a synthetic dataset in the test database and reports the latency, "
+            "queries and memory of the main API endpoints as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=1000)
+        parser.add_argument('--layers', type=int, default=5000,
+                            help="Stock layers, spread over the articles.")
+        parser.add_argument('--sales', type=int, default=20000)
+        parser.add_argument('--days', type=int, default=365,
+                            help="Days the stock and sales are spread over.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--requests', type=int, default=50,
+                            help="Measured requests per scenario.")
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help="Only run this scenario, can be repeated.")
+        parser.add_argument('--serving', action='store_true',
+                            help="Also compare the sync WSGI worker with the ASGI handler "
+                                 "on the report endpoints and exports.")
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help="Clients served at once by the ASGI handler.")
+        parser.add_argument('--keepdb', action='store_true',
+                            help="Keep the seeded database, and reuse it when it has the same sizes.")
+        parser.add_argument('--output', help="File to write the report to, stdout by default.")
+        parser.add_argument('--baseline', help="Previous report to compare the results with.")
+
+    def handle(self, *args, **options):
+        scenarios = benchmark.SCENARIOS
+        if options['scenarios']:
+            scenarios = [s for s in scenarios if s.name in options['scenarios']]
+            unknown = set(options['scenarios']) - {s.name for s in scenarios}
+            if unknown:
+                raise CommandError("Unknown scenarios %s" % ', '.join(sorted(unknown)))
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+        dataset = {key: options[key] for key in ('articles', 'layers', 'sales', 'days', 'seed')}
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, keepdb=options['keepdb'], serialize=False)
+        try:
+            counts = (Article.objects.count(), Stock.objects.count(), Sale.objects.count())
+            seed_seconds = None
+            if counts != (options['articles'], options['layers'], options['sales']):
+                if any(counts):
+                    raise CommandError("The kept benchmark database has another dataset, "
+                                       "run once without --keepdb to drop it")
+                seed_seconds = benchmark.seed(
+                    options['articles'], options['layers'], options['sales'],
+                    days=options['days'], seed=options['seed'])
+                commands_logger.info("BENCHMARK DATASET SEEDED IN %.1fS", seed_seconds)
+            results = benchmark.run(options['requests'], scenarios)
+            serving = None
+            if options['serving']:
+                serving = benchmark.serving(options['requests'], options['concurrency'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+        if baseline:
+            benchmark.compare(results, baseline)
+        report = benchmark.report(dataset, seed_seconds, results)
+        if serving:
+            report['serving'] = serving
+        output = benchmark.dumps(report)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,55 @@
+import json
+import logging
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from inventory.importer import ArticleImporter, CHUNK_SIZE, FORMATS, guess_format, read_rows
+
+commands_logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Upserts by sku the articles of a CSV or JSON lines file, with their opening stock."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import.")
+        parser.add_argument(
+            '--user', required=True,
+            help="Username recorded as creator and editor of the rows.")
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help="Format of the file, guessed from its extension by default.")
+        parser.add_argument(
+            '--chunk-size', type=int, default=CHUNK_SIZE,
+            help="Rows validated and written together.")
+        parser.add_argument(
+            '--report',
+            help="File where the errors are written as JSON lines, stdout by default.")
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError("User %s does not exist" % options['user'])
+        format = options['format'] or guess_format(options['path'])
+        report = open(options['report'], 'w') if options['report'] else self.stdout
+
+        def write_error(error):
+            report.write(json.dumps(error) + '\n')
+
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as file:
+                result = ArticleImporter(
+                    user, chunk_size=options['chunk_size'], on_error=write_error
+                ).run(read_rows(file, format))
+        finally:
+            if report is not self.stdout:
+                report.close()
+        commands_logger.info("ARTICLES IMPORTED FROM %s", options['path'])
+        self.stdout.write(
+            "%(created)s articles created, %(updated)s updated, "
+            "%(stock_created)s stock layers created, %(stock_updated)s updated." % result)
+        if result['stock_skipped']:
+            self.stdout.write(
+                "%(stock_skipped)s opening stock layers already sold from were not changed." % result)
+        if result['failed']:
+            self.stdout.write("%(failed)s rows with errors." % result)
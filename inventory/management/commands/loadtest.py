@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from inventory import benchmark
+
+
+class Command(BaseCommand):
+    help = ("Seeds the test database and runs reader and writer processes against "
+            "the API at the same time, reporting their latency as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--articles', type=int, default=200)
+        parser.add_argument(
+            '--journal-mode', default=None,
+            help="SQLite journal mode to test, SQLITE_JOURNAL_MODE by default. "
+                 "Compare WAL with DELETE.")
+        parser.add_argument(
+            '--writer-queue', action='store_true',
+            help="Write the sales of every process through its writer thread.")
+
+    def handle(self, *args, **options):
+        if options['journal_mode']:
+            settings.SQLITE_JOURNAL_MODE = options['journal_mode']
+        settings.SQLITE_WRITER_QUEUE = options['writer_queue']
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, serialize=False)
+        try:
+            articles = options['articles']
+            benchmark.seed(articles, articles * 5, articles * 10, days=30)
+            report = benchmark.load_test(options['readers'], options['writers'], options['seconds'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        report['writer_queue'] = options['writer_queue']
+        self.stdout.write(benchmark.dumps(report))
@@ -0,0 +1,28 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from inventory.models import DailySalesRollup
+
+commands_logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Backfills or rebuilds the daily sales rollup from the sales."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from',
+                            help="First day to rebuild, YYYY-MM-DD.")
+        parser.add_argument('--to', dest='date_to',
+                            help="Last day to rebuild, YYYY-MM-DD.")
+
+    def handle(self, *args, **options):
+        dates = []
+        for option in ('date_from', 'date_to'):
+            value = options[option]
+            date = parse_date(value) if value else None
+            if value and date is None:
+                raise CommandError("Invalid date %s" % value)
+            dates.append(date)
+        written = DailySalesRollup.rebuild(*dates)
+        commands_logger.info("SALES ROLLUP REBUILT, %s ROWS", written)
+        self.stdout.write("%s rollup rows written." % written)
@@ -0,0 +1,16 @@
+import logging
+from django.core.management.base import BaseCommand
+from inventory.search import INDEXES, get_backend
+
+commands_logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the search index of articles and orders from their tables."
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        for index in INDEXES.values():
+            backend.rebuild(index)
+            commands_logger.info("SEARCH INDEX %s REBUILT", index.name)
+            self.stdout.write("Search index %s rebuilt." % index.name)
@@ -0,0 +1,31 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from inventory.models import Article
+from inventory.caching import totals_cache, collection_cache
+
+commands_logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the denormalized stock counters of every article from its stock layers."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="Only report the articles whose counters are out of sync.")
+
+    def handle(self, *args, **options):
+        verify = options['verify']
+        mismatches = Article.rebuild_stock_counters(commit=not verify)
+        for article_id, stored, expected in mismatches:
+            self.stdout.write("Article %s: stored %s/%s, expected %s/%s" % (
+                article_id, stored[0], stored[1], expected[0], expected[1]))
+        if verify and mismatches:
+            raise CommandError(
+                "%s articles have out of sync stock counters" % len(mismatches))
+        if mismatches:
+            totals_cache.bump()
+            collection_cache(Article).bump()
+        commands_logger.info("STOCK COUNTERS REBUILT, %s FIXED", len(mismatches))
+        self.stdout.write("%s articles %s." % (
+            len(mismatches), 'out of sync' if verify else 'fixed'))
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:01
+
+from django.db import migrations, models
+from django.db.models import F, Sum, DecimalField
+
+
+def fill_stock_counters(apps, schema_editor):
+    Article = apps.get_model('inventory', 'Article')
+    Stock = apps.get_model('inventory', 'Stock')
+    rows = Stock.objects.filter(status=True).values('article').annotate(
+        quantity_total=Sum('quantity'),
+        value_total=Sum(F('quantity') * F('cost'), output_field=DecimalField()))
+    for row in rows:
+        Article.objects.filter(pk=row['article']).update(
+            stock_quantity=row['quantity_total'] or 0,
+            stock_value=row['value_total'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_auto_20200425_1343'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='stock_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='stock_value',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.RunPython(fill_stock_counters, migrations.RunPython.noop),
+    ]
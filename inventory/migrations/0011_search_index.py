@@ -0,0 +1,37 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:05
+
+from django.db import migrations
+
+SEARCH_TABLES = {
+    'inventory_search_article': ('inventory_article', ('name', 'sku', 'location')),
+    'inventory_search_order': ('inventory_order', ('body', 'state')),
+}
+
+
+def create_search_tables(apps, schema_editor):
+    # Other databases use the icontains search backend, without tables
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table, (source, fields) in SEARCH_TABLES.items():
+        schema_editor.execute('CREATE VIRTUAL TABLE %s USING fts5(%s)' % (
+            table, ', '.join(fields)))
+        schema_editor.execute('INSERT INTO %s (rowid, %s) SELECT id, %s FROM %s' % (
+            table, ', '.join(fields), ', '.join(fields), source))
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table in SEARCH_TABLES:
+        schema_editor.execute('DROP TABLE %s' % table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0010_auto_20261017_1801'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:08
+
+from django.db import migrations, models
+from django.db.models import F, Sum, DecimalField
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def fill_sales_rollup(apps, schema_editor):
+    Sale = apps.get_model('inventory', 'Sale')
+    DailySalesRollup = apps.get_model('inventory', 'DailySalesRollup')
+    totals = Sale.objects.filter(status=True).annotate(
+        day=TruncDate('created_at')).order_by().values('day', 'stock__article').annotate(
+        quantity_total=Sum('quantity'),
+        revenue_total=Sum(F('quantity') * F('price'), output_field=DecimalField()),
+        cost_total=Sum(F('quantity') * F('stock__cost'), output_field=DecimalField()))
+    DailySalesRollup.objects.bulk_create([
+        DailySalesRollup(date=row['day'], article_id=row['stock__article'],
+                         quantity=row['quantity_total'] or 0,
+                         revenue=round(row['revenue_total'] or 0, 2),
+                         cost=round(row['cost_total'] or 0, 2))
+        for row in totals.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0011_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('article', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollup_article', to='inventory.Article')),
+            ],
+            options={
+                'unique_together': {('date', 'article')},
+            },
+        ),
+        migrations.RunPython(fill_sales_rollup, migrations.RunPython.noop),
+    ]
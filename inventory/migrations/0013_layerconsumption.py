@@ -0,0 +1,48 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:25
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_layer_consumption(apps, schema_editor):
+    Sale = apps.get_model('inventory', 'Sale')
+    LayerConsumption = apps.get_model('inventory', 'LayerConsumption')
+    sales = Sale.objects.filter(stock__isnull=False).values_list(
+        'id', 'stock', 'stock__article', 'stock__cost', 'quantity', 'created_at')
+    batch = []
+    for sale_id, stock_id, article_id, unit_cost, quantity, created_at in sales.iterator():
+        batch.append(LayerConsumption(
+            stock_id=stock_id, article_id=article_id, sale_id=sale_id,
+            quantity=quantity, unit_cost=unit_cost,
+            cost=(quantity * Decimal(str(unit_cost))).quantize(Decimal('0.01')),
+            created_at=created_at))
+        if len(batch) >= 500:
+            LayerConsumption.objects.bulk_create(batch)
+            batch = []
+    LayerConsumption.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0012_dailysalesrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerConsumption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('unit_cost', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='consumption_article', to='inventory.Article')),
+                ('sale', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='consumption_sale', to='inventory.Sale')),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='consumption_stock', to='inventory.Stock')),
+            ],
+        ),
+        migrations.RunPython(fill_layer_consumption, migrations.RunPython.noop),
+    ]
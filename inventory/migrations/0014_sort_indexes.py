@@ -0,0 +1,79 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:27
+
+from django.db import migrations, models
+
+
+# auth.User belongs to another app, its list indexes are created here
+USER_INDEXES = {
+    'user_active_joined_idx': 'is_active, date_joined, id',
+    'user_active_username_idx': 'is_active, username, id',
+    'user_active_email_idx': 'is_active, email, id',
+}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0013_layerconsumption'),
+        ('auth', '0011_update_proxy_permissions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='article_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'updated_at', 'id'], name='article_status_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'name', 'id'], name='article_status_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'sku', 'id'], name='article_status_sku_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'location', 'id'], name='article_status_location_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'suggested_price', 'id'], name='article_status_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'updated_at', 'id'], name='order_status_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'state', 'id'], name='order_status_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='sale_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['status', 'quantity', 'id'], name='sale_status_quantity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['status', 'price', 'id'], name='sale_status_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['article', 'created_at'], name='stock_article_created_idx'),
+        ),
+    ] + [
+        migrations.RunSQL(
+            'CREATE INDEX %s ON auth_user (%s)' % (name, columns),
+            'DROP INDEX %s' % name)
+        for name, columns in USER_INDEXES.items()
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:48
+
+from django.db import migrations
+import inventory.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0014_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='article',
+            name='image',
+            field=inventory.models.HashedImageField(default='default.png', upload_to='images'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+SEARCH_TABLES = {
+    'inventory_search_article': 'inventory_article',
+    'inventory_search_order': 'inventory_order',
+}
+
+
+def remove_inactive_rows(apps, schema_editor):
+    # Only the active rows are indexed now
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table, source in SEARCH_TABLES.items():
+        schema_editor.execute(
+            'DELETE FROM %s WHERE rowid IN (SELECT id FROM %s WHERE NOT status)' % (table, source))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0015_hashed_images'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_inactive_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.5 on 2026-10-17 18:57
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+def mark_processed_images(apps, schema_editor):
+    # Looks at the storage once, for the images processed before the field
+    from inventory.images import variant_names
+    Article = apps.get_model('inventory', 'Article')
+    for article in Article.objects.exclude(image='default.png').exclude(image='').only('id', 'image'):
+        names = variant_names(article.image.name)
+        if all(default_storage.exists(name) for name in names.values()):
+            Article.objects.filter(pk=article.pk).update(image_variants_of=article.image.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0017_updated_at_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='image_variants_of',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.RunPython(mark_processed_images, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,36 @@
+import hashlib
 import logging
-from django.db import models
+import os
+from decimal import Decimal
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum, DecimalField
+from django.db.models.functions import TruncDate
+from django.utils import timezone
 
 models_logger = logging.getLogger(__name__)
 
+CENTS = Decimal('0.01')
+
+
+class HashedImageFieldFile(models.fields.files.ImageFieldFile):
+
+    def save(self, name, content, save=True):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        stem, extension = os.path.splitext(name)
+        super().save('%s.%s%s' % (stem, digest.hexdigest()[:12], extension.lower()), content, save)
+
+
+class HashedImageField(models.ImageField):
+    """
+    Stores images under a name with a hash of their content,
+    images/photo.3fb070cc1a2b.jpg, so their URLs change with the image and
+    can be cached forever.
+    """
+    attr_class = HashedImageFieldFile
+
 
 class Article(models.Model):
     """
@@ -15,8 +43,14 @@ class Article(models.Model):
     suggested_price = models.DecimalField(
         max_digits=15, decimal_places=2, default=0)
     status = models.BooleanField(default=True)
-    image = models.ImageField(upload_to='images', default='default.png')
+    image = HashedImageField(upload_to='images', default='default.png')
+    # Image whose resized variants the image pipeline finished writing
+    image_variants_of = models.CharField(max_length=100, default="", blank=True)
     link = models.CharField(max_length=200, default="")
+    # Denormalized totals of the active stock, kept in sync by Stock.save
+    stock_quantity = models.IntegerField(default=0)
+    stock_value = models.DecimalField(
+        max_digits=15, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(
@@ -24,9 +58,75 @@ class Article(models.Model):
     updated_by = models.ForeignKey(
         'auth.User', related_name='article_editor', on_delete=models.CASCADE)
 
+    class Meta:
+        # One per sortable field of the list, which filters by status
+        indexes = [
+            models.Index(fields=['status', 'created_at', 'id'], name='article_status_created_idx'),
+            models.Index(fields=['status', 'updated_at', 'id'], name='article_status_updated_idx'),
+            models.Index(fields=['status', 'name', 'id'], name='article_status_name_idx'),
+            models.Index(fields=['status', 'sku', 'id'], name='article_status_sku_idx'),
+            models.Index(fields=['status', 'location', 'id'], name='article_status_location_idx'),
+            models.Index(fields=['status', 'suggested_price', 'id'], name='article_status_price_idx'),
+            # Latest change, for the collection stamps
+            models.Index(fields=['updated_at'], name='article_updated_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'status' in field_names:
+            instance._loaded_status = instance.status
+        if 'image' in field_names:
+            instance._loaded_image = instance.image.name
+        return instance
+
+    def status_changed(self):
+        return getattr(self, '_loaded_status', None) != self.status
+
+    def image_changed(self):
+        return getattr(self, '_loaded_image', None) != self.image.name
+
+    @classmethod
+    def add_to_stock_counters(cls, article_id, quantity, value):
+        """
+        Applies a quantity and value delta to the article counters in the
+        database, without reading them first.
+        """
+        if quantity or value:
+            cls.objects.filter(pk=article_id).update(
+                stock_quantity=F('stock_quantity') + quantity,
+                stock_value=F('stock_value') + value)
+
+    @classmethod
+    def rebuild_stock_counters(cls, queryset=None, commit=True):
+        """
+        Recomputes the stock counters of the given articles (all of them by
+        default) from their stock layers. Returns the list of
+        (article_id, stored, expected) tuples that were out of sync, and
+        only writes the fixes when commit is True.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        expected = Stock.counters_by_article(
+            Stock.objects.filter(article__in=queryset.values('id')))
+        mismatches = []
+        with transaction.atomic():
+            articles = queryset.only('id', 'stock_quantity', 'stock_value')
+            for article in articles.iterator():
+                quantity, value = expected.get(article.id, (0, 0))
+                stored = (article.stock_quantity, article.stock_value)
+                if stored[0] != quantity or stored[1] != value:
+                    mismatches.append((article.id, stored, (quantity, value)))
+            if commit and mismatches:
+                cls.objects.bulk_update(
+                    [cls(id=article_id, stock_quantity=values[0], stock_value=values[1])
+                     for article_id, _, values in mismatches],
+                    ['stock_quantity', 'stock_value'], batch_size=500)
+        return mismatches
+
 
 class Stock(models.Model):
     """
@@ -45,9 +145,89 @@ class Stock(models.Model):
     updated_by = models.ForeignKey(
         'auth.User', related_name='stock_editor', on_delete=models.CASCADE)
 
+    class Meta:
+        # Oldest layer of an article, for the cost column of the article list
+        indexes = [
+            models.Index(fields=['article', 'created_at'], name='stock_article_created_idx'),
+            models.Index(fields=['updated_at'], name='stock_updated_idx'),
+        ]
+
     def __str__(self):
         return "%s - %s" % (str(self.updated_at), self.article.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(f in field_names for f in ('article_id', 'quantity', 'cost', 'status')):
+            instance._counted = instance.counted_values()
+            instance._costed = instance.costed_values()
+        return instance
+
+    def costed_values(self):
+        """
+        Returns the article and unit cost of the sales of this layer in the
+        daily sales rollup.
+        """
+        return (self.article_id, Decimal(str(self.cost)))
+
+    def counted_values(self):
+        """
+        Returns the article, quantity and value this layer adds to the
+        article stock counters. Inactive layers do not count.
+        """
+        if not self.status:
+            return (self.article_id, 0, Decimal(0))
+        quantity = int(self.quantity)
+        return (self.article_id, quantity, quantity * Decimal(str(self.cost)))
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        previous = getattr(self, '_counted', None)
+        costed = getattr(self, '_costed', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not adding and costed != self.costed_values():
+                # The rollup counts the sales at the current cost of their
+                # layer, like the reports on the sales themselves
+                DailySalesRollup.restate_layer(self, costed)
+            self._costed = self.costed_values()
+            current = self.counted_values()
+            if previous is None and not adding:
+                # Loaded without the counted fields, recount the article
+                Article.rebuild_stock_counters(
+                    Article.objects.filter(pk=self.article_id))
+            else:
+                if previous is None or previous[0] != current[0]:
+                    if previous is not None:
+                        Article.add_to_stock_counters(
+                            previous[0], -previous[1], -previous[2])
+                    previous = (current[0], 0, 0)
+                Article.add_to_stock_counters(
+                    current[0], current[1] - previous[1], current[2] - previous[2])
+            self._counted = current
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            article_id, quantity, value = self.counted_values()
+            result = super().delete(*args, **kwargs)
+            Article.add_to_stock_counters(article_id, -quantity, -value)
+        return result
+
+    @classmethod
+    def counters_by_article(cls, queryset=None):
+        """
+        Returns {article_id: (quantity, value)} computed from the active
+        stock layers in one grouped query.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        rows = queryset.filter(status=True).order_by().values('article').annotate(
+            quantity_total=Sum('quantity'),
+            value_total=Sum(F('quantity') * F('cost'), output_field=DecimalField()))
+        return {row['article']: (row['quantity_total'] or 0,
+                                 Decimal(row['value_total'] or 0).quantize(CENTS))
+                for row in rows}
+
 
 class Sale(models.Model):
     """
@@ -66,6 +246,241 @@ class Sale(models.Model):
     updated_by = models.ForeignKey(
         'auth.User', related_name='sale_editor', on_delete=models.CASCADE)
 
+    class Meta:
+        # One per sortable field of the list, which filters by status
+        indexes = [
+            models.Index(fields=['status', 'created_at', 'id'], name='sale_status_created_idx'),
+            models.Index(fields=['status', 'quantity', 'id'], name='sale_status_quantity_idx'),
+            models.Index(fields=['status', 'price', 'id'], name='sale_status_price_idx'),
+            models.Index(fields=['updated_at'], name='sale_updated_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(f in field_names for f in ('stock_id', 'quantity', 'price', 'status', 'created_at')):
+            instance._rolled = instance.rollup_fields()
+        return instance
+
+    def rollup_fields(self):
+        return (self.stock_id, self.quantity, self.price, self.status, self.created_at)
+
+    def rollup_deltas(self, fields, sign=1):
+        """
+        Returns what a sale with the given rollup fields adds to the daily
+        rollup, as {(date, article_id): (quantity, revenue, cost)}.
+        """
+        stock_id, quantity, price, status, created_at = fields
+        if not status:
+            return {}
+        if stock_id == self.stock_id:
+            stock = self.stock
+        else:
+            stock = Stock.objects.filter(pk=stock_id).first()
+        quantity = sign * int(quantity)
+        cost = Decimal(str(stock.cost)) if stock else Decimal(0)
+        key = (timezone.localtime(created_at).date(),
+               stock.article_id if stock else None)
+        return {key: (quantity, quantity * Decimal(str(price)), quantity * cost)}
+
+    @classmethod
+    def add_to_rollup(cls, sales):
+        """
+        Adds sales that were created without save(), like in bulk_create, to
+        the daily rollup.
+        """
+        deltas = {}
+        for sale in sales:
+            sale._rolled = sale.rollup_fields()
+            merge_rollup_deltas(deltas, sale.rollup_deltas(sale._rolled))
+        DailySalesRollup.add(deltas)
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        previous = getattr(self, '_rolled', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            current = self.rollup_fields()
+            if previous is None and not adding:
+                # Loaded without the rollup fields, recount the whole day
+                day = timezone.localtime(self.created_at).date()
+                DailySalesRollup.rebuild(day, day)
+            elif previous != current:
+                deltas = self.rollup_deltas(current)
+                if previous is not None:
+                    merge_rollup_deltas(
+                        deltas, self.rollup_deltas(previous, sign=-1))
+                DailySalesRollup.add(deltas)
+            self._rolled = current
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deltas = self.rollup_deltas(self.rollup_fields(), sign=-1)
+            result = super().delete(*args, **kwargs)
+            DailySalesRollup.add(deltas)
+        return result
+
+
+def merge_rollup_deltas(deltas, other):
+    for key, values in other.items():
+        previous = deltas.get(key, (0, 0, 0))
+        deltas[key] = tuple(a + b for a, b in zip(previous, values))
+    return deltas
+
+
+class DailySalesRollup(models.Model):
+    """
+    DailySalesRollup model
+    Quantity, revenue and cost of the active sales of every article, per
+    day, at the current cost of their stock layers. Kept up to date by
+    Sale.save, Stock.save and allocation, and rebuilt by the
+    rebuild_sales_rollup command.
+    """
+    date = models.DateField()
+    article = models.ForeignKey(
+        Article, related_name='rollup_article', on_delete=models.CASCADE, null=True)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    cost = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('date', 'article')
+
+    def __str__(self):
+        return "%s - %s" % (self.date, self.article_id)
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Applies {(date, article_id): (quantity, revenue, cost)} deltas,
+        creating the missing rows, in a fixed number of queries.
+        """
+        deltas = {key: values for key, values in deltas.items() if any(values)}
+        if not deltas:
+            return
+        articles = {article_id for _, article_id in deltas}
+        same_articles = Q(article__in=articles - {None})
+        if None in articles:
+            same_articles |= Q(article__isnull=True)
+        existing = {(row.date, row.article_id): row for row in cls.objects.filter(
+            same_articles, date__in={date for date, _ in deltas})}
+        updated = []
+        missing = []
+        for key, (quantity, revenue, cost) in deltas.items():
+            row = existing.get(key)
+            if row is None:
+                missing.append(cls(date=key[0], article_id=key[1], quantity=quantity,
+                                   revenue=revenue, cost=cost))
+                continue
+            row.quantity = F('quantity') + quantity
+            row.revenue = F('revenue') + revenue
+            row.cost = F('cost') + cost
+            updated.append(row)
+        if updated:
+            cls.objects.bulk_update(updated, ['quantity', 'revenue', 'cost'])
+        if missing:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError:
+                # Some were created by a concurrent sale, add them one by one
+                for row in missing:
+                    cls._add_one(row)
+
+    @classmethod
+    def _add_one(cls, row):
+        rows = cls.objects.filter(date=row.date, article_id=row.article_id)
+        changes = {'quantity': F('quantity') + row.quantity,
+                   'revenue': F('revenue') + row.revenue, 'cost': F('cost') + row.cost}
+        if not rows.update(**changes):
+            row.save()
+
+    @classmethod
+    def restate_layer(cls, stock, previous):
+        """
+        Moves the cost of the active sales of a stock layer from its
+        previous (article_id, cost) to its current ones, or recounts their
+        days when the previous ones are not known or the article changed.
+        """
+        days = Sale.objects.filter(stock=stock, status=True).annotate(
+            day=TruncDate('created_at')).order_by().values('day').annotate(
+            quantity_total=Sum('quantity'))
+        if previous is None or previous[0] != stock.article_id:
+            days = [row['day'] for row in days]
+            if days:
+                cls.rebuild(min(days), max(days))
+            return
+        article_id, cost = stock.costed_values()
+        cls.add({(row['day'], article_id): (0, 0, row['quantity_total'] * (cost - previous[1]))
+                 for row in days})
+
+    @classmethod
+    def rebuild(cls, date_from=None, date_to=None):
+        """
+        Recomputes the rollup rows between two dates (every day by default)
+        from the sales, and returns how many rows were written.
+        """
+        rows = cls.objects.all()
+        sales = Sale.objects.filter(status=True)
+        if date_from is not None:
+            rows = rows.filter(date__gte=date_from)
+            sales = sales.filter(created_at__date__gte=date_from)
+        if date_to is not None:
+            rows = rows.filter(date__lte=date_to)
+            sales = sales.filter(created_at__date__lte=date_to)
+        totals = sales.annotate(day=TruncDate('created_at')).order_by().values(
+            'day', 'stock__article').annotate(
+            quantity_total=Sum('quantity'),
+            revenue_total=Sum(F('quantity') * F('price'), output_field=DecimalField()),
+            cost_total=Sum(F('quantity') * F('stock__cost'), output_field=DecimalField()))
+        with transaction.atomic():
+            rows.delete()
+            created = cls.objects.bulk_create([
+                cls(date=row['day'], article_id=row['stock__article'],
+                    quantity=row['quantity_total'] or 0,
+                    revenue=Decimal(row['revenue_total'] or 0).quantize(CENTS),
+                    cost=Decimal(row['cost_total'] or 0).quantize(CENTS))
+                for row in totals.iterator()
+            ], batch_size=500)
+        return len(created)
+
+
+class LayerConsumption(models.Model):
+    """
+    LayerConsumption model
+    Quantity taken from a stock layer by a sale, with the unit cost of the
+    layer at that moment. Written by the allocation engine, so the cost of
+    goods sold and the value of the inventory on any date are sums over
+    these rows instead of a replay of the sales.
+    """
+    stock = models.ForeignKey(
+        Stock, related_name='consumption_stock', on_delete=models.CASCADE)
+    article = models.ForeignKey(
+        Article, related_name='consumption_article', on_delete=models.CASCADE)
+    sale = models.ForeignKey(
+        Sale, related_name='consumption_sale', on_delete=models.SET_NULL, null=True)
+    quantity = models.IntegerField(default=0)
+    unit_cost = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    cost = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return "%s - %s x %s" % (self.created_at, self.stock_id, self.quantity)
+
+    @classmethod
+    def record(cls, sales):
+        """
+        Writes the consumption of sales that have just taken their quantity
+        from their stock layer, in one query.
+        """
+        cls.objects.bulk_create([
+            cls(stock_id=sale.stock_id, article_id=sale.stock.article_id, sale_id=sale.pk,
+                quantity=sale.quantity, unit_cost=sale.stock.cost,
+                cost=(sale.quantity * Decimal(str(sale.stock.cost))).quantize(CENTS),
+                created_at=sale.created_at)
+            for sale in sales if sale.stock_id is not None
+        ], batch_size=500)
+
 
 class Order(models.Model):
     """
@@ -101,5 +516,14 @@ class Order(models.Model):
     updated_by = models.ForeignKey(
         'auth.User', related_name='order_editor', on_delete=models.CASCADE)
 
+    class Meta:
+        # One per sortable field of the list, which filters by status
+        indexes = [
+            models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+            models.Index(fields=['status', 'updated_at', 'id'], name='order_status_updated_idx'),
+            models.Index(fields=['status', 'state', 'id'], name='order_status_state_idx'),
+            models.Index(fields=['updated_at'], name='order_updated_idx'),
+        ]
+
     def __str__(self):
         return "%s - %s" % (self.article.name, self.status)
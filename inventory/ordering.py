@@ -0,0 +1,42 @@
+from rest_framework.exceptions import ValidationError
+
+
+class SortableMixin:
+    """
+    Sorts the list of a viewset by one of its sortable_fields, a dict of
+    the keys accepted in the order param to the field they sort by. Every
+    field is backed by an index that starts with the status filter of the
+    list, so a sorted page is a range scan of that index.
+    The order is descending when the key starts with - or the type param
+    is -. Unknown keys are rejected with a 400 before any query runs, in
+    the sorted_actions only, the others ignore the params. Exports are
+    always streamed by id and are not sorted.
+    """
+    sortable_fields = {}
+    default_sort = 'created_at'
+    sort_query_param = 'order'
+    direction_query_param = 'type'
+    sorted_actions = ('list',)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.sort = self.get_sort(request)
+
+    def is_sorted_action(self):
+        return getattr(self, 'action', None) in self.sorted_actions
+
+    def has_sort(self):
+        return self.is_sorted_action() and self.sort_query_param in self.request.query_params
+
+    def get_sort(self, request):
+        if not self.is_sorted_action():
+            return self.sortable_fields[self.default_sort]
+        key = request.query_params.get(self.sort_query_param) or self.default_sort
+        descending = key.startswith('-') or \
+            request.query_params.get(self.direction_query_param) == '-'
+        key = key.lstrip('-')
+        if key not in self.sortable_fields:
+            raise ValidationError({self.sort_query_param: [
+                'Invalid order %s, expected one of %s.' % (
+                    key, ', '.join(sorted(self.sortable_fields)))]})
+        return '%s%s' % ('-' if descending else '', self.sortable_fields[key])
@@ -0,0 +1,131 @@
+import base64
+import datetime
+import decimal
+import json
+from collections import OrderedDict
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page number pagination, switched to keyset pagination when the request
+    has a cursor parameter (empty for the first page).
+    Keyset pages continue from the ordering value and id of the last row
+    seen, so a late page costs the same as the first one. The ordering comes
+    from the queryset, with the id as tie-breaker. NULL values, like the
+    article name of a sale without stock, sort before every other value on
+    every backend. Passing total=1 adds a count capped at total_limit rows.
+    """
+    cursor_query_param = 'cursor'
+    total_query_param = 'total'
+    total_limit = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        field, descending = self.get_ordering(queryset)
+
+        self.total = None
+        if request.query_params.get(self.total_query_param):
+            self.total = queryset.order_by()[:self.total_limit + 1].count()
+
+        queryset = queryset.annotate(keyset_value=F(field))
+        reverse = bool(cursor and cursor['r'])
+        # Previous pages are read backwards from the cursor, then flipped
+        backwards = descending != reverse
+        if cursor:
+            queryset = queryset.filter(
+                self.get_keyset_filter(cursor, backwards))
+        if backwards:
+            queryset = queryset.order_by(F('keyset_value').desc(nulls_last=True), '-pk')
+        else:
+            queryset = queryset.order_by(F('keyset_value').asc(nulls_first=True), 'pk')
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = cursor is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.rows = rows
+        return rows
+
+    def get_ordering(self, queryset):
+        ordering = [field for field in queryset.query.order_by
+                    if field.lstrip('-') not in ('pk', 'id')]
+        if not ordering:
+            ordering = list(queryset.model._meta.ordering) or ['pk']
+        field = ordering[0]
+        return field.lstrip('-'), field.startswith('-')
+
+    def get_keyset_filter(self, cursor, descending):
+        lookup = 'lt' if descending else 'gt'
+        same_value = Q(**{'pk__%s' % lookup: cursor['id']})
+        if cursor['v'] is None:
+            same_value &= Q(keyset_value__isnull=True)
+            # NULL is the smallest value
+            return same_value if descending else same_value | Q(keyset_value__isnull=False)
+        same_value &= Q(keyset_value=cursor['v'])
+        keyset_filter = Q(**{'keyset_value__%s' % lookup: cursor['v']}) | same_value
+        if descending:
+            keyset_filter |= Q(keyset_value__isnull=True)
+        return keyset_filter
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            return {'v': cursor['v'], 'id': int(cursor['id']), 'r': bool(cursor['r'])}
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        value = row.keyset_value
+        if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            value = value.isoformat()
+        elif isinstance(value, decimal.Decimal):
+            value = str(value)
+        cursor = json.dumps({'v': value, 'id': row.pk, 'r': int(reverse)})
+        encoded = base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+        url = remove_query_param(self.base_url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next or not self.rows:
+            return None
+        return self.encode_cursor(self.rows[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        if not self.has_previous or not self.rows:
+            return None
+        return self.encode_cursor(self.rows[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ])
+        if self.total is not None:
+            response['total'] = min(self.total, self.total_limit)
+            response['total_is_exact'] = self.total <= self.total_limit
+        return Response(response)
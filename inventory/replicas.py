@@ -0,0 +1,87 @@
+"""
+Read replicas
+Writes always go to the primary database. Reads go to one of the
+DATABASE_REPLICAS, at random, only inside the views and actions that
+declare them safe in replica_reads, and only outside a transaction.
+A user that wrote something is pinned to the primary for
+REPLICA_PIN_SECONDS, so they read their own writes while the replicas
+catch up. Pins are kept in the default cache, shared by the workers when
+the cache is.
+"""
+import random
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def reading_from_replica():
+    return getattr(_state, 'replica', False)
+
+
+def mark_written():
+    """
+    Records a write of the current request done by another thread.
+    """
+    _state.wrote = True
+
+
+def pin_key(user):
+    return 'inventory:replica-pin:%s' % user.pk
+
+
+def pin(user):
+    cache.set(pin_key(user), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(pin_key(user)) is not None
+
+
+class ReplicaRouter:
+    """
+    Routes the reads of the current request to a replica when the view
+    allowed it, and records that the request wrote something.
+    """
+
+    def db_for_read(self, model, **hints):
+        if reading_from_replica() and replicas() and \
+                not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return random.choice(replicas())
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+class ReplicaReadMixin:
+    """
+    Reads from a replica in the actions of a viewset, or the methods of an
+    APIView, listed in replica_reads, unless the user is pinned to the
+    primary. Any write pins the user.
+    """
+    replica_reads = ()
+
+    def initial(self, request, *args, **kwargs):
+        _state.wrote = False
+        super().initial(request, *args, **kwargs)
+        name = getattr(self, 'action', None) or request.method.lower()
+        _state.replica = name in self.replica_reads and not is_pinned(request.user)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        _state.replica = False
+        if getattr(_state, 'wrote', False) and request.user.is_authenticated:
+            pin(request.user)
+        _state.wrote = False
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,148 @@
+"""
+Reports
+Sales reports computed by the database, grouped in time buckets, so the
+payload depends on the number of buckets and not on the number of sales.
+Whole-day ranges are read from the daily sales rollup, so their cost
+depends on the number of days instead.
+"""
+import datetime
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db.models import F, Sum, DecimalField, DateField
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import Sale, DailySalesRollup, CENTS
+
+# Bucket kind of every dateType, and the format of its labels
+BUCKETS = {
+    'day': '%d/%b/%Y',
+    'week': '%d/%b/%Y',
+    'month': '%b/%Y',
+    'year': '%Y',
+}
+
+
+def parse_report_date(value, end_of_day=False):
+    """
+    Parses the date or datetime strings sent by the dashboard. A plain date
+    stands for the start of that day, or its end when end_of_day is set.
+    """
+    parsed = None
+    if isinstance(value, str):
+        try:
+            parsed = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            # Well formed but out of range, like 2026-13-01
+            raise ValidationError("Invalid date %s" % value)
+    if parsed is None:
+        raise ValidationError("Invalid date %s" % value)
+    if not isinstance(parsed, datetime.datetime):
+        parsed = datetime.datetime.combine(
+            parsed, datetime.time.max if end_of_day else datetime.time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def bucket_start(date, kind):
+    if kind == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if kind == 'month':
+        return date.replace(day=1)
+    if kind == 'year':
+        return date.replace(month=1, day=1)
+    return date
+
+
+def next_bucket(date, kind):
+    if kind == 'week':
+        return date + datetime.timedelta(days=7)
+    if kind == 'month':
+        return (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    if kind == 'year':
+        return date.replace(year=date.year + 1)
+    return date + datetime.timedelta(days=1)
+
+
+def buckets_between(date_from, date_to, kind):
+    """
+    Returns the start date of every bucket from date_from to date_to.
+    """
+    current = bucket_start(date_from, kind)
+    buckets = []
+    while current <= date_to:
+        buckets.append(current)
+        current = next_bucket(current, kind)
+    return buckets
+
+
+def earnings_by_bucket(date_from, date_to, kind):
+    """
+    Returns {bucket start date: (quantity, revenue, cost)} of the active
+    sales between date_from and date_to, in a single grouped query.
+    """
+    rows = Sale.objects.filter(
+        status=True, created_at__gte=date_from, created_at__lte=date_to
+    ).annotate(bucket=Trunc('created_at', kind)).order_by().values('bucket').annotate(
+        quantity_total=Sum('quantity'),
+        revenue_total=Sum(F('quantity') * F('price'), output_field=DecimalField()),
+        cost_total=Sum(F('quantity') * F('stock__cost'), output_field=DecimalField()))
+    return {
+        timezone.localtime(row['bucket']).date(): (
+            row['quantity_total'] or 0,
+            Decimal(row['revenue_total'] or 0).quantize(CENTS),
+            Decimal(row['cost_total'] or 0).quantize(CENTS))
+        for row in rows
+    }
+
+
+def rollup_earnings_by_bucket(first_day, last_day, kind):
+    """
+    Same as earnings_by_bucket for whole days, read from the daily sales
+    rollup instead of the sales.
+    """
+    rows = DailySalesRollup.objects.filter(
+        date__gte=first_day, date__lte=last_day
+    ).annotate(bucket=Trunc('date', kind, output_field=DateField())).order_by().values(
+        'bucket').annotate(
+        quantity_total=Sum('quantity'), revenue_total=Sum('revenue'),
+        cost_total=Sum('cost'))
+    return {
+        row['bucket']: (
+            row['quantity_total'] or 0,
+            Decimal(row['revenue_total'] or 0).quantize(CENTS),
+            Decimal(row['cost_total'] or 0).quantize(CENTS))
+        for row in rows
+    }
+
+
+def earnings_report(date_from, date_to, date_type=None):
+    """
+    Builds the earnings chart of the dashboard: one point per bucket of the
+    dateType (day by default), empty buckets included. Ranges made of whole
+    days are read from the daily sales rollup.
+    """
+    kind = date_type if date_type in BUCKETS else 'day'
+    start = parse_report_date(date_from)
+    end = parse_report_date(date_to, end_of_day=True)
+    local_start = timezone.localtime(start)
+    local_end = timezone.localtime(end)
+    if local_start.time() == datetime.time.min and local_end.time() == datetime.time.max:
+        totals = rollup_earnings_by_bucket(local_start.date(), local_end.date(), kind)
+    else:
+        totals = earnings_by_bucket(start, end, kind)
+    report = {
+        'labels': [], 'earnings': [], 'quantity': [], 'revenue': [], 'cost': [],
+        'quantity_total': 0, 'earnings_total': Decimal(0),
+    }
+    for bucket in buckets_between(local_start.date(), local_end.date(), kind):
+        quantity, revenue, cost = totals.get(bucket, (0, Decimal(0), Decimal(0)))
+        report['labels'].append(bucket.strftime(BUCKETS[kind]))
+        report['earnings'].append(revenue - cost)
+        report['quantity'].append(quantity)
+        report['revenue'].append(revenue)
+        report['cost'].append(cost)
+        report['quantity_total'] += quantity
+        report['earnings_total'] += revenue - cost
+    return report
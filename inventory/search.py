@@ -0,0 +1,232 @@
+"""
+Search index
+Keeps a full-text index of the searchable fields of the active articles
+and orders, updated on every save, so the search box does not scan the
+tables. Searches return at most SEARCH_LIMIT matches, lists that were cut
+there say so in an X-Search-Truncated header.
+The index is stored by a pluggable backend, SQLite FTS5 when running on
+SQLite and plain icontains filters anywhere else.
+"""
+import logging
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.db.models.signals import post_save, post_delete
+from django.utils.module_loading import import_string
+from .models import Article, Order
+
+search_logger = logging.getLogger(__name__)
+
+SEARCH_LIMIT = 500
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchIndex:
+    """
+    Declares which fields of a model are searchable. Only the rows whose
+    active_field is set are indexed, the lists never show the others.
+    """
+
+    def __init__(self, name, model, fields, active_field='status'):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.active_field = active_field
+
+    @property
+    def table(self):
+        return 'inventory_search_%s' % self.name
+
+    def values(self, instance):
+        return [getattr(instance, field) or '' for field in self.fields]
+
+    def is_active(self, instance):
+        return bool(getattr(instance, self.active_field))
+
+
+INDEXES = {
+    'article': SearchIndex('article', Article, ('name', 'sku', 'location')),
+    'order': SearchIndex('order', Order, ('body', 'state')),
+}
+
+
+class SearchBackend:
+    """
+    Interface every search backend implements. search returns the matching
+    primary keys, best match first.
+    """
+
+    def update(self, index, instance):
+        raise NotImplementedError
+
+    def update_many(self, index, instances):
+        for instance in instances:
+            self.update(index, instance)
+
+    def remove(self, index, pk):
+        raise NotImplementedError
+
+    def search(self, index, text, limit=SEARCH_LIMIT):
+        raise NotImplementedError
+
+    def rebuild(self, index):
+        raise NotImplementedError
+
+
+class DatabaseBackend(SearchBackend):
+    """
+    Fallback backend without an index, filters the table with icontains.
+    """
+
+    def update(self, index, instance):
+        pass
+
+    def remove(self, index, pk):
+        pass
+
+    def search(self, index, text, limit=SEARCH_LIMIT):
+        query = Q()
+        for field in index.fields:
+            query |= Q(**{'%s__icontains' % field: text})
+        return list(index.model.objects.filter(query, **{index.active_field: True}).values_list(
+            'pk', flat=True)[:limit])
+
+    def rebuild(self, index):
+        pass
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """
+    Stores every index in a FTS5 virtual table whose rowid is the primary
+    key of the indexed row, and ranks the matches with bm25.
+    """
+
+    def update(self, index, instance):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' %
+                           index.table, [instance.pk])
+            if not index.is_active(instance):
+                return
+            cursor.execute('INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                index.table, ', '.join(index.fields),
+                ', '.join(['%s'] * len(index.fields))),
+                [instance.pk] + index.values(instance))
+
+    def update_many(self, index, instances):
+        if not instances:
+            return
+        rows = [[instance.pk] + index.values(instance)
+                for instance in instances if index.is_active(instance)]
+        with connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' %
+                               index.table, [[instance.pk] for instance in instances])
+            cursor.executemany('INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                index.table, ', '.join(index.fields),
+                ', '.join(['%s'] * len(index.fields))), rows)
+
+    def remove(self, index, pk):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' %
+                           index.table, [pk])
+
+    def search(self, index, text, limit=SEARCH_LIMIT):
+        tokens = TOKEN_RE.findall(text)
+        if not tokens:
+            return []
+        # Every token must match, as the prefix of a word of any field
+        match = ' '.join('"%s"*' % token for token in tokens)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY rank LIMIT %%s' % (
+                    index.table, index.table), [match, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self, index):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % index.table)
+            cursor.execute('INSERT INTO %s (rowid, %s) SELECT id, %s FROM %s WHERE %s' % (
+                index.table, ', '.join(index.fields), ', '.join(index.fields),
+                index.model._meta.db_table, index.active_field))
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Returns the backend set on SEARCH_BACKEND, or the best one for the
+    database in use.
+    """
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        elif connection.vendor == 'sqlite':
+            _backend = SQLiteFTS5Backend()
+        else:
+            _backend = DatabaseBackend()
+    return _backend
+
+
+def search_queryset(queryset, index_name, text):
+    """
+    Filters the queryset down to the best SEARCH_LIMIT rows matching text,
+    and annotates their position in the ranking as search_rank. Returns the
+    queryset and whether more rows matched.
+    """
+    ids = get_backend().search(INDEXES[index_name], text, SEARCH_LIMIT + 1)
+    truncated = len(ids) > SEARCH_LIMIT
+    ids = ids[:SEARCH_LIMIT]
+    if not ids:
+        return queryset.none().annotate(search_rank=Value(0, IntegerField())), truncated
+    ranking = Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+                   output_field=IntegerField())
+    return queryset.filter(pk__in=ids).annotate(search_rank=ranking), truncated
+
+
+class SearchMixin:
+    """
+    Adds X-Search-Truncated, with SEARCH_LIMIT, to the responses of a
+    viewset whose search matched more rows than it returns.
+    """
+    search_truncated = False
+
+    def search(self, queryset, index_name, text):
+        queryset, self.search_truncated = search_queryset(queryset, index_name, text)
+        return queryset
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.search_truncated:
+            response['X-Search-Truncated'] = str(SEARCH_LIMIT)
+        return response
+
+
+def update_index_many(index_name, instances):
+    """
+    Indexes rows written without signals, such as bulk_create or
+    bulk_update, in one batch.
+    """
+    get_backend().update_many(INDEXES[index_name], instances)
+
+
+def update_index(sender, instance, **kwargs):
+    for index in INDEXES.values():
+        if isinstance(instance, index.model):
+            get_backend().update(index, instance)
+
+
+def remove_from_index(sender, instance, **kwargs):
+    for index in INDEXES.values():
+        if isinstance(instance, index.model):
+            get_backend().remove(index, instance.pk)
+
+
+def connect_signals():
+    for index in INDEXES.values():
+        post_save.connect(update_index, sender=index.model,
+                          dispatch_uid='search_update_%s' % index.name)
+        post_delete.connect(remove_from_index, sender=index.model,
+                            dispatch_uid='search_remove_%s' % index.name)
@@ -1,7 +1,9 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from django.db.models import Sum
+from django.db.models import OuterRef, Subquery, Prefetch
+from django.core.files.storage import default_storage
 from .models import Article, Stock, Sale, Order
+from . import images
 
 User = get_user_model()
 
@@ -23,8 +25,26 @@ class ArticleSerializer(serializers.ModelSerializer):
     cost = serializers.SerializerMethodField('get_cost')
     quantity = serializers.SerializerMethodField('get_stock')
     stock_list = serializers.SerializerMethodField('get_stock_list')
+    image_variants = serializers.SerializerMethodField('get_image_variants')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Annotates the cost of every article and prefetches its active stock,
+        so a whole page serializes in a fixed number of queries instead of
+        several per article.
+        """
+        first_stock = Stock.objects.filter(
+            article=OuterRef('pk')).order_by('created_at')
+        return queryset.annotate(
+            stock_cost=Subquery(first_stock.values('cost')[:1])
+        ).prefetch_related(Prefetch(
+            'stock_article', queryset=Stock.objects.filter(status=True),
+            to_attr='active_stock'))
 
     def get_cost(self, obj):
+        if hasattr(obj, 'stock_cost'):
+            return obj.stock_cost if obj.stock_cost is not None else 0
         stock = Stock.objects.filter(
             article=obj.pk).order_by('created_at')
         count = 0
@@ -33,18 +53,30 @@ class ArticleSerializer(serializers.ModelSerializer):
         return count
 
     def get_stock(self, obj):
-        res = Stock.objects.filter(article=obj.pk, status=True).aggregate(
-            article_total_stock=Sum('quantity'))
-        stock = 0
-        if res['article_total_stock']:
-            stock = res['article_total_stock']
-        return stock
+        return obj.stock_quantity
 
     def get_stock_list(self, obj):
+        if hasattr(obj, 'active_stock'):
+            return StockSerializer(obj.active_stock, many=True).data
         stock = Stock.objects.filter(article=obj.pk, status=True)
         stockSerializer = StockSerializer(stock, many=True)
         return stockSerializer.data
 
+    def get_image_variants(self, obj):
+        """
+        URLs of the resized variants of the image, empty until the image
+        pipeline has written them. Built from their names, without looking
+        at the storage.
+        """
+        if not obj.image or obj.image.name != obj.image_variants_of:
+            return {}
+        request = self.context.get('request')
+        variants = {}
+        for key, name in images.variant_names(obj.image.name).items():
+            url = default_storage.url(name)
+            variants[key] = request.build_absolute_uri(url) if request else url
+        return variants
+
     class Meta:
         model = Article
         fields = (
@@ -57,6 +89,7 @@ class ArticleSerializer(serializers.ModelSerializer):
             "quantity",
             "status",
             "image",
+            "image_variants",
             "link",
             "stock_list",
             "created_at",
@@ -114,6 +147,31 @@ class SaleSerializer(serializers.ModelSerializer):
         )
 
 
+class SaleLineSerializer(serializers.Serializer):
+    """
+    Validates one line of a sale request, before it is allocated on stock.
+    """
+    article = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+    price = serializers.DecimalField(max_digits=15, decimal_places=2)
+
+
+class ArticleImportSerializer(serializers.Serializer):
+    """
+    Validates one row of an article import, with the quantity and cost of
+    its opening stock. Uniqueness is checked by the importer, per chunk.
+    """
+    sku = serializers.CharField(max_length=200)
+    name = serializers.CharField(max_length=200)
+    location = serializers.CharField(max_length=200)
+    suggested_price = serializers.DecimalField(
+        max_digits=15, decimal_places=2, required=False)
+    link = serializers.CharField(max_length=200, required=False, allow_blank=True)
+    quantity = serializers.IntegerField(min_value=0, required=False)
+    cost = serializers.DecimalField(
+        max_digits=15, decimal_places=2, min_value=0, required=False)
+
+
 class OrderSerializer(serializers.ModelSerializer):
     name = serializers.SerializerMethodField('get_article_name')
 
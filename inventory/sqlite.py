@@ -0,0 +1,151 @@
+"""
+SQLite
+Tuning for running on the bundled SQLite database with several gunicorn
+workers. Every new connection gets the SQLITE_JOURNAL_MODE (WAL, so
+readers never wait for the writer), a busy timeout so writers wait for
+the lock instead of failing, and the SQLITE_PRAGMAS.
+Short write transactions are retried with backoff when the database is
+still locked, and with SQLITE_WRITER_QUEUE they run one at a time on a
+single writer thread of the process, so its request threads never
+compete for the lock. The queries of a queued write are still seen by
+the execute wrappers of the request, and still pin its user to the
+primary database.
+Large batches of rows are written with one executemany, bulk_create and
+bulk_update compile a statement per batch of fewer than a hundred rows
+on SQLite, which dominates the time of imports and seeding.
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections, router, transaction, connection, OperationalError
+from django.db.backends.signals import connection_created
+from . import replicas
+
+sqlite_logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=%s' % settings.SQLITE_JOURNAL_MODE)
+        cursor.execute('PRAGMA busy_timeout=%d' % settings.SQLITE_BUSY_TIMEOUT)
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+
+
+def is_locked(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        return _writer
+
+
+def atomic_with_retries(func, *args, on_retry=None, **kwargs):
+    """
+    Runs func in a transaction and returns its result, retrying it with
+    exponential backoff and jitter while the database is locked. on_retry
+    is called with the attempt number before every retry.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as error:
+            if not is_locked(error) or attempt == MAX_ATTEMPTS:
+                raise
+            if on_retry is not None:
+                on_retry(attempt)
+            time.sleep(0.01 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _write_on_writer(func, args, kwargs, wrappers):
+    try:
+        # The request waits for the write, its wrappers are not used meanwhile
+        with ExitStack() as stack:
+            for wrapper in wrappers:
+                stack.enter_context(connection.execute_wrapper(wrapper))
+            return atomic_with_retries(func, *args, **kwargs)
+    finally:
+        # The writer thread outlives requests, never keep a broken connection
+        connection.close_if_unusable_or_obsolete()
+
+
+def write(func, *args, on_retry=None, **kwargs):
+    """
+    Runs the write transaction of func with atomic_with_retries, on the
+    writer thread when SQLITE_WRITER_QUEUE is set, with the execute
+    wrappers of the calling thread. Inside a transaction it always runs in
+    the calling thread, the writer could not see its rows.
+    """
+    if not settings.SQLITE_WRITER_QUEUE or connection.vendor != 'sqlite' or \
+            connection.in_atomic_block:
+        return atomic_with_retries(func, *args, on_retry=on_retry, **kwargs)
+    kwargs['on_retry'] = on_retry
+    # The router of the writer thread records the writes of that thread
+    replicas.mark_written()
+    return get_writer().submit(
+        _write_on_writer, func, args, kwargs, list(connection.execute_wrappers)).result()
+
+
+def insert_rows(model, columns, rows):
+    """
+    Inserts rows of values of the given fields with one executemany. The
+    other fields take their defaults, primary keys are not set on anything.
+    """
+    if not rows:
+        return
+    connection = connections[router.db_for_write(model)]
+    fields = [model._meta.get_field(column) for column in columns]
+    defaults = [field for field in model._meta.concrete_fields
+                if field not in fields and field.has_default()]
+    fields += defaults
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(value, connection) for field, value in zip(
+                fields, tuple(row) + tuple(field.get_default() for field in defaults))]
+            for row in rows])
+
+
+def update_rows(model, objs, fields):
+    """
+    Writes the given fields of every object with one executemany, instead
+    of the CASE with a branch per object for every field of bulk_update.
+    """
+    if not objs:
+        return
+    connection = connections[router.db_for_write(model)]
+    fields = [model._meta.get_field(field) for field in fields]
+    quote = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        quote(model._meta.db_table),
+        ', '.join('%s = %%s' % quote(field.column) for field in fields),
+        quote(model._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(getattr(obj, field.attname), connection)
+             for field in fields] + [obj.pk] for obj in objs])
+
+
+def connect_signals():
+    connection_created.connect(configure_connection, dispatch_uid='sqlite_pragmas')
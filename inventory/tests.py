@@ -1,12 +1,44 @@
 import io
-from django.test import TestCase, Client
+import gzip
+import asyncio
+import csv
+import os
+import json
+import logging
+import re
+import sqlite3
+import tempfile
+from decimal import Decimal
+import threading
+from unittest import mock
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, OperationalError
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.signals import request_finished
+from django.http import StreamingHttpResponse
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth import get_user_model
 from PIL import Image
 from rest_framework import status
-from rest_framework.test import APIClient
-from inventory.serializers import ArticleSerializer, SaleSerializer, OrderSerializer, StockSerializer, UserSerializer
-from inventory.models import Article, Stock, Sale, Order
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.authtoken.models import Token
+from inventory.serializers import ArticleSerializer, SaleSerializer, OrderSerializer, StockSerializer, UserSerializer, SaleLineSerializer
+from inventory.models import Article, Stock, Sale, Order, DailySalesRollup, LayerConsumption
+from inventory import allocation, benchmark, images, importer, replicas, sqlite, valuation
+from inventory.authentication import token_cache
+from inventory.caching import totals_cache
+from inventory.pagination import KeysetPagination
+from managment import handlers, log, metrics, middleware, profiling
+from managment.handlers import ThreadPoolASGIHandler
+from managment.storage import BuildStaticFilesStorage
 
 # ARTICLES_URL = reverse('api:articles')
 # Test cases to add:
@@ -45,6 +77,41 @@ class TestUser(TestCase):
         self.assertEqual(res.data['results'], userSerializer.data)
 
 
+class TestCachedTokenAuthentication(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token %s' % self.token.key)
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.client.get('/api/articles/').status_code, status.HTTP_200_OK)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/articles/')
+        self.assertFalse(any('authtoken_token' in query['sql'] for query in queries))
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get('/api/articles/')
+        self.token.delete()
+        res = self.client.get('/api/articles/')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get('/api/articles/')
+        self.user.is_active = False
+        self.user.save()
+        res = self.client.get('/api/articles/')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_get_user_by_token(self):
+        res = self.client.post('/api/getUser', {'token': self.token.key})
+        self.assertEqual(res.data['username'], 'testuser@gmail.com')
+
+
 class TestArticle(TestCase):
     """ Test module for Article model """
 
@@ -148,6 +215,155 @@ class TestArticle(TestCase):
         self.assertEqual(status.HTTP_200_OK, res.status_code)
         self.assertEquals(res.data['count'], 2)
 
+    def test_search_index_follows_article_changes(self):
+        article = Article.objects.create(
+            name="Blue helmet", sku="HHH3", location="Caja 2",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        res = self.client.get('/api/articles/?search=helm caja')
+        self.assertEqual(res.data['count'], 1)
+        article.name = "Blue gloves"
+        article.save()
+        res = self.client.get('/api/articles/?search=helmet')
+        self.assertEqual(res.data['count'], 0)
+        res = self.client.get('/api/articles/?search=HHH3')
+        self.assertEqual(res.data['results'][0]['name'], "Blue gloves")
+        article.delete()
+        res = self.client.get('/api/articles/?search=HHH3')
+        self.assertEqual(res.data['count'], 0)
+
+    def test_search_only_finds_active_articles(self):
+        for i in range(4):
+            Article.objects.create(
+                name="Helmet %s" % i, sku="HLM%s" % i, location="Caja 1", status=i % 2 == 0,
+                suggested_price=350.65, created_by=self.user, updated_by=self.user
+            )
+        with mock.patch('inventory.search.SEARCH_LIMIT', 2):
+            res = self.client.get('/api/articles/?search=helmet')
+            self.assertEqual(res.data['count'], 2)
+            self.assertNotIn('X-Search-Truncated', res)
+            article = Article.objects.get(sku="HLM1")
+            article.status = True
+            article.save()
+            res = self.client.get('/api/articles/?search=helmet')
+            self.assertEqual(res.data['count'], 2)
+            self.assertEqual(res['X-Search-Truncated'], '2')
+
+    def test_search_ranks_best_match_first(self):
+        Article.objects.create(
+            name="Wheel bolts", sku="WB1", location="Wheel helmet shelf",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        Article.objects.create(
+            name="Helmet", sku="HLM1", location="Caja 1",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        res = self.client.get('/api/articles/?search=helmet')
+        self.assertEqual([a['name'] for a in res.data['results']],
+                         ["Helmet", "Wheel bolts"])
+
+    @override_settings(CACHE_IS_SHARED=True)
+    def test_article_list_conditional_get(self):
+        cache.clear()
+        self.create_articles_with_stock(3)
+        res = self.client.get('/api/articles/')
+        etag = res['ETag']
+        self.assertIn('Last-Modified', res)
+        res = self.client.get('/api/articles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        res = self.client.get('/api/articles/?order=name', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        stock = Stock.objects.first()
+        self.client.patch('/api/stocks/%s/' % stock.id, {'quantity': 1})
+        res = self.client.get('/api/articles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+        article = Article.objects.first()
+        res = self.client.get('/api/articles/%s/' % article.id)
+        res = self.client.get('/api/articles/%s/' % article.id, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(CACHE_IS_SHARED=True)
+    def test_article_list_conditional_get_from_versions(self):
+        cache.clear()
+        self.create_articles_with_stock(3)
+        res = self.client.get('/api/articles/')
+        etag = res['ETag']
+        self.assertIn('Last-Modified', res)
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/api/articles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(queries), 0)
+        # Sales update the stock layers and counters without signals
+        allocation.sell(Article.objects.first().id, 1, 50, self.user)
+        res = self.client.get('/api/articles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_article_list_without_shared_cache_is_never_conditional(self):
+        self.create_articles_with_stock(3)
+        res = self.client.get('/api/articles/')
+        self.assertNotIn('ETag', res)
+        self.assertNotIn('Last-Modified', res)
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/api/articles/', HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse([query for query in queries if 'MAX(' in query['sql']])
+
+    def create_articles_with_stock(self, amount, offset=0):
+        for i in range(offset, offset + amount):
+            article = Article.objects.create(
+                name="Articulo %s" % i, sku="ART%s" % i, location="Caja 1",
+                suggested_price=350.65, created_by=self.user, updated_by=self.user
+            )
+            Stock.objects.create(article=article, quantity=2, cost=100.50,
+                                 created_by=self.user, updated_by=self.user)
+            Stock.objects.create(article=article, quantity=3, cost=120.50,
+                                 created_by=self.user, updated_by=self.user)
+
+    def test_article_list_query_count_does_not_depend_on_page_size(self):
+        self.create_articles_with_stock(2)
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get('/api/articles/')
+        self.create_articles_with_stock(10, offset=2)
+        with CaptureQueriesContext(connection) as big_page:
+            res = self.client.get('/api/articles/')
+        self.assertEqual(res.data['count'], 12)
+        self.assertEqual(len(small_page), len(big_page))
+
+    def test_article_list_matches_single_serialization(self):
+        self.create_articles_with_stock(3)
+        for stock in Stock.objects.filter(article__name="Articulo 0"):
+            stock.status = False
+            stock.save()
+        res = self.client.get('/api/articles/?order=name')
+        articles = Article.objects.filter(status=True).order_by('name')
+        serializer = ArticleSerializer(articles, many=True)
+        for listed, single in zip(res.data['results'], serializer.data):
+            listed.pop('image')
+            single.pop('image')
+            self.assertEqual(listed, single)
+        self.assertEqual(res.data['results'][0]['quantity'], 0)
+        self.assertEqual(res.data['results'][1]['quantity'], 5)
+
+    def test_article_list_sort_is_whitelisted(self):
+        self.create_articles_with_stock(3)
+        res = self.client.get('/api/articles/', {'order': 'name', 'type': '-'})
+        self.assertEqual([row['name'] for row in res.data['results']],
+                         ["Articulo 2", "Articulo 1", "Articulo 0"])
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/api/articles/', {'order': 'created_by__password'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('order', res.data)
+        self.assertEqual(len(queries), 0)
+        # Only the list is sorted, other actions ignore the param
+        article = Article.objects.first()
+        res = self.client.get('/api/articles/%s/' % article.id, {'order': 'nope'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        res = self.client.patch('/api/articles/%s/?order=nope' % article.id, {'location': "Caja 9"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        res = self.client.get('/api/articles/export/', {'order': 'nope'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
 
 class TestSale(TestCase):
     def setUp(self):
@@ -230,11 +446,67 @@ class TestSale(TestCase):
             created_by=self.user, updated_by=self.user
         )
         res = self.client.get('/api/sales/')
-        sales = Sale.objects.filter(status=True)
+        sales = Sale.objects.filter(status=True).order_by('created_at')
         serializer = SaleSerializer(sales, many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
         self.assertEqual(res.data['results'], serializer.data)
 
+    def test_sales_keyset_pagination(self):
+        stock = Stock.objects.create(article=self.article, quantity=50,
+                                     cost=300.53, created_by=self.user, updated_by=self.user)
+        for i in range(45):
+            Sale.objects.create(stock=stock, quantity=1 + i % 3, price=550.54,
+                                created_by=self.user, updated_by=self.user)
+        expected = list(Sale.objects.order_by('-quantity', '-id').values_list('id', flat=True))
+        seen = []
+        res = self.client.get('/api/sales/?order=-quantity&cursor=&total=1')
+        self.assertEqual(res.data['total'], 45)
+        self.assertIsNone(res.data['previous'])
+        pages = [res]
+        while res.data['next']:
+            res = self.client.get(res.data['next'])
+            pages.append(res)
+        for page in pages:
+            seen.extend(sale['id'] for sale in page.data['results'])
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(seen, expected)
+        res = self.client.get(pages[-1].data['previous'])
+        self.assertEqual([sale['id'] for sale in res.data['results']],
+                         [sale['id'] for sale in pages[1].data['results']])
+        res = self.client.get('/api/sales/?cursor=')
+        res = self.client.get(res.data['next'])
+        expected = Sale.objects.order_by('created_at', 'id').values_list('id', flat=True)
+        self.assertEqual([sale['id'] for sale in res.data['results']],
+                         list(expected[20:40]))
+
+    def test_keyset_pagination_with_null_values(self):
+        stock = Stock.objects.create(article=self.article, quantity=50,
+                                     cost=300.53, created_by=self.user, updated_by=self.user)
+        for i in range(45):
+            Sale.objects.create(stock=stock if i % 2 else None, quantity=1, price=550.54,
+                                created_by=self.user, updated_by=self.user)
+
+        def page(url, ordering):
+            paginator = KeysetPagination()
+            paginator.page_size = 10
+            rows = paginator.paginate_queryset(
+                Sale.objects.order_by(ordering), Request(APIRequestFactory().get(url)))
+            return [row.pk for row in rows], paginator.get_next_link(), paginator.get_previous_link()
+
+        for ordering in ('stock__article__name', '-stock__article__name'):
+            seen, pages = [], []
+            url = '/api/sales/?cursor='
+            while url:
+                ids, url, previous = page(url, ordering)
+                seen.extend(ids)
+                pages.append(ids)
+            self.assertEqual(sorted(seen), sorted(Sale.objects.values_list('id', flat=True)))
+            self.assertEqual(page(previous, ordering)[0], pages[-2])
+
+    def test_sales_invalid_cursor(self):
+        res = self.client.get('/api/sales/?cursor=nope')
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_sell_more_that_stock(self):
         stock = Stock.objects.create(article=self.article, quantity=5,
                                      cost=300.53, created_by=self.user, updated_by=self.user)
@@ -247,6 +519,531 @@ class TestSale(TestCase):
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class TestStockAllocation(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.article = Article.objects.create(
+            name="Articulo 6", sku="ART6", location="Caja 6",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        self.older = Stock.objects.create(article=self.article, quantity=3,
+                                          cost=10, created_by=self.user, updated_by=self.user)
+        self.newer = Stock.objects.create(article=self.article, quantity=3,
+                                          cost=20, created_by=self.user, updated_by=self.user)
+
+    def test_fifo_consumes_oldest_layer_first(self):
+        sales = allocation.sell(self.article.id, 4, 50, self.user, policy='FIFO')
+        self.assertEqual([sale.stock_id for sale in sales],
+                         [self.older.id, self.newer.id])
+        self.assertEqual([sale.quantity for sale in sales], [3, 1])
+        self.assertTrue(all(sale.pk for sale in sales))
+        self.older.refresh_from_db()
+        self.newer.refresh_from_db()
+        self.assertFalse(self.older.status)
+        self.assertEqual(self.newer.quantity, 2)
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.stock_quantity, 2)
+        self.assertEqual(self.article.stock_value, Decimal('40.00'))
+
+    def test_created_sales_get_their_own_primary_keys(self):
+        sales = allocation.sell(self.article.id, 4, 50, self.user, policy='FIFO')
+        for sale in sales:
+            stored = Sale.objects.get(pk=sale.pk)
+            self.assertEqual((stored.stock_id, stored.quantity), (sale.stock_id, sale.quantity))
+
+    def test_not_enough_stock_writes_nothing(self):
+        with self.assertRaises(allocation.NotEnoughStock):
+            allocation.sell(self.article.id, 7, 50, self.user)
+        self.assertFalse(Sale.objects.exists())
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.stock_quantity, 6)
+
+
+class TestCartSale(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+        self.articles = []
+        for i in range(4):
+            article = Article.objects.create(
+                name="Carrito %s" % i, sku="CART%s" % i, location="Caja 8",
+                suggested_price=350.65, created_by=self.user, updated_by=self.user
+            )
+            Stock.objects.create(article=article, quantity=2,
+                                 cost=10, created_by=self.user, updated_by=self.user)
+            Stock.objects.create(article=article, quantity=2,
+                                 cost=20, created_by=self.user, updated_by=self.user)
+            self.articles.append(article)
+
+    def test_cart_sells_every_line(self):
+        payload = [
+            {'article': self.articles[0].id, 'quantity': 3, 'price': 50},
+            {'article': self.articles[1].id, 'quantity': 1, 'price': 60},
+            {'article': self.articles[0].id, 'quantity': 1, 'price': 55},
+        ]
+        res = self.client.post('/api/sales/cart/', payload)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([len(line['sales']) for line in res.data], [2, 1, 1])
+        self.assertEqual(res.data[2]['sales'][0]['price'], '55.00')
+        self.assertEqual(Sale.objects.count(), 4)
+        self.articles[0].refresh_from_db()
+        self.assertEqual(self.articles[0].stock_quantity, 0)
+        self.assertEqual(self.articles[0].stock_value, Decimal('0.00'))
+
+    def test_cart_fails_atomically(self):
+        payload = [
+            {'article': self.articles[0].id, 'quantity': 2, 'price': 50},
+            {'article': self.articles[1].id, 'quantity': 5, 'price': 60},
+        ]
+        res = self.client.post('/api/sales/cart/', payload)
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(res.data['lines'][0]['error'])
+        self.assertIsNotNone(res.data['lines'][1]['error'])
+        self.assertFalse(Sale.objects.exists())
+        self.articles[0].refresh_from_db()
+        self.assertEqual(self.articles[0].stock_quantity, 4)
+
+    def test_cart_query_count_does_not_depend_on_lines(self):
+        def sell_lines(articles):
+            payload = [{'article': article.id, 'quantity': 1, 'price': 50}
+                       for article in articles]
+            with CaptureQueriesContext(connection) as queries:
+                allocation.sell_cart(
+                    SaleLineSerializer(payload, many=True).data, self.user)
+            # Without RETURNING the sales are inserted one at a time
+            return len([query for query in queries
+                        if not query['sql'].startswith('INSERT INTO "inventory_sale"')])
+        self.assertEqual(sell_lines(self.articles[:1]), sell_lines(self.articles[1:]))
+
+
+class TestConcurrentSales(TransactionTestCase):
+    def test_parallel_sales_do_not_oversell(self):
+        user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        article = Article.objects.create(
+            name="Articulo 7", sku="ART7", location="Caja 7",
+            suggested_price=350.65, created_by=user, updated_by=user
+        )
+        for _ in range(2):
+            Stock.objects.create(article=article, quantity=3,
+                                 cost=10, created_by=user, updated_by=user)
+        responses = []
+
+        def sell():
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                res = client.post('/api/sales/', {
+                    'article': article.id, 'quantity': 1, 'price': 50})
+                responses.append(res.status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=sell) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(responses.count(status.HTTP_200_OK), 6)
+        self.assertEqual(responses.count(status.HTTP_400_BAD_REQUEST), 4)
+        self.assertEqual(Sale.objects.count(), 6)
+        self.assertFalse(Stock.objects.filter(quantity__gt=0).exists())
+        article.refresh_from_db()
+        self.assertEqual(article.stock_quantity, 0)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class TestReplicaRouting(TransactionTestCase):
+    """
+    A copy of the test database stands in for the replica, so rows
+    written after the copy are only on the primary.
+    """
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory.name, 'replica.sqlite3'),
+        }
+        connections.ensure_defaults('replica')
+        connections.prepare_test_settings('replica')
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        cls.directory.cleanup()
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(username='testuser@gmail.com')
+        self.other = get_user_model().objects.create(username='other@gmail.com')
+        self.article = Article.objects.create(
+            name="Articulo 1", sku="ART1", location="Caja 1",
+            suggested_price=100, created_by=self.user, updated_by=self.user)
+        Stock.objects.create(article=self.article, quantity=10, cost=20,
+                             created_by=self.user, updated_by=self.user)
+        connections['replica'].close()
+        connections['default'].ensure_connection()
+        replica = sqlite3.connect(connections['replica'].settings_dict['NAME'])
+        connections['default'].connection.backup(replica)
+        replica.close()
+        Article.objects.create(
+            name="Articulo 2", sku="ART2", location="Caja 1",
+            suggested_price=100, created_by=self.user, updated_by=self.user)
+
+    def list_articles(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get('/api/articles/')
+
+    def test_lists_read_from_replica(self):
+        self.assertEqual(self.list_articles(self.user).data['count'], 1)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        res = client.get('/api/articles/%s/' % Article.objects.get(sku='ART2').id)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_writes_pin_the_user_to_primary(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        res = client.post('/api/sales/', {'article': self.article.id, 'quantity': 1, 'price': 50})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(Sale.objects.using('replica').count(), 0)
+        self.assertEqual(self.list_articles(self.user).data['count'], 2)
+        self.assertEqual(self.list_articles(self.other).data['count'], 1)
+
+    def test_cached_totals_are_read_from_primary(self):
+        Stock.objects.create(article=Article.objects.get(sku='ART2'), quantity=5, cost=20,
+                             created_by=self.user, updated_by=self.user)
+        client = APIClient()
+        client.force_authenticate(self.other)
+        self.assertEqual(client.get('/api/getTotals').data['stock_total'], 15)
+
+    def test_router_without_replica_context(self):
+        router = replicas.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Article), 'default')
+        self.assertEqual(router.db_for_write(Article, instance=self.article), 'default')
+
+
+class TestSQLite(TestCase):
+    def test_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_locked_writes_are_retried(self):
+        calls = []
+        retries = []
+
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'written'
+
+        self.assertEqual(sqlite.atomic_with_retries(write, on_retry=retries.append), 'written')
+        self.assertEqual(retries, [1, 2])
+
+        def fail():
+            raise OperationalError('no such table: inventory_sale')
+
+        with self.assertRaises(OperationalError):
+            sqlite.atomic_with_retries(fail, on_retry=retries.append)
+        self.assertEqual(retries, [1, 2])
+
+
+@override_settings(SQLITE_WRITER_QUEUE=True)
+class TestSQLiteWriterQueue(TransactionTestCase):
+    def test_sales_are_written_by_one_thread(self):
+        user = get_user_model().objects.create(username='testuser@gmail.com')
+        article = Article.objects.create(
+            name="Articulo 7", sku="ART7", location="Caja 7",
+            suggested_price=350.65, created_by=user, updated_by=user)
+        Stock.objects.create(article=article, quantity=6, cost=10,
+                             created_by=user, updated_by=user)
+        threads_used = set()
+        sell_lines = allocation._sell_lines
+
+        def record_thread(*args, **kwargs):
+            threads_used.add(threading.current_thread().name)
+            return sell_lines(*args, **kwargs)
+
+        responses = []
+
+        def sell():
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                responses.append(client.post('/api/sales/', {
+                    'article': article.id, 'quantity': 1, 'price': 50}).status_code)
+            finally:
+                connections.close_all()
+
+        with mock.patch.object(allocation, '_sell_lines', record_thread):
+            threads = [threading.Thread(target=sell) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(responses.count(status.HTTP_200_OK), 6)
+        self.assertEqual(responses.count(status.HTTP_400_BAD_REQUEST), 2)
+        self.assertEqual(len(threads_used), 1)
+        self.assertTrue(threads_used.pop().startswith('sqlite-writer'))
+        article.refresh_from_db()
+        self.assertEqual(article.stock_quantity, 0)
+
+    def test_queued_writes_are_seen_by_the_request(self):
+        cache.clear()
+        user = get_user_model().objects.create(username='testuser@gmail.com')
+        article = Article.objects.create(
+            name="Articulo 7", sku="ART7", location="Caja 7",
+            suggested_price=350.65, created_by=user, updated_by=user)
+        Stock.objects.create(article=article, quantity=6, cost=10,
+                             created_by=user, updated_by=user)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        def sale_queries():
+            with self.assertLogs('managment.requests', logging.INFO) as logs:
+                res = client.post('/api/sales/', {'article': article.id, 'quantity': 1, 'price': 50})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            return logs.records[-1].queries
+
+        queued = sale_queries()
+        with override_settings(SQLITE_WRITER_QUEUE=False):
+            # The writer thread may also count the setup of its connection
+            self.assertGreaterEqual(queued, sale_queries())
+        self.assertTrue(replicas.is_pinned(user))
+
+
+class TestASGIHandler(TransactionTestCase):
+    """
+    The handler runs the views in its own threads, with connections of
+    their own, so the rows must be committed.
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='testuser@gmail.com')
+        self.token = Token.objects.create(user=self.user)
+        article = Article.objects.create(
+            name="Articulo 1", sku="ART1", location="Caja 1",
+            suggested_price=100, created_by=self.user, updated_by=self.user)
+        stock = Stock.objects.create(article=article, quantity=10, cost=20,
+                                     created_by=self.user, updated_by=self.user)
+        for _ in range(3):
+            Sale.objects.create(stock=stock, quantity=1, price=50,
+                                created_by=self.user, updated_by=self.user)
+        self.application = ThreadPoolASGIHandler()
+
+    def tearDown(self):
+        self.application.executor.shutdown()
+
+    async def request(self, path, query=b'', disconnect=None, send=None):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(),
+            'query_string': query, 'root_path': '', 'scheme': 'http',
+            'headers': [(b'host', b'testserver'),
+                        (b'authorization', ('Token %s' % self.token.key).encode())],
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        messages = []
+        received = []
+        disconnect = disconnect or asyncio.Event()
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': b''}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def record(message):
+            messages.append(message)
+            if send is not None:
+                await send(message)
+
+        await self.application(scope, receive, record)
+        if not messages:
+            return None, b''
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def test_views_run_in_the_pool(self):
+        async def totals():
+            return await asyncio.gather(*[self.request('/api/getTotals') for _ in range(10)])
+
+        for status_code, body in asyncio.run(totals()):
+            self.assertEqual(status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(body)['stock_total'], 10)
+
+    def test_exports_stream_from_the_pool(self):
+        status_code, body = asyncio.run(self.request('/api/sales/export/', b'type=csv'))
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        rows = list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['article'], "Articulo 1")
+
+    def test_disconnected_clients_stop_the_response(self):
+        async def disconnected():
+            disconnect = asyncio.Event()
+            disconnect.set()
+            return await self.request('/api/sales/export/', b'type=csv', disconnect)
+
+        finished = []
+
+        def finish(**kwargs):
+            finished.append(threading.current_thread().name)
+
+        request_finished.connect(finish)
+        try:
+            self.assertEqual(asyncio.run(disconnected()), (None, b''))
+        finally:
+            request_finished.disconnect(finish)
+        self.assertEqual(len(finished), 1)
+        self.assertTrue(finished[0].startswith('asgi'))
+
+    @mock.patch.object(handlers, 'QUEUE_SIZE', 1)
+    def test_slow_clients_never_hold_the_response(self):
+        events = []
+
+        def rows():
+            for number in range(5):
+                events.append('produced')
+                yield b'row %d\n' % number
+
+        def finish(**kwargs):
+            events.append('finished')
+
+        async def slow_send(message):
+            events.append('sent')
+            await asyncio.sleep(0.01)
+
+        self.application.get_response = lambda request: StreamingHttpResponse(rows())
+        request_finished.connect(finish)
+        try:
+            status_code, body = asyncio.run(self.request('/rows', send=slow_send))
+        finally:
+            request_finished.disconnect(finish)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(body, b''.join(b'row %d\n' % number for number in range(5)))
+        # The response is closed before the client got most of its chunks
+        self.assertLessEqual(events[:events.index('finished')].count('sent'), 2)
+
+
+class TestStockCounters(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+        self.article = Article.objects.create(
+            name="Articulo 5", sku="ART5", location="Caja 5",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+
+    def assertCounters(self, quantity, value):
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.stock_quantity, quantity)
+        self.assertEqual(self.article.stock_value, Decimal(value))
+
+    def test_counters_follow_stock_writes(self):
+        stock = Stock.objects.create(article=self.article, quantity=4,
+                                     cost=10.25, created_by=self.user, updated_by=self.user)
+        self.assertCounters(4, '41.00')
+        self.client.post('/api/stocks/', {
+            'article': self.article.id, 'quantity': 2, 'cost': 5})
+        self.assertCounters(6, '51.00')
+        self.client.patch('/api/stocks/%s/' % stock.id, {'quantity': 1})
+        self.assertCounters(3, '20.25')
+        self.client.patch('/api/stocks/%s/' % stock.id, {'status': False})
+        self.assertCounters(2, '10.00')
+        Stock.objects.get(article=self.article, status=True).delete()
+        self.assertCounters(0, '0')
+
+    def test_counters_follow_sales(self):
+        Stock.objects.create(article=self.article, quantity=3,
+                             cost=10, created_by=self.user, updated_by=self.user)
+        Stock.objects.create(article=self.article, quantity=3,
+                             cost=20, created_by=self.user, updated_by=self.user)
+        self.client.post('/api/sales/', {
+            'article': self.article.id, 'quantity': 4, 'price': 50})
+        self.assertCounters(2, '20.00')
+        res = self.client.get('/api/getTotals')
+        self.assertEqual(res.data['stock_total'], 2)
+        self.assertEqual(res.data['price_total'], Decimal('20.00'))
+
+    def test_rebuild_command_fixes_counters(self):
+        Stock.objects.create(article=self.article, quantity=3,
+                             cost=10, created_by=self.user, updated_by=self.user)
+        Article.objects.filter(pk=self.article.pk).update(stock_quantity=99)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_stock_counters', '--verify', stdout=io.StringIO())
+        call_command('rebuild_stock_counters', stdout=io.StringIO())
+        self.assertCounters(3, '30.00')
+        call_command('rebuild_stock_counters', '--verify', stdout=io.StringIO())
+
+
+class TestTotalsCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+        self.article = Article.objects.create(
+            name="Articulo 12", sku="ART12", location="Caja 12",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        Stock.objects.create(article=self.article, quantity=4, cost=10,
+                             created_by=self.user, updated_by=self.user)
+
+    def test_totals_are_cached_until_a_write(self):
+        self.assertEqual(self.client.get('/api/getTotals').data['stock_total'], 4)
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/api/getTotals')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(res.data['stock_total'], 4)
+        stats = self.client.get('/api/getCacheStats').data['totals']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        self.client.post('/api/sales/', {'article': self.article.id, 'quantity': 1, 'price': 50})
+        self.assertEqual(self.client.get('/api/getTotals').data['stock_total'], 3)
+        self.client.post('/api/stocks/', {'article': self.article.id, 'quantity': 2, 'cost': 5})
+        self.assertEqual(self.client.get('/api/getTotals').data['stock_total'], 5)
+        self.client.patch('/api/articles/%s/' % self.article.id, {'status': False})
+        self.assertIsNone(self.client.get('/api/getTotals').data['stock_total'])
+
+    def test_local_cache_keeps_totals_briefly(self):
+        self.assertFalse(settings.CACHE_IS_SHARED)
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            totals_cache.get_or_compute(lambda: 1)
+        self.assertEqual(cache_set.call_args[0][2], 5)
+        with override_settings(TOTALS_CACHE_TIMEOUT=3600):
+            self.assertEqual(totals_cache.timeout, 3600)
+
+
 class TestOrder(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -274,6 +1071,16 @@ class TestOrder(TestCase):
         self.assertTrue(order.exists())
         self.assertEqual(order[0].state, "PENDIENTE")
 
+    def test_search_orders_by_body(self):
+        Order.objects.create(article=self.article, body="Pedir al proveedor",
+                             created_by=self.user, updated_by=self.user)
+        Order.objects.create(article=self.article, body="Nothing",
+                             created_by=self.user, updated_by=self.user)
+        res = self.client.get('/api/orders/?search=proveedor')
+        self.assertEqual(res.data['count'], 1)
+        res = self.client.get('/api/orders/?search=pendiente')
+        self.assertEqual(res.data['count'], 2)
+
     def test_update_order_status(self):
         Order.objects.create(article=self.article, body="Nothing",
                              created_by=self.user, updated_by=self.user)
@@ -302,3 +1109,668 @@ class TestHelpers(TestCase):
     def test_get_inventory_configuration_info(self):
         # retrieve columns, stock_total, money_total
         pass
+
+    def create_sale(self, stock, quantity, price, created_at):
+        sale = Sale.objects.create(stock=stock, quantity=quantity, price=price,
+                                   created_by=self.user, updated_by=self.user)
+        sale.created_at = parse_datetime(created_at)
+        sale.save()
+        return sale
+
+    def test_get_earnings_by_month(self):
+        article = Article.objects.create(
+            name="Articulo 9", sku="ART9", location="Caja 9",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        stock = Stock.objects.create(article=article, quantity=50, cost=10,
+                                     created_by=self.user, updated_by=self.user)
+        self.create_sale(stock, 2, 25, "2020-01-10T10:00:00Z")
+        self.create_sale(stock, 1, 30, "2020-01-20T10:00:00Z")
+        self.create_sale(stock, 3, 20, "2020-03-05T10:00:00Z")
+        payload = {'dateFrom': '2020-01-01', 'dateTo': '2020-03-31', 'dateType': 'month'}
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.post('/api/getEarnings', payload)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['labels'], ['Jan/2020', 'Feb/2020', 'Mar/2020'])
+        self.assertEqual(res.data['quantity'], [3, 0, 3])
+        self.assertEqual(res.data['revenue'], [Decimal('80.00'), 0, Decimal('60.00')])
+        self.assertEqual(res.data['earnings'], [Decimal('50.00'), 0, Decimal('30.00')])
+        self.assertEqual(res.data['quantity_total'], 6)
+        self.assertEqual(res.data['earnings_total'], Decimal('80.00'))
+
+    def test_sales_rollup_follows_sales(self):
+        article = Article.objects.create(
+            name="Articulo 10", sku="ART10", location="Caja 10",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        stock = Stock.objects.create(article=article, quantity=50, cost=10,
+                                     created_by=self.user, updated_by=self.user)
+        sale = self.create_sale(stock, 2, 25, "2020-01-10T10:00:00Z")
+        self.create_sale(stock, 1, 30, "2020-01-10T18:00:00Z")
+        rollup = DailySalesRollup.objects.get(article=article, date="2020-01-10")
+        self.assertEqual((rollup.quantity, rollup.revenue, rollup.cost),
+                         (3, Decimal('80.00'), Decimal('30.00')))
+        self.client.patch('/api/sales/%s/' % sale.id, {'status': False})
+        rollup.refresh_from_db()
+        self.assertEqual((rollup.quantity, rollup.revenue, rollup.cost),
+                         (1, Decimal('30.00'), Decimal('10.00')))
+        self.client.post('/api/sales/', {'article': article.id, 'quantity': 4, 'price': 20})
+        today = DailySalesRollup.objects.exclude(pk=rollup.pk).get()
+        self.assertEqual((today.quantity, today.revenue), (4, Decimal('80.00')))
+
+        expected = list(DailySalesRollup.objects.order_by('date').values_list(
+            'date', 'quantity', 'revenue', 'cost'))
+        self.assertEqual(len(expected), 2)
+        DailySalesRollup.objects.all().delete()
+        call_command('rebuild_sales_rollup', stdout=io.StringIO())
+        self.assertEqual(list(DailySalesRollup.objects.order_by('date').values_list(
+            'date', 'quantity', 'revenue', 'cost')), expected)
+
+    def test_get_earnings_rollup_matches_sales(self):
+        article = Article.objects.create(
+            name="Articulo 11", sku="ART11", location="Caja 11",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        stock = Stock.objects.create(article=article, quantity=50, cost=10,
+                                     created_by=self.user, updated_by=self.user)
+        self.create_sale(stock, 2, 25, "2020-01-06T10:00:00Z")
+        self.create_sale(stock, 1, 30, "2020-01-14T10:00:00Z")
+        from_rollup = self.client.post('/api/getEarnings', {
+            'dateFrom': '2020-01-01', 'dateTo': '2020-01-31', 'dateType': 'week'})
+        from_sales = self.client.post('/api/getEarnings', {
+            'dateFrom': '2020-01-01T00:00:00Z', 'dateTo': '2020-01-31T23:00:00Z',
+            'dateType': 'week'})
+        self.assertEqual(from_rollup.data, from_sales.data)
+        self.assertEqual(from_rollup.data['quantity'], [0, 2, 1, 0, 0])
+
+    def test_get_earnings_rollup_follows_layer_costs(self):
+        article = Article.objects.create(
+            name="Articulo 12", sku="ART12", location="Caja 12",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        stock = Stock.objects.create(article=article, quantity=50, cost=10,
+                                     created_by=self.user, updated_by=self.user)
+        self.create_sale(stock, 2, 25, "2020-01-06T10:00:00Z")
+        self.create_sale(stock, 1, 30, "2020-01-07T10:00:00Z")
+        self.client.patch('/api/stocks/%s/' % stock.id, {'cost': 12})
+        from_rollup = self.client.post('/api/getEarnings', {
+            'dateFrom': '2020-01-06', 'dateTo': '2020-01-07'})
+        from_sales = self.client.post('/api/getEarnings', {
+            'dateFrom': '2020-01-06T00:00:00Z', 'dateTo': '2020-01-07T23:00:00Z'})
+        self.assertEqual(from_rollup.data, from_sales.data)
+        self.assertEqual(from_rollup.data['cost'], [Decimal('24.00'), Decimal('12.00')])
+        # Layers loaded without their cost recount the days of their sales
+        stock = Stock.objects.only('id').get(pk=stock.pk)
+        stock.cost = 15
+        stock.save()
+        from_rollup = self.client.post('/api/getEarnings', {
+            'dateFrom': '2020-01-06', 'dateTo': '2020-01-07'})
+        self.assertEqual(from_rollup.data['cost'], [Decimal('30.00'), Decimal('15.00')])
+
+    def test_get_earnings_by_day_fills_empty_days(self):
+        payload = {'dateFrom': '2020-01-30', 'dateTo': '2020-02-02'}
+        res = self.client.post('/api/getEarnings', payload)
+        self.assertEqual(res.data['labels'], [
+            '30/Jan/2020', '31/Jan/2020', '01/Feb/2020', '02/Feb/2020'])
+        self.assertEqual(res.data['earnings_total'], 0)
+
+    def test_get_earnings_invalid_date(self):
+        payload = {'dateFrom': 'yesterday', 'dateTo': '2020-02-02'}
+        res = self.client.post('/api/getEarnings', payload)
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        for date in ('2026-13-01', '2026-02-30', '2026-01-01T25:00:00'):
+            res = self.client.post('/api/getEarnings', {'dateFrom': date, 'dateTo': '2026-03-01'})
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get('/api/getValuation', {'date': '2026-13-01'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestLogging(TestCase):
+    def test_background_handler_writes_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            handler = log.BackgroundHandler({
+                'class': 'logging.handlers.RotatingFileHandler',
+                'filename': filename, 'maxBytes': 1024 * 1024})
+            handler.setFormatter(log.JSONFormatter())
+            logger = logging.getLogger('inventory.tests.background')
+            logger.propagate = False
+            logger.addHandler(handler)
+            try:
+                logger.warning("SOLD %s", 3, extra={'action': 'create'})
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+            with open(filename) as file:
+                entry = json.loads(file.readline())
+        self.assertEqual(entry['message'], "SOLD 3")
+        self.assertEqual(entry['level'], "WARNING")
+        self.assertEqual(entry['action'], "create")
+
+    def test_sampling_filter_keeps_warnings(self):
+        sampling = log.SamplingFilter(rate=0)
+        info = logging.LogRecord('inventory', logging.INFO, '', 0, 'payload', (), None)
+        error = logging.LogRecord('inventory', logging.ERROR, '', 0, 'failed', (), None)
+        self.assertFalse(sampling.filter(info))
+        self.assertTrue(sampling.filter(error))
+
+
+class TestRequestInstrumentation(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+
+    def list_articles(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.get('/api/articles/')
+
+    def test_server_timing_and_log_record(self):
+        with self.assertLogs('managment.requests', logging.INFO) as logs:
+            res = self.list_articles()
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertRegex(res['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", total;dur=[\d.]+$')
+        record = logs.records[-1]
+        self.assertEqual(record.levelno, logging.INFO)
+        self.assertEqual(record.view, 'ArticleViewSet.list')
+        self.assertEqual(record.status, status.HTTP_200_OK)
+        self.assertGreater(record.queries, 0)
+
+    def test_repeated_queries_are_detected(self):
+        for i in range(3):
+            Article.objects.create(
+                name="Articulo %s" % i, sku="ART%s" % i, location="Caja 1",
+                created_by=self.user, updated_by=self.user)
+        recorder = middleware.QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for article in Article.objects.all():
+                article.created_by.username
+        self.assertEqual(recorder.count, 4)
+        self.assertEqual([count for count, _ in recorder.repeated(2)], [3])
+
+    @override_settings(SLOW_REQUEST_QUERIES=1)
+    def test_query_heavy_requests_are_warnings(self):
+        with self.assertLogs('managment.requests', logging.INFO) as logs:
+            self.list_articles()
+        self.assertEqual(logs.records[-1].levelno, logging.WARNING)
+        self.assertEqual(logs.records[-1].view, 'ArticleViewSet.list')
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(PROFILE_DIR=self.directory.name, PROFILE_INTERVAL=0.001)
+        self.settings.enable()
+        self.staff = get_user_model().objects.create(username='staff', is_staff=True)
+        self.user = get_user_model().objects.create(username='testuser@gmail.com')
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def earnings(self, user, **extra):
+        # The middleware authenticates the token itself, before the view
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token %s' % token.key)
+        today = timezone.localdate().isoformat()
+        return self.client.post('/api/getEarnings', {
+            'dateFrom': today, 'dateTo': today, 'dateType': 'day'}, **extra)
+
+    def test_staff_request_is_profiled(self):
+        res = self.earnings(self.staff, HTTP_X_PROFILE='1')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        profile_id = res['X-Profile']
+        res = self.client.get('/api/getProfiles')
+        self.assertEqual([profile['id'] for profile in res.data['profiles']], [profile_id])
+        self.assertEqual(res.data['profiles'][0]['view'], 'getEarnings')
+        res = self.client.get('/api/getProfiles', {'id': profile_id})
+        self.assertEqual(res['Content-Type'], 'text/plain')
+        for line in res.content.decode().splitlines():
+            self.assertRegex(line, r'^\S.* \d+$')
+        res = self.client.get('/api/getProfiles', {'id': '../settings'})
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_users_are_not_profiled(self):
+        res = self.earnings(self.user, HTTP_X_PROFILE='1')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile', res)
+        self.assertEqual(os.listdir(self.directory.name), [])
+        res = self.client.get('/api/getProfiles')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_sampler_only_starts_for_staff(self):
+        with mock.patch.object(profiling, 'Sampler') as sampler:
+            self.earnings(self.user, HTTP_X_PROFILE='1')
+            self.client.credentials()
+            self.client.post('/api/getEarnings?profile=1', {})
+            self.client.post('/api/getEarnings?profile=1', {}, HTTP_AUTHORIZATION='Token nope')
+        sampler.assert_not_called()
+
+    def test_old_profiles_expire(self):
+        res = self.earnings(self.staff, HTTP_X_PROFILE='1')
+        for name in os.listdir(self.directory.name):
+            os.utime(os.path.join(self.directory.name, name), (0, 0))
+        self.assertEqual(profiling.list_profiles(), [])
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_sampler_summary(self):
+        sampler = profiling.Sampler(0, 0.001)
+        sampler.stacks.update({('main', 'view', 'query'): 3, ('main', 'view'): 1})
+        self.assertEqual(sampler.collapsed(), 'main;view;query 3\nmain;view 1\n')
+        self.assertEqual(sampler.top(), [{'function': 'view', 'self': 1, 'total': 4},
+                                         {'function': 'query', 'self': 3, 'total': 3}])
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(METRICS_DIR=self.directory.name)
+        self.settings.enable()
+        metrics.registry.clear()
+        self.staff = get_user_model().objects.create(username='staff', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_requests_are_recorded_by_action(self):
+        self.client.get('/api/articles/')
+        self.client.get('/api/getTotals')
+        self.client.get('/api/getTotals')
+        res = self.client.get('/api/getMetrics')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        text = res.content.decode()
+        self.assertIn('inventory_requests_total{status="200",view="ArticleViewSet.list"} 1\n', text)
+        self.assertIn('inventory_request_duration_seconds_count{view="getTotals"} 2\n', text)
+        self.assertIn('inventory_request_duration_seconds_bucket{view="getTotals",le="+Inf"} 2\n', text)
+        self.assertIn('inventory_cache_requests_total{cache="totals",result="hit"} 1\n', text)
+        self.assertIn('inventory_cache_requests_total{cache="totals",result="miss"} 1\n', text)
+        self.assertIn('# TYPE inventory_allocation_retries_total counter\n', text)
+
+    def test_processes_are_summed(self):
+        metrics.inc('inventory_allocation_retries_total', view='SaleViewSet.create')
+        metrics.observe('inventory_request_queries', 3, view='SaleViewSet.create')
+        with open(os.path.join(self.directory.name, '1-worker.json'), 'w') as file:
+            json.dump({
+                'counters': [['inventory_allocation_retries_total',
+                              [['view', 'SaleViewSet.create']], 2]],
+                'histograms': [['inventory_request_queries', [['view', 'SaleViewSet.create']],
+                                [0, 0, 1, 1, 1, 1, 1, 1, 1, 4, 1]]],
+            }, file)
+        text = metrics.render()
+        self.assertIn('inventory_allocation_retries_total{view="SaleViewSet.create"} 3\n', text)
+        self.assertIn('inventory_request_queries_bucket{view="SaleViewSet.create",le="5"} 2\n', text)
+        self.assertIn('inventory_request_queries_sum{view="SaleViewSet.create"} 7\n', text)
+        self.assertIn('inventory_request_queries_count{view="SaleViewSet.create"} 2\n', text)
+
+    @override_settings(SQL_INSTRUMENTATION=False)
+    def test_requests_are_recorded_without_sql_instrumentation(self):
+        res = self.client.get('/api/getTotals')
+        self.assertNotIn('Server-Timing', res)
+        text = metrics.render()
+        self.assertIn('inventory_requests_total{status="200",view="getTotals"} 1\n', text)
+        self.assertIn('inventory_request_queries_count{view="getTotals"} 1\n', text)
+
+    def test_only_staff_reads_metrics(self):
+        user = get_user_model().objects.create(username='testuser@gmail.com')
+        self.client.force_authenticate(user)
+        res = self.client.get('/api/getMetrics')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TestImages(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        media = override_settings(MEDIA_ROOT=self.directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def test_process_image_writes_stripped_variants(self):
+        image = Image.new('RGB', size=(1200, 800), color=(155, 0, 0))
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera'
+        os.makedirs(os.path.join(self.directory.name, 'images'))
+        image.save(os.path.join(self.directory.name, 'images', 'photo.jpg'), 'jpeg', exif=exif)
+        article = Article.objects.create(
+            name="Articulo 1", sku="ART1331", location="Caja 1",
+            suggested_price=350.65, image='images/photo.jpg',
+            created_by=self.user, updated_by=self.user
+        )
+        self.assertEqual(ArticleSerializer(article).data['image_variants'], {})
+
+        images.process_image('images/photo.jpg')
+
+        thumb = Image.open(os.path.join(self.directory.name, 'images', 'photo_thumb.jpg'))
+        self.assertEqual(thumb.size, (160, 107))
+        self.assertEqual(len(thumb.getexif()), 0)
+        medium = Image.open(os.path.join(self.directory.name, 'images', 'photo_medium.webp'))
+        self.assertEqual(medium.format, 'WEBP')
+        self.assertEqual(medium.size, (640, 427))
+
+        article.refresh_from_db()
+        with mock.patch('inventory.serializers.default_storage.exists') as exists:
+            variants = ArticleSerializer(article).data['image_variants']
+        exists.assert_not_called()
+        self.assertEqual(variants['thumb'], '/media/images/photo_thumb.jpg')
+        self.assertEqual(variants['medium_webp'], '/media/images/photo_medium.webp')
+
+    def test_image_changed(self):
+        article = Article.objects.create(
+            name="Articulo 1", sku="ART1331", location="Caja 1",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        article = Article.objects.get(pk=article.pk)
+        self.assertFalse(article.image_changed())
+        article.image = 'images/photo.png'
+        self.assertTrue(article.image_changed())
+
+    @mock.patch.object(images, 'schedule')
+    def test_uploads_are_named_by_content(self, schedule):
+        content = io.BytesIO()
+        Image.new('RGB', size=(10, 10)).save(content, 'png')
+        names = []
+        for sku in ('ART1', 'ART2'):
+            article = Article(name=sku, sku=sku, location="Caja 1",
+                              created_by=self.user, updated_by=self.user)
+            article.image.save('Photo.PNG', ContentFile(content.getvalue()), save=False)
+            names.append(article.image.name)
+        self.assertRegex(names[0], r'^images/Photo\.[0-9a-f]{12}\.png$')
+        # Same content, same hash, the storage makes the name unique
+        self.assertTrue(names[1].startswith(names[0][:-len('.png')]))
+
+    def test_workers_close_their_obsolete_connections(self):
+        closed = []
+
+        def close_if_unusable_or_obsolete(wrapper):
+            closed.append(threading.current_thread().name)
+
+        wrapper = type(connections['default'])
+        with mock.patch.object(images, 'process_image', side_effect=OSError), \
+                mock.patch.object(wrapper, 'close_if_unusable_or_obsolete', close_if_unusable_or_obsolete):
+            with self.assertRaises(OSError):
+                images.schedule('images/missing.png').result()
+        self.assertTrue(closed)
+        self.assertTrue(all(name.startswith('images') for name in closed))
+
+
+class TestSinglePageApplication(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index = os.path.join(self.directory.name, 'index.html')
+        self.write_index('<html><body>%s</body></html>' % ('Inventario ' * 100))
+        spa = override_settings(SPA_INDEX=self.index, DEBUG=True)
+        spa.enable()
+        self.addCleanup(spa.disable)
+
+    def write_index(self, content):
+        with open(self.index, 'w') as file:
+            file.write(content)
+        # The shell is reloaded when the modification time changes
+        stat = os.stat(self.index)
+        os.utime(self.index, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_shell_is_revalidated_by_etag(self):
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(b'Inventario', res.content)
+        self.assertEqual(res['Cache-Control'], 'no-cache')
+        res = self.client.get('/', HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res.content, b'')
+
+        self.write_index('<html><body>Nuevo</body></html>')
+        res = self.client.get('/', HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(b'Nuevo', res.content)
+
+    def test_shell_is_precompressed(self):
+        plain = self.client.get('/')
+        res = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res['Vary'])
+        self.assertNotEqual(res['ETag'], plain['ETag'])
+        self.assertEqual(gzip.decompress(res.content), plain.content)
+        res = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=plain['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_hashed_static_files(self):
+        root = os.path.join(self.directory.name, 'static')
+        os.makedirs(os.path.join(root, 'js'))
+        for name in ('main.3fb070cc.chunk.js', 'manifest.js'):
+            with open(os.path.join(root, 'js', name), 'w') as file:
+                file.write('var inventory = 1;' * 100)
+        storage = BuildStaticFilesStorage(location=root)
+        processed = list(storage.post_process({}))
+        self.assertEqual(len(processed), 1)
+        self.assertTrue(os.path.exists(os.path.join(root, 'js', 'main.3fb070cc.chunk.js.gz')))
+        self.assertFalse(os.path.exists(os.path.join(root, 'js', 'manifest.js.gz')))
+        # Compressed copies are written once
+        self.assertEqual(list(storage.post_process({})), [])
+
+        immutable = re.compile(settings.WHITENOISE_IMMUTABLE_FILE_TEST)
+        self.assertTrue(immutable.search('/static/js/main.3fb070cc.chunk.js'))
+        self.assertTrue(immutable.search('/static/admin/css/base.5af66c1b1797.css'))
+        self.assertFalse(immutable.search('/static/manifest.json'))
+
+
+class TestArticleImport(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+
+    def test_import_upserts_by_sku(self):
+        article = Article.objects.create(
+            name="Articulo 1", sku="ART1", location="Caja 1",
+            suggested_price=100, created_by=self.user, updated_by=self.user
+        )
+        Stock.objects.create(article=article, quantity=3, cost=10,
+                             created_by=self.user, updated_by=self.user)
+        Stock.objects.create(article=article, quantity=2, cost=20,
+                             created_by=self.user, updated_by=self.user)
+        rows = io.StringIO(
+            "sku,name,location,suggested_price,quantity,cost\n"
+            "ART1,Articulo uno,Caja 9,120,5,12\n"
+            "ART2,Articulo 2,Caja 2,50,4,25.5\n"
+            "ART3,Articulo 3,Caja 3,,,\n"
+            "ART4,Articulo 2,Caja 4,10,1,1\n"
+            "ART5,Articulo 5,,abc,-1,1\n")
+        result = importer.ArticleImporter(self.user, chunk_size=2).run(
+            importer.read_rows(rows, 'csv'))
+        self.assertEqual((result['created'], result['updated']), (2, 1))
+        self.assertEqual((result['stock_created'], result['stock_updated']), (1, 1))
+        self.assertEqual([error['row'] for error in result['errors']], [5, 6])
+        self.assertIn('name', result['errors'][0]['errors'])
+        self.assertEqual(set(result['errors'][1]['errors']),
+                         {'location', 'suggested_price', 'quantity'})
+
+        article.refresh_from_db()
+        self.assertEqual((article.name, article.location), ("Articulo uno", "Caja 9"))
+        self.assertEqual(article.stock_quantity, 7)
+        self.assertEqual(article.stock_value, Decimal('100.00'))
+        created = Article.objects.get(sku="ART2")
+        self.assertEqual(created.stock_quantity, 4)
+        self.assertEqual(created.stock_value, Decimal('102.00'))
+        self.assertEqual(Article.objects.get(sku="ART3").stock_article.count(), 0)
+        self.assertEqual(Article.rebuild_stock_counters(commit=False), [])
+        res = self.client.get('/api/articles/', {'search': 'uno'})
+        self.assertEqual([row['sku'] for row in res.data['results']], ['ART1'])
+
+    def test_import_keeps_opening_stock_that_was_sold_from(self):
+        rows = "sku,name,location,quantity,cost\nART1,Articulo 1,Caja 1,%s,10\nART2,Articulo 2,Caja 2,%s,10\n"
+        importer.ArticleImporter(self.user).run(importer.read_rows(io.StringIO(rows % (5, 5)), 'csv'))
+        allocation.sell(Article.objects.get(sku="ART1").id, 5, 50, self.user)
+
+        result = importer.ArticleImporter(self.user).run(
+            importer.read_rows(io.StringIO(rows % (8, 8)), 'csv'))
+        self.assertEqual((result['stock_updated'], result['stock_skipped']), (1, 1))
+        self.assertEqual([(error['row'], error['sku']) for error in result['errors']], [(2, 'ART1')])
+        self.assertEqual(Article.objects.get(sku="ART1").stock_quantity, 0)
+        self.assertEqual(Article.objects.get(sku="ART2").stock_quantity, 8)
+        self.assertEqual(Article.rebuild_stock_counters(commit=False), [])
+
+    def test_import_endpoint(self):
+        upload = io.BytesIO(
+            b'{"sku": "ART1", "name": "Articulo 1", "location": "Caja 1", "quantity": 2, "cost": 5}\n'
+            b'not json\n')
+        upload.name = 'catalog.jsonl'
+        res = self.client.post('/api/articles/import/', {'file': upload}, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['created'], 1)
+        self.assertEqual(res.data['errors'][0]['row'], 2)
+        self.assertEqual(Article.objects.get(sku="ART1").stock_quantity, 2)
+
+        res = self.client.post('/api/articles/import/', {}, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.csv')
+            with open(path, 'w') as file:
+                file.write("sku,name,location,quantity,cost\nART1,Articulo 1,Caja 1,3,2\n")
+            out = io.StringIO()
+            call_command('import_articles', path, user=self.user.username, stdout=out)
+        self.assertIn("1 articles created", out.getvalue())
+        self.assertEqual(Article.objects.get(sku="ART1").stock_value, Decimal('6.00'))
+
+
+class TestExports(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+        self.article = Article.objects.create(
+            name="Articulo 1", sku="ART1", location="Caja 1",
+            suggested_price=100, created_by=self.user, updated_by=self.user
+        )
+        self.stock = Stock.objects.create(
+            article=self.article, quantity=10, cost=20,
+            created_by=self.user, updated_by=self.user)
+        for day, quantity in (('2020-01-10', 1), ('2020-02-10', 2), ('2020-03-10', 3)):
+            sale = Sale.objects.create(stock=self.stock, quantity=quantity, price=50,
+                                       created_by=self.user, updated_by=self.user)
+            Sale.objects.filter(pk=sale.pk).update(
+                created_at=parse_datetime('%sT12:00:00Z' % day))
+
+    def read(self, response):
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_sales_csv_export(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/api/sales/export/', {
+                'dateFrom': '2020-02-01', 'dateTo': '2020-03-10'})
+            content = self.read(res)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([row['quantity'] for row in rows], ['2', '3'])
+        self.assertEqual(rows[0]['article'], "Articulo 1")
+        self.assertEqual((rows[0]['net'], rows[0]['gross']), ('100.00', '60.00'))
+        # Only the export query, whatever the number of rows
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'inventory_sale' in q['sql']]), 1)
+
+    def test_jsonl_export_and_status_filter(self):
+        Article.objects.filter(pk=self.article.pk).update(status=False)
+        res = self.client.get('/api/articles/export/', {'type': 'jsonl', 'status': 'false'})
+        rows = [json.loads(line) for line in self.read(res).splitlines()]
+        self.assertEqual([row['sku'] for row in rows], ['ART1'])
+        self.assertEqual(rows[0]['quantity'], 10)
+        res = self.client.get('/api/stocks/export/', {'type': 'xml'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestValuation(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create(
+            username='testuser@gmail.com',
+            password='testpassw00rd'
+        )
+        self.client.force_authenticate(self.user)
+        self.article = Article.objects.create(
+            name="Articulo 9", sku="ART9", location="Caja 9",
+            suggested_price=350.65, created_by=self.user, updated_by=self.user
+        )
+        for cost, day in ((10, '2020-01-01'), (20, '2020-01-02')):
+            stock = Stock.objects.create(article=self.article, quantity=3,
+                                         cost=cost, created_by=self.user, updated_by=self.user)
+            Stock.objects.filter(pk=stock.pk).update(
+                created_at=parse_datetime('%sT12:00:00Z' % day))
+        self.sales = allocation.sell(self.article.id, 4, 50, self.user, policy='FIFO')
+
+    def test_consumption_is_recorded_per_layer(self):
+        consumed = LayerConsumption.objects.order_by('id')
+        self.assertEqual([(row.quantity, row.unit_cost, row.cost) for row in consumed],
+                         [(3, Decimal('10.00'), Decimal('30.00')),
+                          (1, Decimal('20.00'), Decimal('20.00'))])
+        self.assertEqual([row.sale_id for row in consumed], [sale.pk for sale in self.sales])
+
+    def test_inventory_value_as_of_date(self):
+        now = valuation.inventory_value()
+        self.assertEqual((now['quantity'], now['value']), (2, Decimal('40.00')))
+        before_sale = valuation.inventory_value(parse_datetime('2020-01-03T00:00:00Z'))
+        self.assertEqual((before_sale['quantity'], before_sale['value']), (6, Decimal('90.00')))
+        first_layer = valuation.inventory_value(parse_datetime('2020-01-01T23:00:00Z'))
+        self.assertEqual((first_layer['quantity'], first_layer['value']), (3, Decimal('30.00')))
+
+    def test_cost_of_goods_sold(self):
+        today = timezone.localdate().isoformat()
+        res = self.client.get('/api/getCogs', {'dateFrom': today, 'dateTo': today})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual((res.data['quantity'], res.data['cost']), (4, Decimal('50.00')))
+        self.sales[0].status = False
+        self.sales[0].save()
+        res = self.client.get('/api/getCogs', {
+            'dateFrom': today, 'dateTo': today, 'article': self.article.id})
+        self.assertEqual((res.data['quantity'], res.data['cost']), (1, Decimal('20.00')))
+        res = self.client.get('/api/getValuation', {'date': '2020-01-02'})
+        self.assertEqual(res.data['value'], Decimal('90.00'))
+        res = self.client.get('/api/getCogs', {'dateFrom': today})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestBenchmark(TestCase):
+    def setUp(self):
+        benchmark.seed(5, 10, 20, days=30)
+
+    def test_seeded_dataset(self):
+        self.assertEqual((Article.objects.count(), Stock.objects.count(), Sale.objects.count()),
+                         (5, 10, 20))
+        article = Article.objects.get(id=1)
+        active = Stock.objects.filter(article=article, status=True)
+        self.assertEqual(article.stock_quantity, sum(layer.quantity for layer in active))
+        self.assertTrue(DailySalesRollup.objects.exists())
+        sold = Sale.objects.filter(status=True)
+        cogs = valuation.cost_of_goods_sold(
+            sold.earliest('created_at').created_at, sold.latest('created_at').created_at)
+        self.assertEqual(cogs['quantity'], sum(sale.quantity for sale in sold))
+        self.assertEqual(cogs['cost'], sum(sale.quantity * sale.stock.cost for sale in sold))
+
+    def test_run_reports_every_scenario(self):
+        results = benchmark.run(requests=2)
+        self.assertEqual(set(results), {scenario.name for scenario in benchmark.SCENARIOS})
+        for result in results.values():
+            self.assertEqual(result['status'], [status.HTTP_200_OK])
+            self.assertLessEqual(result['p50_ms'], result['max_ms'])
+        report = benchmark.report({'articles': 5}, 0.5, results)
+        compared = benchmark.compare(json.loads(benchmark.dumps(report))['scenarios'], report)
+        self.assertEqual(compared['totals']['queries_change'], 0)
@@ -15,4 +15,9 @@ urlpatterns = [
     path("/getUser", views.getUser.as_view()),
     path("/getTotals", views.getTotals.as_view()),
     path("/getEarnings", views.getEarnings.as_view()),
+    path("/getCacheStats", views.getCacheStats.as_view()),
+    path("/getValuation", views.getValuation.as_view()),
+    path("/getCogs", views.getCogs.as_view()),
+    path("/getProfiles", views.getProfiles.as_view()),
+    path("/getMetrics", views.getMetrics.as_view()),
 ]
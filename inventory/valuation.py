@@ -0,0 +1,58 @@
+"""
+Inventory valuation
+Value of the stock and cost of goods sold computed from the stock layers
+and the per-layer consumption records written by the allocation engine.
+The cost flow is the one of STOCK_ALLOCATION_POLICY, every unit is valued
+at the cost of the layer it was actually taken from.
+"""
+from decimal import Decimal
+from django.db.models import F, Sum, DecimalField
+from django.utils import timezone
+from .models import Stock, LayerConsumption, CENTS
+
+
+def money(value):
+    return Decimal(value or 0).quantize(CENTS)
+
+
+def inventory_value(as_of=None, article=None):
+    """
+    Returns the quantity and value of the stock on hand at as_of (now by
+    default), optionally of one article. That is what remains today in the
+    layers created until then, plus what was consumed from them since.
+    """
+    if as_of is None:
+        as_of = timezone.now()
+    layers = Stock.objects.filter(status=True, created_at__lte=as_of)
+    consumed = LayerConsumption.objects.filter(
+        created_at__gt=as_of, stock__created_at__lte=as_of)
+    if article is not None:
+        layers = layers.filter(article=article)
+        consumed = consumed.filter(article=article)
+    remaining = layers.aggregate(
+        quantity=Sum('quantity'),
+        value=Sum(F('quantity') * F('cost'), output_field=DecimalField()))
+    consumed = consumed.aggregate(quantity=Sum('quantity'), value=Sum('cost'))
+    return {
+        'date': as_of,
+        'quantity': (remaining['quantity'] or 0) + (consumed['quantity'] or 0),
+        'value': money(remaining['value']) + money(consumed['value']),
+    }
+
+
+def cost_of_goods_sold(date_from, date_to, article=None):
+    """
+    Returns the quantity sold and its cost between two datetimes, summing
+    the consumption of the active sales.
+    """
+    consumed = LayerConsumption.objects.filter(
+        created_at__gte=date_from, created_at__lte=date_to, sale__status=True)
+    if article is not None:
+        consumed = consumed.filter(article=article)
+    totals = consumed.aggregate(quantity=Sum('quantity'), cost=Sum('cost'))
+    return {
+        'dateFrom': date_from,
+        'dateTo': date_to,
+        'quantity': totals['quantity'] or 0,
+        'cost': money(totals['cost']),
+    }
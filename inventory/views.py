@@ -1,53 +1,78 @@
 from django.shortcuts import render
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .serializers import ArticleSerializer, StockSerializer, SaleSerializer, OrderSerializer, UserSerializer
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from .serializers import ArticleSerializer, StockSerializer, SaleSerializer, OrderSerializer, UserSerializer, SaleLineSerializer
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from django.http import HttpResponse
 from django.core.exceptions import ValidationError
-from django.db.models import Sum, F, DecimalField, IntegerField
+from django.db.models import Q, Sum
 from django.contrib.auth import get_user_model
 from .models import Article, Stock, Sale, Order
+from . import allocation, importer
+from .search import SearchMixin
+from .pagination import KeysetPagination
+from .reports import earnings_report, parse_report_date
+from .valuation import inventory_value, cost_of_goods_sold
+from .caching import totals_cache
+from .conditional import ConditionalGetMixin
+from .exports import ExportMixin
+from .ordering import SortableMixin
+from .replicas import ReplicaReadMixin
+from .authentication import CachedTokenAuthentication
+from managment import metrics, profiling
 import logging
 import copy
 
 views_logger = logging.getLogger(__name__)
+# Request payloads and responses, sampled by the logging configuration
+payload_logger = logging.getLogger('inventory.views.payload')
 User = get_user_model()
 
 
-class ArticleViewSet(viewsets.ModelViewSet):
+class ArticleViewSet(ConditionalGetMixin, SearchMixin, SortableMixin, ExportMixin, ReplicaReadMixin,
+                     viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
     """
     serializer_class = ArticleSerializer
+    stamp_models = (Article, Stock)
+    export_name = 'articles'
+    replica_reads = ('list', 'export')
+    sortable_fields = {
+        'created_at': 'created_at',
+        'updated_at': 'updated_at',
+        'name': 'name',
+        'sku': 'sku',
+        'location': 'location',
+        'suggested_price': 'suggested_price',
+    }
     permission_classes = [IsAuthenticated]
-    authentication_classes = (TokenAuthentication,)
-    pagination_class = PageNumberPagination
+    authentication_classes = (CachedTokenAuthentication,)
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         search = self.request.query_params.get('search', "")
-        orderField = self.request.query_params.get('order', 'created_at')
-        orderType = self.request.query_params.get('type', "")
-        queryset = Article.objects.filter(status=True, name__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Article.objects.filter(status=True, sku__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Article.objects.filter(status=True, location__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Article.objects.filter(status=True, created_at__icontains=search).order_by(
-            '%s%s' % (orderType, orderField))
-        return queryset
+        queryset = Article.objects.filter(status=True)
+        if search:
+            queryset = self.search(queryset, 'article', search)
+        if search and not self.has_sort():
+            queryset = queryset.order_by('search_rank')
+        else:
+            queryset = queryset.order_by(self.sort)
+        return ArticleSerializer.setup_eager_loading(queryset)
 
     def create(self, request, *args, **kwargs):
         try:
             views_logger.info("%s IS CREATING AN ARTICLE", self.request.user)
             payload = copy.copy(request.data)
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['created_by'] = self.request.user.pk
             payload['updated_by'] = self.request.user.pk
             payload['status'] = True
-            views_logger.info("%s IS CREATING AN ARTICLE", payload)
+            payload_logger.info("%s IS CREATING AN ARTICLE", payload)
             serializer = ArticleSerializer(data=payload)
             serializer.is_valid(raise_exception=True)
             serializer.save()
@@ -82,7 +107,7 @@ class ArticleViewSet(viewsets.ModelViewSet):
         try:
             views_logger.info("START PARTIAL UPDATE ARTICLE")
             payload = request.data
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['updated_by'] = self.request.user.pk
             article = Article.objects.get(id=pk)
             serializer = ArticleSerializer(
@@ -90,24 +115,49 @@ class ArticleViewSet(viewsets.ModelViewSet):
             serializer.is_valid(raise_exception=True)
             serializer.save()
             views_logger.info("ARTICLE UPDATED SUCCESSFULLY")
-            views_logger.info(serializer.data)
+            payload_logger.info("%s", serializer.data)
             return Response(serializer.data)
         except ValidationError as error:
             views_logger.error("ERROR WHILE UPDATING ARTICLE %s" % error)
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_articles(self, request):
+        """
+        Upserts by sku the articles of an uploaded CSV or JSON lines file,
+        sent as the file field, with their opening stock. Answers with the
+        totals and the errors of every row that was not imported.
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'message': 'Falta el archivo.'}, status.HTTP_400_BAD_REQUEST)
+        format = request.data.get('type') or importer.guess_format(upload.name)
+        if format not in importer.FORMATS:
+            return Response({'message': 'Formato desconocido.'}, status.HTTP_400_BAD_REQUEST)
+        views_logger.info("%s IS IMPORTING ARTICLES FROM %s", self.request.user, upload.name)
+        rows = importer.read_rows(importer.text_stream(upload.file), format)
+        try:
+            result = importer.ArticleImporter(self.request.user).run(rows)
+        except UnicodeDecodeError as error:
+            views_logger.error("ERROR WHILE IMPORTING ARTICLES %s", error)
+            return Response({'message': 'El archivo no es UTF-8.'}, status.HTTP_400_BAD_REQUEST)
+        views_logger.info("ARTICLES IMPORTED SUCCESSFULLY")
+        return Response(result)
+
 
-class StockViewSet(viewsets.ModelViewSet):
+class StockViewSet(ExportMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Stock.objects.all()
     serializer_class = StockSerializer
+    export_name = 'stock'
+    replica_reads = ('list', 'export')
     permission_classes = [IsAuthenticated]
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
 
     def create(self, request, *args, **kwargs):
         try:
             views_logger.info("%s IS CREATING AN STOCK", self.request.user)
             payload = copy.copy(request.data)
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['created_by'] = self.request.user.pk
             payload['updated_by'] = self.request.user.pk
             serializerStock = StockSerializer(data=payload)
@@ -120,89 +170,83 @@ class StockViewSet(viewsets.ModelViewSet):
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
 
-class SaleViewSet(viewsets.ModelViewSet):
+class SaleViewSet(ConditionalGetMixin, SortableMixin, ExportMixin, ReplicaReadMixin,
+                  viewsets.ModelViewSet):
     queryset = Sale.objects.all()
     serializer_class = SaleSerializer
-    pagination_class = PageNumberPagination
+    stamp_models = (Sale, Stock, Article)
+    export_name = 'sales'
+    replica_reads = ('list', 'export')
+    sortable_fields = {
+        'created_at': 'created_at',
+        'quantity': 'quantity',
+        'price': 'price',
+        # Sorted through a join, the article name is not indexed with the sale
+        'name': 'stock__article__name',
+    }
+    pagination_class = KeysetPagination
     permission_classes = [IsAuthenticated]
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
 
     def get_queryset(self):
         search = self.request.query_params.get('search', "")
-        orderField = self.request.query_params.get(
-            'order', 'created_at')
-        orderType = ''
-        if (orderField[0] == '-'):
-            orderType = '-'
-            orderField = orderField[1:]
-        if (orderField == 'name' or orderField == '-name'):
-            orderField = 'stock__article__name'
-        queryset = Sale.objects.filter(
-            status=True).order_by('%s%s' % (orderType, orderField))
-        queryset = Sale.objects.filter(status=True, quantity__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Sale.objects.filter(status=True, price__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Sale.objects.filter(status=True, created_at__icontains=search).order_by(
-            '%s%s' % (orderType, orderField))
-        return queryset
+        queryset = Sale.objects.filter(status=True)
+        if search:
+            queryset = queryset.filter(
+                Q(quantity__icontains=search) | Q(price__icontains=search) |
+                Q(created_at__icontains=search))
+        return queryset.order_by(self.sort)
 
     def create(self, request, *args, **kwargs):
         try:
             views_logger.info("START CREATING SALE")
-            views_logger.info("%s", request.data)
-            quantity = int(self.request.data['quantity'])
-            res = Stock.objects.filter(
-                article=self.request.data['article']).aggregate(article_total_stock=Sum('quantity'))
-            views_logger.info("TOTAL STOCK IS %s" %
-                              res['article_total_stock'])
-            if (res['article_total_stock'] >= quantity):
-                views_logger.info("ENOUGH STOCK TO CREATE SALE")
-                stocks = Stock.objects.filter(
-                    article=self.request.data['article']).order_by('-created_at')
-                i = 0
-                while (quantity > 0):
-                    new_quantity = stocks[i].quantity - quantity
-                    stock_payload = {'quantity': new_quantity,
-                                     'updated_by': self.request.user.pk}
-                    sale_payload = {
-                        'stock': stocks[i].pk,
-                        'price': request.data['price'],
-                        'quantity': quantity,
-                        'created_by': self.request.user.pk,
-                        'updated_by': self.request.user.pk
-                    }
-                    if (new_quantity < 0):
-                        quantity = abs(new_quantity)
-                        sale_payload['quantity'] = stocks[i].quantity
-                        stock_payload['quantity'] = 0
-                        stock_payload['status'] = False
-                    else:
-                        quantity = 0
-                        if (new_quantity == 0):
-                            stock_payload['status'] = False
-
-                    saleSerializer = SaleSerializer(data=sale_payload)
-                    stockSerializer = StockSerializer(
-                        stocks[i], data=stock_payload, partial=True)
-                    saleSerializer.is_valid(raise_exception=True)
-                    stockSerializer.is_valid(raise_exception=True)
-                    saleSerializer.save()
-                    stockSerializer.save()
-                    i += 1
-                    new_quantity = 0
-            else:
-                views_logger.info("CANT CREATE SALE, NOT ENOUGH STOCK")
-                return Response({'message': 'No hay stock suficiente.'}, status.HTTP_400_BAD_REQUEST)
-            views_logger.info("ARTICLE CREATED SUCCESSFULLY")
-            return Response(saleSerializer.data)
+            payload_logger.info("%s", request.data)
+            line = SaleLineSerializer(data=request.data)
+            line.is_valid(raise_exception=True)
+            sales = allocation.sell(user=self.request.user, **line.validated_data)
+            views_logger.info("SALE CREATED SUCCESSFULLY")
+            return Response(SaleSerializer(sales[-1]).data)
+        except allocation.NotEnoughStock:
+            views_logger.info("CANT CREATE SALE, NOT ENOUGH STOCK")
+            return Response({'message': 'No hay stock suficiente.'}, status.HTTP_400_BAD_REQUEST)
         except ValidationError as error:
-            views_logger.error("ERROR WHILE CREATING ARTICLE %s", error)
+            views_logger.error("ERROR WHILE CREATING SALE %s", error)
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def cart(self, request):
+        """
+        Sells a list of {article, quantity, price} lines at once. Either
+        every line is sold or none is.
+        """
+        try:
+            views_logger.info("START CREATING CART SALE")
+            payload_logger.info("%s", request.data)
+            lines = SaleLineSerializer(data=request.data, many=True, allow_empty=False)
+            lines.is_valid(raise_exception=True)
+            sales = allocation.sell_cart(
+                lines.validated_data, user=self.request.user)
+            views_logger.info("CART SALE CREATED SUCCESSFULLY")
+            return Response([
+                dict(line, sales=SaleSerializer(line_sales, many=True).data)
+                for line, line_sales in zip(lines.data, sales)
+            ])
+        except allocation.NotEnoughStock as error:
+            views_logger.info("CANT CREATE CART SALE, NOT ENOUGH STOCK")
+            return Response({
+                'message': 'No hay stock suficiente.',
+                'lines': [
+                    dict(line, error='No hay stock suficiente.'
+                         if line['article'] in error.articles else None)
+                    for line in lines.data
+                ]
+            }, status.HTTP_400_BAD_REQUEST)
+
     def partial_update(self, request, pk=None):
         try:
             views_logger.info("START PARTIAL UPDATE SALE")
             payload = request.data
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['updated_by'] = self.request.user.pk
             sale = Sale.objects.get(id=pk)
             serializer = SaleSerializer(
@@ -210,39 +254,46 @@ class SaleViewSet(viewsets.ModelViewSet):
             serializer.is_valid(raise_exception=True)
             serializer.save()
             views_logger.info("SALE UPDATED SUCCESSFULLY")
-            views_logger.info(serializer.data)
+            payload_logger.info("%s", serializer.data)
             return Response(serializer.data)
         except ValidationError as error:
             views_logger.error("ERROR WHILE UPDATING SALE %s" % error)
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, SearchMixin, SortableMixin, ReplicaReadMixin,
+                   viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
-    pagination_class = PageNumberPagination
+    stamp_models = (Order, Article)
+    replica_reads = ('list',)
+    sortable_fields = {
+        'created_at': 'created_at',
+        'updated_at': 'updated_at',
+        'state': 'state',
+        # Sorted through a join, the article name is not indexed with the order
+        'name': 'article__name',
+    }
+    pagination_class = KeysetPagination
     permission_classes = [IsAuthenticated]
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
 
     def get_queryset(self):
         search = self.request.query_params.get('search', "")
-        orderField = self.request.query_params.get('order', 'created_at')
-        orderType = ''
-        if (orderField[0] == '-'):
-            orderType = '-'
-            orderField = orderField[1:]
-        if (orderField == 'name' or orderField == '-name'):
-            orderField = 'article__name'
-        queryset = Order.objects.filter(status=True, state__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | Order.objects.filter(status=True, body__icontains=search).order_by(
-            '%s%s' % (orderType, orderField))
+        queryset = Order.objects.filter(status=True)
+        if search:
+            queryset = self.search(queryset, 'order', search)
+        if search and not self.has_sort():
+            queryset = queryset.order_by('search_rank')
+        else:
+            queryset = queryset.order_by(self.sort)
         return queryset
 
     def create(self, request, *args, **kwargs):
         try:
             views_logger.info("START CREATE ORDER %s" % self.request.user)
             payload = request.data
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['created_by'] = self.request.user.pk
             payload['updated_by'] = self.request.user.pk
             serializer = OrderSerializer(data=payload)
@@ -258,7 +309,7 @@ class OrderViewSet(viewsets.ModelViewSet):
         try:
             views_logger.info("START PARTIAL UPDATE ORDER")
             payload = request.data
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             payload['updated_by'] = self.request.user.pk
             order = Order.objects.get(id=pk)
             serializer = OrderSerializer(
@@ -266,41 +317,47 @@ class OrderViewSet(viewsets.ModelViewSet):
             serializer.is_valid(raise_exception=True)
             serializer.save()
             views_logger.info("ORDER UPDATED SUCCESSFULLY")
-            views_logger.info(serializer.data)
+            payload_logger.info("%s", serializer.data)
             return Response(serializer.data)
         except ValidationError as error:
             views_logger.error("ERROR WHILE UPDATING ORDER %s" % error)
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
 
-class UserViewset(viewsets.ModelViewSet):
+class UserViewset(SortableMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     # Viewset automatically provides "list" and "detail"
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    default_sort = 'date_joined'
+    replica_reads = ('list',)
+    sortable_fields = {
+        'date_joined': 'date_joined',
+        'username': 'username',
+        'email': 'email',
+    }
     permission_classes = [IsAuthenticated]
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
 
     def get_queryset(self):
         search = self.request.query_params.get('search', "")
-        orderField = self.request.query_params.get('order', 'date_joined')
-        orderType = ''
-        queryset = User.objects.filter(is_active=True, username__icontains=search).order_by(
-            '%s%s' % (orderType, orderField)) | User.objects.filter(is_active=True, email__icontains=search).order_by(
-            '%s%s' % (orderType, orderField))
-        return queryset
+        queryset = User.objects.filter(is_active=True)
+        if search:
+            queryset = queryset.filter(
+                Q(username__icontains=search) | Q(email__icontains=search))
+        return queryset.order_by(self.sort)
 
     def partial_update(self, request, pk=None):
         try:
             views_logger.info("START PARTIAL UPDATE USER")
             payload = request.data
-            views_logger.info("%s", payload)
+            payload_logger.info("%s", payload)
             user = User.objects.get(id=pk)
             serializer = UserSerializer(
                 user, data=payload, partial=True)
             serializer.is_valid(raise_exception=True)
             serializer.save()
             views_logger.info("USER UPDATED SUCCESSFULLY")
-            views_logger.info(serializer.data)
+            payload_logger.info("%s", serializer.data)
             return Response(serializer.data)
         except ValidationError as error:
             views_logger.error("ERROR WHILE UPDATING USER %s" % error)
@@ -314,16 +371,19 @@ class getUser(APIView):
         if 'token' not in request.data:
             return Response({'message': 'Please enter token'})
         data = request.data
-        token = Token.objects.get(key=data['token'])
-        User = UserSerializer(token.user)
+        user, token = CachedTokenAuthentication().authenticate_credentials(data['token'])
+        User = UserSerializer(user)
         return Response(User.data)
 
 
 class getTotals(APIView):
+    # Cached totals are shared by every user, they are never read from a
+    # lagging replica
+
     def get(self, request, format=None):
         try:
-            res = Stock.objects.filter(article__status=True,
-                                       status=True).aggregate(stock_total=Sum('quantity'), price_total=(Sum(F('quantity') * F('cost'), output_field=DecimalField())))
+            res = totals_cache.get_or_compute(lambda: Article.objects.filter(status=True).aggregate(
+                stock_total=Sum('stock_quantity'), price_total=Sum('stock_value')))
             # res2 = Stock.objects.filter(
             # status=True).aggregate(total=(Sum(F('quantity') * F('cost'))))['total']
             return Response(res)
@@ -332,7 +392,47 @@ class getTotals(APIView):
             return Response({'message': error.as_json}, status.HTTP_400_BAD_REQUEST)
 
 
-class getEarnings(APIView):
+class getCacheStats(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        return Response({'totals': totals_cache.stats()})
+
+
+class getProfiles(APIView):
+    """
+    Lists the stored request profiles, or returns the collapsed stacks of
+    one given its id, or its summary with type=json.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        profile_id = request.query_params.get('id', None)
+        if profile_id is None:
+            return Response({'profiles': profiling.list_profiles()})
+        kind = request.query_params.get('type', 'collapsed')
+        content = profiling.read_profile(profile_id, kind)
+        if content is None:
+            return Response({'message': "Profile %s not found" % profile_id},
+                            status.HTTP_404_NOT_FOUND)
+        return HttpResponse(
+            content, content_type='application/json' if kind == 'json' else 'text/plain')
+
+
+class getMetrics(APIView):
+    """
+    Metrics of every worker process in the Prometheus text format.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
+class getEarnings(ReplicaReadMixin, APIView):
+    # A report, it only reads even if the range is posted
+    replica_reads = ('post',)
+
     def post(self, request, format=None):
         try:
             if 'dateFrom' not in request.data.keys() or 'dateTo' not in request.data.keys():
@@ -340,27 +440,49 @@ class getEarnings(APIView):
             dateFrom = self.request.data.get('dateFrom', None)
             dateTo = self.request.data.get('dateTo', None)
             dateType = self.request.data.get('dateType', None)
-            sales = Sale.objects.filter(
-                status=True, created_at__gte=dateFrom, created_at__lte=dateTo)
-            labels = []
-            earnings_data = []
-            quantity_data = []
-            earnings_total = 0
-            quantity_total = 0
-            import datetime
-            for el in sales:
-                cost = el.stock.cost
-                labels.append(el.created_at.strftime("%d/%b/%Y"))
-                earnings_data.append(
-                    (el.quantity*el.price) - (el.quantity*cost))
-                quantity_data.append(el.quantity)
-                earnings_total += (el.quantity*el.price) - (el.quantity*cost)
-                quantity_total += el.quantity
             return Response(
-                {"labels": labels, "earnings": earnings_data, "quantity": quantity_data,
-                    "quantity_total": quantity_total, "earnings_total": earnings_total},
+                earnings_report(dateFrom, dateTo, dateType),
                 status.HTTP_200_OK
             )
         except ValidationError as error:
             views_logger.error("ERROR GET EARNINGS %s" % error)
             return Response({'message': error.message}, status.HTTP_400_BAD_REQUEST)
+
+
+def article_param(request):
+    article = request.query_params.get('article', None)
+    if article is not None and not article.isdigit():
+        raise ValidationError("Invalid article %s" % article)
+    return article
+
+
+class getValuation(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    replica_reads = ('get',)
+
+    def get(self, request, format=None):
+        try:
+            date = request.query_params.get('date', None)
+            return Response(inventory_value(
+                parse_report_date(date, end_of_day=True) if date else None,
+                article=article_param(request)))
+        except ValidationError as error:
+            views_logger.error("ERROR GET VALUATION %s" % error)
+            return Response({'message': error.message}, status.HTTP_400_BAD_REQUEST)
+
+
+class getCogs(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    replica_reads = ('get',)
+
+    def get(self, request, format=None):
+        try:
+            if 'dateFrom' not in request.query_params or 'dateTo' not in request.query_params:
+                raise ValidationError("Please provide dateFrom and dateTo")
+            return Response(cost_of_goods_sold(
+                parse_report_date(request.query_params['dateFrom']),
+                parse_report_date(request.query_params['dateTo'], end_of_day=True),
+                article=article_param(request)))
+        except ValidationError as error:
+            views_logger.error("ERROR GET COGS %s" % error)
+            return Response({'message': error.message}, status.HTTP_400_BAD_REQUEST)
@@ -2,6 +2,9 @@
 ASGI config for managment project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Views run in a pool of ASGI_THREADS threads per process, see
+managment.handlers. Serve it with any ASGI server, for example
+``gunicorn managment.asgi -k uvicorn.workers.UvicornWorker``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -9,8 +12,12 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'managment.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from .handlers import ThreadPoolASGIHandler  # noqa: E402
+
+application = ThreadPoolASGIHandler()
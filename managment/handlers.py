@@ -0,0 +1,165 @@
+"""
+ASGI handler
+Django 3.0 has no async views. Its ASGI handler runs each view in the
+unbounded default executor of the event loop, and it iterates streaming
+responses such as the exports in the event loop itself, where the ORM
+refuses to run.
+This handler serves each request in a pool of ASGI_THREADS threads,
+which bounds the ORM work and the database connections of a process. The
+thread that runs the view also produces its response, streaming or not.
+The chunks go through a small queue to the event loop, which sends them
+while it keeps serving many slow or waiting clients. The thread never
+waits for the client while it produces the response: the chunks that do
+not fit in the queue go to a spool file, and the response is closed,
+which releases its database connections, before the rest is sent. A
+client that disconnects stops the thread at its next chunk.
+"""
+import asyncio
+import contextvars
+import functools
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core import signals
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+from django.http import FileResponse
+from django.urls import set_script_prefix
+
+# Chunks of a response waiting to be sent
+QUEUE_SIZE = 8
+
+
+class ClientGone(Exception):
+    pass
+
+
+async def offer(queue, message):
+    """
+    Puts the message on the queue if it has room, returns whether it did.
+    """
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        return False
+    return True
+
+
+class ThreadPoolASGIHandler(ASGIHandler):
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.ASGI_THREADS, thread_name_prefix='asgi')
+
+    def run_sync(self, func, *args):
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+        return loop.run_in_executor(self.executor, functools.partial(context.run, func, *args))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError(
+                'Django can only handle ASGI/HTTP connections, not %s.' % scope['type'])
+        try:
+            body_file = await self.read_body(receive)
+        except RequestAborted:
+            return
+        set_script_prefix(self.get_script_prefix(scope))
+        queue = asyncio.Queue(QUEUE_SIZE)
+        gone = threading.Event()
+        watching = asyncio.ensure_future(self.watch_disconnect(receive, gone))
+        serving = self.run_sync(self.serve, asyncio.get_event_loop(), queue, gone, scope, body_file)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                if not gone.is_set():
+                    await send(message)
+        except BaseException:
+            # Unblock the serving thread, it stops at its next chunk
+            gone.set()
+            while await queue.get() is not None:
+                pass
+            raise
+        finally:
+            watching.cancel()
+            await serving
+
+    async def watch_disconnect(self, receive, gone):
+        """
+        Sets gone when the client disconnects, the only message that can
+        follow the body.
+        """
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        gone.set()
+
+    def serve(self, loop, queue, gone, scope, body_file):
+        """
+        Runs the request in a pool thread and puts the ASGI messages of its
+        response on the queue, then None. Streaming responses are produced
+        into the spool once the queue is full, and only sent from it after
+        the response is closed.
+        """
+        def put(message):
+            if gone.is_set():
+                raise ClientGone()
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def produce(chunk):
+            if gone.is_set():
+                raise ClientGone()
+            message = {'type': 'http.response.body', 'body': chunk, 'more_body': True}
+            if spool.tell() or not asyncio.run_coroutine_threadsafe(
+                    offer(queue, message), loop).result():
+                spool.write(chunk)
+
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, mode='w+b')
+        try:
+            signals.request_started.send(sender=self.__class__, scope=scope)
+            request, response = self.create_request(scope, body_file)
+            if request is not None:
+                response = self.get_response(request)
+            response._handler_class = self.__class__
+            if isinstance(response, FileResponse):
+                response.block_size = self.chunk_size
+            try:
+                try:
+                    put(self.start_message(response))
+                    if response.streaming:
+                        for part in response:
+                            for chunk, _ in self.chunk_bytes(part):
+                                produce(chunk)
+                finally:
+                    # Sends request_finished from the thread that used the
+                    # connections, before waiting for the client
+                    response.close()
+                if response.streaming:
+                    spool.seek(0)
+                    for chunk in iter(functools.partial(spool.read, self.chunk_size), b''):
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    put({'type': 'http.response.body'})
+                else:
+                    for chunk, last in self.chunk_bytes(response.content):
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': not last})
+            except ClientGone:
+                pass
+        finally:
+            spool.close()
+            asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    def start_message(self, response):
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return {'type': 'http.response.start', 'status': response.status_code, 'headers': headers}
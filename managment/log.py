@@ -0,0 +1,114 @@
+"""
+Logging pipeline
+Request threads only put records on a queue, a background thread writes
+them to the real handlers. Records are formatted as JSON lines before being
+queued, and noisy loggers can be sampled.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+from django.utils.module_loading import import_string
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+# Attributes every LogRecord has, anything else was passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the extra fields of
+    the record.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only a fraction of the records of the logger it is set on.
+    Records of level WARNING and above always pass.
+    """
+
+    def __init__(self, rate=1.0, name=''):
+        super().__init__(name)
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Queues the records for a background thread that hands them to the
+    target handler, given as a dict with its class and arguments.
+    When the queue is full records are dropped instead of blocking.
+    """
+
+    def __init__(self, target, queue_size=10000):
+        target = dict(target)
+        handler = import_string(target.pop('class'))(**target)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(
+            self.queue, handler, respect_handler_level=True)
+        self.listener.start()
+        with _listeners_lock:
+            _listeners.append(self.listener)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        stop_listener(self.listener)
+        super().close()
+
+
+def stop_listener(listener):
+    with _listeners_lock:
+        if listener not in _listeners:
+            return
+        _listeners.remove(listener)
+    listener.stop()
+
+
+def flush():
+    """
+    Writes every queued record and stops the background threads. Runs on
+    exit and from the gunicorn worker_exit hook.
+    """
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        stop_listener(listener)
+
+
+atexit.register(flush)
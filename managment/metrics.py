@@ -0,0 +1,237 @@
+"""
+Metrics
+Counters and histograms kept in memory by every process, labelled by the
+view or viewset action of the request they happen in. Each process writes
+a snapshot of its values to its own file in METRICS_DIR, at most every
+METRICS_FLUSH_INTERVAL seconds and when it exits, and the metrics endpoint
+sums the files of every process into the Prometheus text format.
+Files of workers that exited are kept until the server restarts, so
+totals do not go backwards when a worker is replaced.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from django.conf import settings
+
+metrics_logger = logging.getLogger(__name__)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'inventory_requests_total': (
+        'counter', "Requests by view and status.", None),
+    'inventory_request_duration_seconds': (
+        'histogram', "Time to respond to a request by view.",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    'inventory_request_queries': (
+        'histogram', "SQL queries run by a request by view.",
+        (1, 2, 5, 10, 20, 50, 100, 200, 500)),
+    'inventory_sql_seconds_total': (
+        'counter', "Time spent in SQL queries by view.", None),
+    'inventory_cache_requests_total': (
+        'counter', "Cache lookups by cache and result.", None),
+    'inventory_allocation_retries_total': (
+        'counter', "Sales retried because the database was locked, by view.", None),
+}
+
+_context = threading.local()
+
+
+def current_view():
+    return getattr(_context, 'view', None)
+
+
+def set_view(view):
+    _context.view = view
+
+
+class Registry:
+    """
+    Values of the metrics of this process by (name, labels), where labels
+    is a sorted tuple of (label, value) pairs. Histograms are stored as
+    their bucket counts followed by sum and count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.flushed_at = time.monotonic()
+        self.pid = None
+        self.name = None
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(values)]
+                               for (name, labels), values in self.histograms.items()],
+            }
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def file(self):
+        # A forked process starts a file of its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.name = '%s-%s.json' % (self.pid, uuid.uuid4().hex[:8])
+        return os.path.join(settings.METRICS_DIR, self.name)
+
+    def flush(self, force=False):
+        """
+        Writes the snapshot of this process when METRICS_FLUSH_INTERVAL
+        passed since the last one, or always when forced.
+        """
+        now = time.monotonic()
+        if not force and now - self.flushed_at < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.flushed_at = now
+        try:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            path = self.file()
+            with open(path + '.tmp', 'w') as file:
+                json.dump(self.snapshot(), file)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            metrics_logger.error("ERROR WRITING METRICS %s", error)
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def observe_request(view, status, duration, queries, sql_duration):
+    view = view or 'unknown'
+    registry.inc('inventory_requests_total', view=view, status=str(status))
+    registry.observe('inventory_request_duration_seconds', duration, view=view)
+    registry.observe('inventory_request_queries', queries, view=view)
+    registry.inc('inventory_sql_seconds_total', sql_duration, view=view)
+    registry.flush()
+
+
+def collect():
+    """
+    Returns the sum of the snapshots of every process, with the one of this
+    process written first.
+    """
+    registry.flush(force=True)
+    counters = defaultdict(float)
+    histograms = {}
+    if not os.path.isdir(settings.METRICS_DIR):
+        return counters, histograms
+    for name in os.listdir(settings.METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in snapshot['counters']:
+            counters[(metric, tuple(map(tuple, labels)))] += value
+        for metric, labels, values in snapshot['histograms']:
+            key = (metric, tuple(map(tuple, labels)))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = values
+    return counters, histograms
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() \
+        else str(int(value))
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, help, buckets) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(buckets, values):
+                lines.append('%s_bucket%s %s' % (
+                    name, format_labels(labels, le=bound), format_value(count)))
+            lines.append('%s_bucket%s %s' % (
+                name, format_labels(labels, le='+Inf'), format_value(values[-1])))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(values[-2])))
+            lines.append('%s_count%s %s' % (name, format_labels(labels), format_value(values[-1])))
+    return '\n'.join(lines) + '\n'
+
+
+def flush():
+    """
+    Writes the last values of this process. Runs on exit and from the
+    gunicorn worker_exit hook.
+    """
+    if registry.pid is not None or registry.counters or registry.histograms:
+        registry.flush(force=True)
+
+
+def reset():
+    """
+    Deletes the files of every process, from the gunicorn on_starting hook
+    so a restarted server starts counting from zero.
+    """
+    registry.clear()
+    if not os.path.isdir(settings.METRICS_DIR):
+        return
+    for name in os.listdir(settings.METRICS_DIR):
+        try:
+            os.remove(os.path.join(settings.METRICS_DIR, name))
+        except OSError:
+            pass
+
+
+atexit.register(flush)
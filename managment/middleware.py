@@ -0,0 +1,152 @@
+"""
+Request instrumentation
+Counts the SQL queries of every request and the time spent in them, with a
+database execute wrapper, and reports them in a Server-Timing header and a
+log record. Queries with the same SQL run many times in one request are
+reported as likely N+1 patterns. Requests over the thresholds are logged
+as warnings, named by their view and viewset action. The same numbers are
+recorded in the metrics of the view, by a middleware of their own that
+runs whether the SQL instrumentation is on or not.
+"""
+import logging
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from . import metrics
+
+requests_logger = logging.getLogger('managment.requests')
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper that sums the queries and their time, and
+    counts how many times each SQL template ran. Parameters are never
+    looked at, so one template covers every lookup of the same shape.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.templates = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.templates[sql] = self.templates.get(sql, 0) + 1
+
+    def repeated(self, threshold):
+        """
+        Returns the (count, sql) of the templates that ran at least
+        threshold times, most repeated first.
+        """
+        return sorted(((count, sql) for sql, count in self.templates.items()
+                       if count >= threshold), reverse=True)
+
+
+def view_name(view_func, method):
+    """
+    Name of a view for the logs, ArticleViewSet.list for viewset actions.
+    """
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__name__', type(view_func).__name__)
+    actions = getattr(view_func, 'actions', None)
+    if actions:
+        return '%s.%s' % (cls.__name__, actions.get(method.lower(), method.lower()))
+    return cls.__name__
+
+
+def record_queries(stack, recorder):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(recorder))
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the metrics of every request, by view, with the SQL queries
+    counted by a recorder that QueryInstrumentationMiddleware reuses.
+    Disabled with REQUEST_METRICS = False.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS', True):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = request.query_recorder = QueryRecorder()
+        started = time.perf_counter()
+        metrics.set_view(None)
+        with ExitStack() as stack:
+            record_queries(stack, recorder)
+            response = self.get_response(request)
+        metrics.observe_request(
+            getattr(request, 'instrumented_view', None), response.status_code,
+            time.perf_counter() - started, recorder.count, recorder.duration)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.instrumented_view = view_name(view_func, request.method)
+        metrics.set_view(request.instrumented_view)
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Adds Server-Timing db and total metrics to every response and logs one
+    record of every request. Disabled with SQL_INSTRUMENTATION = False.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_INSTRUMENTATION', True):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.slow_ms = settings.SLOW_REQUEST_MS
+        self.max_queries = settings.SLOW_REQUEST_QUERIES
+        self.repeated_threshold = settings.REPEATED_QUERY_THRESHOLD
+
+    def __call__(self, request):
+        recorder = getattr(request, 'query_recorder', None)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            if recorder is None:
+                recorder = QueryRecorder()
+                record_queries(stack, recorder)
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - started) * 1000
+        sql_ms = recorder.duration * 1000
+        response['Server-Timing'] = 'db;dur=%.1f;desc="%s queries", total;dur=%.1f' % (
+            sql_ms, recorder.count, total_ms)
+        self.log(request, response, recorder, total_ms, sql_ms)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.instrumented_view = view_name(view_func, request.method)
+
+    def log(self, request, response, recorder, total_ms, sql_ms):
+        repeated = recorder.repeated(self.repeated_threshold)
+        flagged = total_ms >= self.slow_ms or recorder.count >= self.max_queries or repeated
+        level = logging.WARNING if flagged else logging.INFO
+        if not requests_logger.isEnabledFor(level):
+            return
+        extra = {
+            'method': request.method,
+            'path': request.path,
+            'view': getattr(request, 'instrumented_view', None),
+            'status': response.status_code,
+            'duration_ms': round(total_ms, 1),
+            'sql_ms': round(sql_ms, 1),
+            'queries': recorder.count,
+        }
+        if repeated:
+            extra['repeated_queries'] = [
+                {'count': count, 'sql': sql} for count, sql in repeated[:3]]
+        if flagged:
+            requests_logger.warning("SLOW REQUEST %s %s", request.method, request.path, extra=extra)
+        else:
+            requests_logger.info("REQUEST %s %s", request.method, request.path, extra=extra)
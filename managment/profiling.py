@@ -0,0 +1,224 @@
+"""
+Request profiling
+A staff user can profile one request by sending the X-Profile header or
+the profile query param. Once the user is known to be staff, from the
+session or the API token, a background thread samples the stack of the
+request thread every PROFILE_INTERVAL seconds, so the request runs at
+nearly full speed. Samples are saved under PROFILE_DIR as a collapsed
+stack file, the input of flamegraph.pl and speedscope, and a JSON summary
+with the hottest functions. Profiles older than PROFILE_TTL are deleted.
+"""
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed
+
+profiling_logger = logging.getLogger(__name__)
+
+PROFILE_ID = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+TOP_FUNCTIONS = 30
+
+
+class Sampler:
+    """
+    Counts the stacks of one thread, sampled from another thread.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.labels = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self.stack(frame)] += 1
+
+    def stack(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(settings.BASE_DIR):
+                filename = os.path.relpath(filename, settings.BASE_DIR)
+            label = '%s (%s:%s)' % (code.co_name, filename, code.co_firstlineno)
+            # ; separates the frames in the collapsed format
+            label = label.replace(';', ':')
+            self.labels[code] = label
+        return label
+
+    def collapsed(self):
+        return ''.join('%s %s\n' % (';'.join(stack), count)
+                       for stack, count in self.stacks.most_common())
+
+    def top(self, limit=TOP_FUNCTIONS):
+        """
+        Returns the functions with most samples, as self samples on top of
+        the stack and total samples anywhere in it.
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        return [{'function': label, 'self': own[label], 'total': count}
+                for label, count in total.most_common()
+                if own[label]][:limit]
+
+
+def profile_dir():
+    return settings.PROFILE_DIR
+
+
+def expire():
+    """
+    Deletes the profile files older than PROFILE_TTL seconds.
+    """
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return
+    oldest = time.time() - settings.PROFILE_TTL
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def save(sampler, summary):
+    """
+    Writes the collapsed stacks and the summary of a profile, returning
+    its id.
+    """
+    expire()
+    os.makedirs(profile_dir(), exist_ok=True)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    profile_id = '%s-%s' % (now.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+    summary = dict(summary, id=profile_id, created_at=now.isoformat(), samples=sum(sampler.stacks.values()),
+                   interval_ms=sampler.interval * 1000, top=sampler.top())
+    with open(os.path.join(profile_dir(), profile_id + '.collapsed'), 'w') as file:
+        file.write(sampler.collapsed())
+    with open(os.path.join(profile_dir(), profile_id + '.json'), 'w') as file:
+        json.dump(summary, file, default=str)
+    return profile_id
+
+
+def list_profiles():
+    """
+    Returns the summaries of the stored profiles without their functions,
+    newest first.
+    """
+    expire()
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    summary = json.load(file)
+            except (OSError, ValueError):
+                continue
+            summary.pop('top', None)
+            profiles.append(summary)
+    return profiles
+
+
+def read_profile(profile_id, kind='collapsed'):
+    """
+    Returns the content of the collapsed or json file of a profile, or
+    None when there is no such profile.
+    """
+    if not PROFILE_ID.match(profile_id) or kind not in ('collapsed', 'json'):
+        return None
+    try:
+        with open(os.path.join(profile_dir(), '%s.%s' % (profile_id, kind))) as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def requested(request):
+    return 'HTTP_X_PROFILE' in request.META or 'profile' in request.GET
+
+
+def staff_user(request):
+    """
+    Returns the user of the session or the API token of a request when it
+    is staff, otherwise None. Token users come from the token cache, the
+    view finds them there again.
+    """
+    from inventory.authentication import CachedTokenAuthentication
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        try:
+            credentials = CachedTokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return None
+        user = credentials[0] if credentials else None
+    return user if user is not None and user.is_staff else None
+
+
+class ProfilingMiddleware:
+    """
+    Samples the requests of staff users that ask for a profile, every
+    other request passes straight through. The id of the profile is
+    returned in the X-Profile header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        user = staff_user(request) if requested(request) else None
+        if user is None:
+            return self.get_response(request)
+        sampler = Sampler(threading.get_ident(), settings.PROFILE_INTERVAL).start()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+        profile_id = save(sampler, {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'view': getattr(request, 'instrumented_view', None),
+            'user': user.get_username(),
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        })
+        profiling_logger.info("REQUEST PROFILED %s", profile_id)
+        response['X-Profile'] = profile_id
+        return response
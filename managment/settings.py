@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import re
+import dj_database_url
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -51,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'managment.middleware.RequestMetricsMiddleware',
+    'managment.middleware.QueryInstrumentationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -58,6 +62,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After the session user is known
+    'managment.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,6 +88,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'managment.wsgi.application'
 
+# Threads that run the views of each process served by managment.asgi
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -90,9 +99,65 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # A file (not the shared in-memory database) lets concurrent test
+        # threads wait on SQLite locks like production workers do
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
+# Read replicas, given as comma separated database URLs, for example
+# DATABASE_REPLICA_URLS=sqlite:////path/to/replica.sqlite3 to try it locally
+# with a copy of db.sqlite3. Reads of the views that allow it go to them
+# and users are kept on the primary REPLICA_PIN_SECONDS after a write.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = 'replica%s' % (index + 1)
+    DATABASES[alias] = dict(dj_database_url.parse(url, conn_max_age=600), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['inventory.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+
+# SQLite tuning, applied to every new connection. WAL lets readers run
+# while a sale is written, and writers wait SQLITE_BUSY_TIMEOUT milliseconds
+# for the lock. With SQLITE_WRITER_QUEUE the sales of a process are written
+# one at a time by a single thread.
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+SQLITE_PRAGMAS = {
+    # Durable across crashes of the process, only a power loss can lose
+    # the last commits in WAL mode
+    'synchronous': 'NORMAL',
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+    'mmap_size': 128 * 1024 * 1024,
+}
+SQLITE_WRITER_QUEUE = os.environ.get('SQLITE_WRITER_QUEUE', 'false').lower() == 'true'
+
+
+# Cache
+# Local memory by default, set CACHE_BACKEND to
+# django.core.cache.backends.filebased.FileBasedCache and CACHE_LOCATION to
+# a directory to share cached values between the gunicorn workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'managment'),
+    }
+}
+# A local memory cache is private to each worker, which never sees the
+# writes handled by the others, so its cached totals may be stale for
+# TOTALS_CACHE_TIMEOUT seconds, and the lists have no ETags. A shared cache
+# sees every write.
+CACHE_IS_SHARED = CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+TOTALS_CACHE_TIMEOUT = int(os.environ.get('TOTALS_CACHE_TIMEOUT', 3600 if CACHE_IS_SHARED else 5))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -130,33 +195,75 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
+# Logging
+# Records are written as JSON lines by background threads. The request
+# payload and response dumps of the views go to the inventory.views.payload
+# logger, and only LOG_PAYLOAD_SAMPLE_RATE of them are kept.
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '0.1'))
+
+# Every request is logged with its SQL queries and time, and as a warning
+# when it is slow, runs too many queries or repeats the same one (N+1)
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'true').lower() == 'true'
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES', 50))
+REPEATED_QUERY_THRESHOLD = int(os.environ.get('REPEATED_QUERY_THRESHOLD', 10))
+
+# Requests of staff users with the X-Profile header or profile param are
+# sampled every PROFILE_INTERVAL seconds, profiles are kept PROFILE_TTL seconds
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'managment', 'tmp', 'profiles'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+PROFILE_TTL = int(os.environ.get('PROFILE_TTL', 24 * 3600))
+
+# Metrics of every request by view, REQUEST_METRICS=false turns them off.
+# Every worker process writes its own file in METRICS_DIR, at most every
+# METRICS_FLUSH_INTERVAL seconds. The server deletes the files of the
+# directory when it starts, so it must not be shared with other projects.
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', 'true').lower() == 'true'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(BASE_DIR, 'managment', 'tmp', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'console': {
-            'format': '%(name)-12s %(levelname)-8s %(message)s'
-        },
-        'file': {
-            'format': '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+        'json': {
+            '()': 'managment.log.JSONFormatter'
+        }
+    },
+    'filters': {
+        'sample_payloads': {
+            '()': 'managment.log.SamplingFilter',
+            'rate': LOG_PAYLOAD_SAMPLE_RATE
         }
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'console'
+            'class': 'managment.log.BackgroundHandler',
+            'formatter': 'json',
+            'target': {
+                'class': 'logging.StreamHandler'
+            }
         },
         'file': {
-            'level': 'DEBUG',
-            'class': 'logging.FileHandler',
-            'formatter': 'file',
-            'filename': 'managment/tmp/debug.log'
+            'class': 'managment.log.BackgroundHandler',
+            'formatter': 'json',
+            'target': {
+                'class': 'logging.handlers.RotatingFileHandler',
+                'filename': os.path.join(BASE_DIR, 'managment', 'tmp', 'debug.log'),
+                'maxBytes': 10 * 1024 * 1024,
+                'backupCount': 5
+            }
         }
     },
     'loggers': {
         '': {
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'handlers': ['console', 'file']
+        },
+        'inventory.views.payload': {
+            'filters': ['sample_payloads']
         }
     }
 }
@@ -167,10 +274,19 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [],
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'inventory.authentication.CachedTokenAuthentication',
     ]
 }
 
+# Users of recently seen tokens are kept in memory for TOKEN_CACHE_TTL
+# seconds, and in the shared cache too when TOKEN_CACHE_SHARED is set
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 30
+TOKEN_CACHE_SHARED = False
+
+# Order in which sales consume the stock layers of an article, FIFO or LIFO
+STOCK_ALLOCATION_POLICY = 'LIFO'
+
 CORS_ORIGIN_WHITELIST = [
     "http://localhost:3000",
     "http://127.0.0.1:3000"
@@ -178,8 +294,8 @@ CORS_ORIGIN_WHITELIST = [
 
 SITE_ID = 1
 
-# Configure app for Heroku deployment
-django_heroku.settings(locals())
+# Configure app for Heroku deployment, keeping the LOGGING defined above
+django_heroku.settings(locals(), logging=False)
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
@@ -192,4 +308,13 @@ STATICFILES_DIRS = []
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'build', 'media')
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
\ No newline at end of file
+# Worker threads that write the resized variants of uploaded article images
+IMAGE_PIPELINE_WORKERS = int(os.environ.get('IMAGE_PIPELINE_WORKERS', 2))
+
+# Compresses the hashed webpack bundles too, see managment/storage.py
+STATICFILES_STORAGE = 'managment.storage.BuildStaticFilesStorage'
+# Files with a content hash in their name are cached by clients forever
+WHITENOISE_IMMUTABLE_FILE_TEST = r'^%s.*\.[0-9a-f]{8,}\.' % re.escape(STATIC_URL)
+
+# Shell of the Single Page Application, served from memory
+SPA_INDEX = os.path.join(BASE_DIR, 'build', 'index.html')
\ No newline at end of file
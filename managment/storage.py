@@ -0,0 +1,43 @@
+"""
+Static files storage
+The webpack build writes its bundles straight into STATIC_ROOT, with a
+hash of their content in their names, so collectstatic never sees them.
+After collecting and compressing the static files of the apps, this
+storage also writes gzip and brotli copies of every hashed build file,
+which WhiteNoise serves to the clients that accept them. Brotli copies
+need the brotli package.
+"""
+import os
+import re
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+# Names with a content hash, main.3fb070cc.chunk.js or base.5af66c1b1797.css
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+
+
+class BuildStaticFilesStorage(CompressedManifestStaticFilesStorage):
+
+    def post_process(self, *args, **kwargs):
+        yield from super().post_process(*args, **kwargs)
+        if kwargs.get('dry_run'):
+            return
+        compressor = self.create_compressor(quiet=True)
+        for path in self.build_files(compressor):
+            for compressed_path in compressor.compress(path):
+                yield path, compressed_path, True
+
+    def build_files(self, compressor):
+        """
+        Yields the hashed files under STATIC_ROOT worth compressing and
+        without an up to date compressed copy.
+        """
+        for directory, _, files in os.walk(self.location):
+            for name in files:
+                if not HASHED_NAME.search(name) or not compressor.should_compress(name):
+                    continue
+                path = os.path.join(directory, name)
+                compressed = path + '.gz'
+                if os.path.exists(compressed) and \
+                        os.path.getmtime(compressed) >= os.path.getmtime(path):
+                    continue
+                yield path
@@ -1,5 +1,83 @@
-from django.views.generic import TemplateView
-from django.views.decorators.cache import never_cache
+"""
+Single Page Application
+The shell in SPA_INDEX is read once per process and served from memory,
+with a strong ETag of its content and gzip and brotli copies made once.
+It is revalidated on every load, so a new build is picked up right away,
+and unchanged shells are answered with an empty 304.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.views.decorators.http import require_safe
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_shell = None
+_shell_lock = threading.Lock()
+
+
+class Shell:
+    """
+    Content of the shell by encoding, with the ETag of each.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            content = file.read()
+        self.mtime = os.stat(path).st_mtime
+        self.etag = '"%s"' % hashlib.sha256(content).hexdigest()[:32]
+        self.encodings = {None: content}
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            self.encodings['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                self.encodings['br'] = compressed
+
+    def encoding_for(self, accept_encoding):
+        accepted = {value.split(';')[0].strip() for value in accept_encoding.split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.encodings:
+                return encoding
+        return None
+
+    def etag_for(self, encoding):
+        # Each encoding is a different representation with its own strong ETag
+        return self.etag if encoding is None else '%s-%s"' % (self.etag[:-1], encoding)
+
+
+def get_shell():
+    """
+    Returns the loaded shell, reloaded when the file changed in DEBUG.
+    """
+    global _shell
+    with _shell_lock:
+        if _shell is None or settings.DEBUG and \
+                os.stat(settings.SPA_INDEX).st_mtime != _shell.mtime:
+            _shell = Shell(settings.SPA_INDEX)
+        return _shell
+
 
 # Serve Single Page Application
-index = never_cache(TemplateView.as_view(template_name='index.html'))
\ No newline at end of file
+@require_safe
+def index(request):
+    shell = get_shell()
+    encoding = shell.encoding_for(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    etag = shell.etag_for(encoding)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(shell.encodings[encoding], content_type='text/html; charset=utf-8')
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response